@@ -1,5 +1,6 @@
 # ~/~ begin <<docs/gong-web-app-code/center-dashboard.md#libs/cdash.py>>[init]
 
+import asyncio
 from fasthtml.common import *
 from fastlite import database
 from datetime import datetime
@@ -9,6 +10,7 @@ import libs.minio as minio
 import libs.dbset as dbset
 import libs.messages as messages
 import libs.states as states
+import libs.transit as transit
 
 # ~/~ begin <<docs/gong-web-app-code/center-dashboard.md#dashboard>>[init]
 
@@ -102,6 +104,8 @@ def status_page(session, center_name, centers, users, planners, csms):
         H1(f"{center_name}"),
         Div(
             f"Current center state: {extended_states.replace(",", " , ")}  ",Br(),
+            Span("Saving the new database: {2} ({0}/{1} steps)".format(*state_mach.model.save_progress), Br())
+                if "save_db" in state_list and state_mach.model.save_progress else None,
             Div(
                 utils.toggle_markdown("todo-no-production-confirmation"),
                 A("recover from NO PRODUCTION CONFIRMATION AFTER CHECKING center gong computer and Internet",
@@ -153,6 +157,14 @@ def status_page(session, center_name, centers, users, planners, csms):
                  Button("Upload", type="submit"),
             ),
             Br(),Br(),
+            H4("Roll back the center database to its previous version"),
+            Div(id="rollback-feedback"),
+            Form(hx_post="rollback_db", hx_target="#rollback-feedback",
+                hx_confirm="Are you ABSOLUTELY sure to put back the previous database of this center?")
+                (Input(type="hidden", name="center_name", value=center_name),
+                 Button("Roll back", type="submit"),
+            ),
+            Br(),Br(),
             A("set FREE",href="/planning/force_to_free") 
         ) if user_is_admin else None,
         cls="container"
@@ -166,12 +178,21 @@ async def upload_config(file: UploadFile, center_name: str):
     else:
         try:
             filebuffer = await file.read()
-            upload_dir = Path(utils.get_db_path())
-            (upload_dir / file.filename).write_bytes(filebuffer)
+            await asyncio.to_thread(minio.save_config, center_name, filebuffer)
             mess = {"success": "config_uploaded"}
+        except ValueError as e:
+            mess = {"error": "bad_config_content", "etext": str(e)}
         except Exception as e:
             return Redirect(f'/db_error?etext={e}')
     return Div(messages.feedback_to_user(mess))
 
+async def rollback_db(center_name: str):
+    async with states.clocks[center_name]:
+        if states.csms[center_name].configuration[0].id != "free":
+            mess = {"error": "center_not_free"}
+        else:
+            mess = await asyncio.to_thread(transit.rollback_db_file, center_name)
+    return Div(messages.feedback_to_user(mess))
+
 # ~/~ end
 # ~/~ end
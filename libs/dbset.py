@@ -29,6 +29,11 @@ class Center:
 class Planner:
     user_email: str
     center_name: str
+class Scheduled_event:
+    send_id: str
+    center_name: str
+    event: str
+    due_at: str
 
 class Coming_periods:
     start_date: str
@@ -45,6 +50,12 @@ class Timetables:
     auto: int
     targets: str
     comment: str
+class Period_types:
+    period_type: str
+    duration: int
+    time_start_first_day: str
+    time_end_last_day: str
+    tags: str
 class Gongs:
     sound_id: int
     repeat: int
@@ -65,6 +76,19 @@ def get_central_db():
 def gong_db_name(center_name, middle="ok"):
     return center_name.lower() + "." + middle + ".db"
 
+GONG_DB_KEYS = {"coming_periods": ["start_date"],
+                "periods_struct": ["period_type", "day"],
+                "timetables": ["period_type", "day_type", "time"]}
+
+def ensure_gong_db_indexes(db_center):
+    # index the keys of a center gong db, unless an index (primary key included) already starts with them
+    for table, columns in GONG_DB_KEYS.items():
+        indexed = [[info["name"] for info in db_center.q(f"PRAGMA index_info('{index['name']}')")]
+                   for index in db_center.q(f"PRAGMA index_list('{table}')")]
+        if not any(names[:len(columns)] == columns for names in indexed):
+            db_center.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_key ON {table} ({', '.join(columns)})")
+    return
+
 # ~/~ end
 # ~/~ begin <<docs/gong-web-app-code/database-setup.md#setup-database>>[init]
 
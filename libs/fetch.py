@@ -2,41 +2,126 @@
 
 from curl_cffi import requests
 import re
+import os
+import json
+import time
 import asyncio
-from datetime import date
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
 from fasthtml.common import *
 import libs.plancheck as plancheck
 import libs.utils as utils
 import libs.minio as minio
 
+# ~/~ begin <<docs/gong-web-app-code/fetch-courses.md#fetch-cache>>[init]
+
+scrap_cache = OrderedDict()  # {(location, date_start, date_end, page): (expires_at, payload)} oldest use first
+scrap_cache_loaded = False
+scrap_cache_dirty = False  # pages stored since the last write of the cache file
+
+def scrap_cache_file():
+    return utils.get_db_path() + utils.Globals.FETCH_CACHE_FILE
+
+def load_scrap_cache():
+    global scrap_cache_loaded
+    scrap_cache_loaded = True
+    if not utils.Globals.FETCH_CACHE_FILE or not os.path.exists(scrap_cache_file()):
+        return
+    try:
+        with open(scrap_cache_file()) as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        return  # a damaged cache file is just an empty cache
+    for key, expires_at, payload in entries:
+        scrap_cache[tuple(key)] = (expires_at, payload)
+
+def write_scrap_cache(entries):
+    tmp_file = scrap_cache_file() + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(entries, f)
+    os.replace(tmp_file, scrap_cache_file())
+
+async def save_scrap_cache():
+    global scrap_cache_dirty
+    if not utils.Globals.FETCH_CACHE_FILE or not scrap_cache_dirty:
+        return
+    scrap_cache_dirty = False
+    entries = [[list(key), expires_at, payload] for key, (expires_at, payload) in scrap_cache.items()]
+    await asyncio.to_thread(write_scrap_cache, entries)
+
+def get_cached_page(key):
+    if not scrap_cache_loaded:
+        load_scrap_cache()
+    entry = scrap_cache.get(key)
+    if entry is None:
+        return None
+    expires_at, payload = entry
+    if time.time() > expires_at:
+        del scrap_cache[key]
+        return None
+    scrap_cache.move_to_end(key)
+    return payload
+
+def put_cached_page(key, payload, ttl=None):
+    global scrap_cache_dirty
+    scrap_cache_dirty = True
+    ttl = utils.Globals.FETCH_CACHE_TTL if ttl is None else ttl
+    scrap_cache[key] = (time.time() + ttl, payload)
+    scrap_cache.move_to_end(key)
+    while len(scrap_cache) > utils.Globals.FETCH_CACHE_SIZE:
+        scrap_cache.popitem(last=False)
+
+# ~/~ end
 # ~/~ begin <<docs/gong-web-app-code/fetch-courses.md#fetch-api>>[init]
 
-def fetch_scrap(location, date_start, date_end):
-    # Initialize a session that mimics a modern Chrome browser
-    session = requests.Session(impersonate="chrome")
-    all_courses = []
-    page = 1
-    while True:
-        print(f"Scraping courses Dhamma {location} - Page {page}...")
-        # curl_cffi uses the standard 'data' parameter for form-encoded POST requests
-        response = session.post(
-            "https://www.dhamma.org/en-US/courses/do_search",
-            data={
-                "current_state": "OldStudents",
-                "regions[]": location,
-                "daterange": f"{date_start} - {date_end}",
-                "page": page,
-            }
-        )
-        # Parse the JSON response
-        payload = response.json()
-        courses = payload.get("courses", [])
-        all_courses.extend(courses)
-        total_pages = payload.get("pages", 0)
-        if page >= total_pages:
-            break
-        page += 1
+DHAMMA_SEARCH_URL = "https://www.dhamma.org/en-US/courses/do_search"
+scrap_session = None
+scrap_loop = None
+scrap_inflight = {}  # {(location, date_start, date_end, refresh): task} searches being scraped right now
 
+def get_scrap_session():
+    global scrap_session, scrap_loop
+    loop = asyncio.get_running_loop()
+    if scrap_session is None or scrap_loop is not loop:
+        scrap_session = requests.AsyncSession(impersonate="chrome",
+                                              max_clients=utils.Globals.FETCH_CONCURRENCY)
+        scrap_loop = loop
+    return scrap_session
+
+async def fetch_page(session, location, date_start, date_end, page, refresh=False):
+    key = (location, date_start, date_end, page)
+    if not refresh:
+        payload = get_cached_page(key)
+        if payload is not None:
+            return payload
+    print(f"Scraping courses Dhamma {location} - Page {page}...")
+    # curl_cffi uses the standard 'data' parameter for form-encoded POST requests
+    response = await session.post(
+        DHAMMA_SEARCH_URL,
+        data=[
+            ("current_state", "OldStudents"),
+            # several regions in one search are given as "location_1,location_2"
+            *[("regions[]", region) for region in location.split(",")],
+            ("daterange", f"{date_start} - {date_end}"),
+            ("page", page),
+        ]
+    )
+    # Parse the JSON response
+    payload = response.json()
+    put_cached_page(key, payload)
+    return payload
+
+async def scrap_courses(location, date_start, date_end, refresh):
+    session = get_scrap_session()
+    first = await fetch_page(session, location, date_start, date_end, 1, refresh)
+    total_pages = first.get("pages", 0)
+    # gather keeps the page order whatever the order of the responses
+    others = await asyncio.gather(*[fetch_page(session, location, date_start, date_end, page, refresh)
+                                    for page in range(2, total_pages + 1)])
+    await save_scrap_cache()
+    return [c for payload in [first, *others] for c in payload.get("courses", [])]
+
+def extract_courses(all_courses):
     extracted = [
         {
             "course_start_date": c.get("course_start_date"),
@@ -51,55 +136,105 @@ def fetch_scrap(location, date_start, date_end):
     ]   
     return extracted
 
+async def scrap_search(location, date_start, date_end, refresh):
+    return extract_courses(await scrap_courses(location, date_start, date_end, refresh))
+
+async def fetch_scrap(location, date_start, date_end, refresh=False):
+    # identical searches running at the same time share one scrape, result or error:
+    # a forced refresh never joins a search that may be served from the cache
+    key = (location, date_start, date_end, refresh)
+    inflight = scrap_inflight.get(key)
+    if inflight is None:
+        inflight = asyncio.ensure_future(scrap_search(location, date_start, date_end, refresh))
+        scrap_inflight[key] = inflight
+        inflight.add_done_callback(lambda _: scrap_inflight.pop(key, None))
+    # shield: a waiter going away does not cancel the scrape of the others
+    extracted = await asyncio.shield(inflight)
+    return [dict(c) for c in extracted]
+
 
 # ~/~ end
 # ~/~ begin <<docs/gong-web-app-code/fetch-courses.md#period-type>>[init]
 
+course_mappers = {}  # {center: ((all_centers version, center version), CourseTypeMapper)}
+
+class CourseTypeMapper:
+    def __init__(self, dhamma_types, replacement):
+        self.mapping = {}
+        for r in dhamma_types:
+            self.mapping.setdefault(r["raw_course_type"], r["period_type"])
+        by_raw = {}
+        for r in replacement:
+            by_raw.setdefault(r["raw_course_type"], []).append(r)
+        self.replace_all = {}
+        self.replace_descr = {}  # {raw type: (regex, {description: period_type of its first row})}
+        for raw, rows in by_raw.items():
+            replace_all = [r for r in rows if r["course_description"] == "@ALL@"]
+            if replace_all:
+                self.replace_all[raw] = replace_all[0]["period_type"]
+                continue
+            descr = {}
+            for r in rows:
+                descr.setdefault(r["course_description"], r["period_type"])
+            pattern = "|".join(re.escape(d) for d in descr if isinstance(d, str))
+            self.replace_descr[raw] = (re.compile(f"(?=({pattern}))"), descr)
+        self.memo = {}
+
+    def period_type(self, dhamma_type, course_type):
+        key = (dhamma_type, course_type)
+        if key not in self.memo:
+            self.memo[key] = self.resolve(dhamma_type, course_type)
+        return self.memo[key]
+
+    def resolve(self, dhamma_type, course_type):
+        if dhamma_type in self.replace_all:
+            return self.replace_all[dhamma_type]
+        if dhamma_type in self.replace_descr:
+            regex, descr = self.replace_descr[dhamma_type]
+            cleaned_type = re.sub(r'[^a-zA-Z0-9]', '', course_type).upper()
+            found = set(regex.findall(cleaned_type))
+            if found:
+                # dicts keep the table order
+                return next(pt for d, pt in descr.items() if d in found)
+        return self.mapping.get(dhamma_type, dhamma_type)
+
+def course_type_mapper(center):
+    version = (minio.config_version("all_centers"), minio.config_version(center))
+    cached = course_mappers.get(center)
+    if cached is None or cached[0] != version:
+        mapper = CourseTypeMapper(minio.dicts_from_excel("all_centers", "dhamma_course"),
+                                  minio.dicts_from_excel(center, "replacement"))
+        cached = course_mappers[center] = (version, mapper)
+    return cached[1]
+
 def get_period_type(dhamma_type, course_type: str, dhamma_types, replacement):
-    replace_dhamma = [r for r in replacement if r["raw_course_type"] == dhamma_type]
-    if replace_dhamma:
-        replace_all = [r for r in replace_dhamma if r["course_description"] == "@ALL@"]
-        if replace_all:
-            return replace_all[0]["period_type"]
-        cleaned_type = re.sub(r'[^a-zA-Z0-9]', '', course_type).upper()
-        replace_cleaned = [r for r in replace_dhamma if r["course_description"] in cleaned_type]
-        if replace_cleaned:
-            return replace_cleaned[0]["period_type"]    
-    match_dhamma = [r for r in dhamma_types if r["raw_course_type"] == dhamma_type]
-    if  match_dhamma:
-        return match_dhamma[0]['period_type']
-    return dhamma_type
+    return CourseTypeMapper(dhamma_types, replacement).period_type(dhamma_type, course_type)
 # ~/~ end
 # ~/~ begin <<docs/gong-web-app-code/fetch-courses.md#deduplicate>>[init]
 
 def deduplicate(merged):
     deduplicated = []
-    i = 0
-    while i < len(merged):
-        current = merged[i]
-        if i + 1 < len(merged):
-            next_item = merged[i + 1]
-            if (current['start_date'] == next_item['start_date'] and 
-                current['period_type'] == next_item['period_type'] and
-                # current['end_date'] == next_item['end_date'] and
-                current['source'] != next_item['source']):
-                # Mark as BOTH and keep the "dhamma.org" one
-                if current['source'] == "dhamma.org":
-                    current['source'] = 'BOTH'
-                    deduplicated.append(current)
-                else:
-                    next_item['source'] = 'BOTH'
-                    deduplicated.append(next_item)
-                i += 2  # skip next item
-                continue
-        deduplicated.append(current)
-        i += 1
+    unpaired = {}  # {(start_date, period_type): position in deduplicated}
+    for row in merged:
+        key = (row['start_date'], row['period_type'])
+        pos = unpaired.pop(key, None)
+        if pos is not None and deduplicated[pos]['source'] != row['source']:
+            # Mark as BOTH and keep the "dhamma.org" one
+            if deduplicated[pos]['source'] == "dhamma.org":
+                deduplicated[pos]['source'] = 'BOTH'
+            else:
+                row['source'] = 'BOTH'
+                deduplicated[pos] = row
+            continue
+        unpaired[key] = len(deduplicated)
+        deduplicated.append(row)
     return deduplicated
 
 # ~/~ end
 # ~/~ begin <<docs/gong-web-app-code/fetch-courses.md#fetch-courses>>[init]
 
-def get_dhamma_courses_types(extracted, center_obj, dhamma_types, replacement):
+def get_dhamma_courses_types(extracted, center_obj, dhamma_types, replacement, mapper=None):
+    mapper = mapper or CourseTypeMapper(dhamma_types, replacement)
     for course in extracted:   ## [5]
         if course['course_type_anchor'].endswith("OSC"):
             course['course_type_anchor'] = course['course_type_anchor'][:-3].strip()
@@ -108,7 +243,7 @@ def get_dhamma_courses_types(extracted, center_obj, dhamma_types, replacement):
         {
             "start_date": c.get("course_start_date"),
             "end_date": c.get("course_end_date"),
-            "period_type": get_period_type(c.get("course_type_anchor"), c.get("course_type"), dhamma_types, replacement),
+            "period_type": mapper.period_type(c.get("course_type_anchor"), c.get("course_type")),
             "source": "dhamma.org",
             "course_type": c.get("course_type")
         }
@@ -126,31 +261,39 @@ def check_within(this_row, row_aft):
 
 def clean_dhamma_courses(center, periods_dhamma_org, inside):
     cleaned = []
-    delete_list = [d for d in inside if d["action"] == "delete"]
+    delete_rules = {}  # {period_type: its delete rules in table order}
+    for d in inside:
+        if d["action"] == "delete":
+            delete_rules.setdefault(d["period_type"], []).append(d)
     insert1_list = [d for d in inside if d["action"] == "insert1"]
+    insert1_containers = {d["container"] for d in insert1_list}
+    durations = None  # {period_type: duration} read at the first insert1 row
     for i, row in enumerate(periods_dhamma_org):
         if i == 0:
             cleaned.append(row)
             continue
         row_bef = periods_dhamma_org[i-1]
 
-        row_delete_list = [d for d in delete_list if d["period_type"] == row["period_type"]]
+        row_delete_list = delete_rules.get(row["period_type"])
         if row_delete_list:
             if row_delete_list[0]["container"] == "@ALL@":
                 # row_bef["No_gong"] = row["period_type"]
                 cleaned[-1]["No_gong"] = row["period_type"]
                 continue
-            elif [d for d in row_delete_list if d["container"] == row_bef["period_type"] \
-                                            and check_within(row, row_bef)]:
+            elif any(d["container"] == row_bef["period_type"] for d in row_delete_list) \
+                                            and check_within(row, row_bef):
                 # row_bef["No_gong"] = row["period_type"]
                 cleaned[-1]["No_gong"] = row["period_type"]
                 continue
             else:
                 cleaned.append(row)
                 continue
-        elif [d for d in insert1_list if d["container"] == row["period_type"]]:
-            first_period_duration = [d for d in plancheck.get_types_with_duration(center) 
-                                        if d["period_type"] == row["period_type"]][0]["duration"]
+        elif row["period_type"] in insert1_containers:
+            if durations is None:
+                durations = {}
+                for d in plancheck.get_types_with_duration(center):
+                    durations.setdefault(d["period_type"], d["duration"])
+            first_period_duration = durations[row["period_type"]]
             end_first_period = utils.add_months_days(row["start_date"], 0, first_period_duration - 1)
             first_row = {
                 "start_date": row["start_date"],
@@ -201,38 +344,92 @@ def fillgaps_dhamma_courses(periods_dhamma_org, inside):
     return filled
 
 def sort_clean(center,aplan, inside):
-    # Sort by end_date descending first then RE_SORT EVERYTHING by start_date ascending
-    # this keeps the first sorting order ok for identical start_dates
-    sorted_plan = sorted(sorted(aplan, key=lambda x: x['end_date'], reverse=True),
-                      key=lambda x: x['start_date'])
+    # One sort by start_date ascending then end_date descending,
+    # identical dates keep the merge order
+    sorted_plan = sorted(aplan, key=lambda x: (x['start_date'], -date.fromisoformat(x['end_date']).toordinal()))
     dedup = deduplicate(sorted_plan)
     dedup_cleaned = clean_dhamma_courses(center, dedup, inside)
     cleaned_filled = fillgaps_dhamma_courses(dedup_cleaned, inside)
     return cleaned_filled
 
-async def fetch_dhamma_courses(centers, center, num_months, num_days):
-    center_obj = centers[center]
-    # get the course_type mapping table from the spreadsheet
-    dhamma_types = minio.dicts_from_excel("all_centers", "dhamma_course")
-    replacement = minio.dicts_from_excel(center,"replacement")
-    inside = minio.dicts_from_excel(center,"inside")
+def center_search(center, num_months, num_days, source="df"):
     params = minio.params_from_excel(center)
     dhamma_location = f"location_{params[utils.Pkey.LOCATION]}"
 
     # get the start date for the last course just before today = current course - or service
-    periods_db_center, date_current_course = plancheck.coming_center_courses(center)
+    # durations from the edit session ("df"), or from the saved db ("db") for a center not being edited
+    periods_db_center, date_current_course = plancheck.coming_center_courses(center, source)
 
     end_date = utils.add_months_days(date_current_course, num_months, num_days)
+    return dhamma_location, date_current_course, end_date, periods_db_center
 
-    # fetch extracted courses from dhamma.org
-    extracted = await asyncio.to_thread(fetch_scrap, dhamma_location, date_current_course, end_date)
+def merge_center_courses(centers, center, periods_db_center, extracted):
+    center_obj = centers[center]
+    inside = minio.dicts_from_excel(center,"inside")
 
-    # get the course_type for each extracted course from the mapping and replacements tables
-    periods_dhamma = get_dhamma_courses_types(extracted, center_obj, dhamma_types, replacement)
+    # get the course_type for each extracted course from the mapping and replacements tables of the spreadsheets
+    periods_dhamma = get_dhamma_courses_types(extracted, center_obj, None, None, course_type_mapper(center))
 
     # merge the 2 course lists, sort the merge and deduplicate identical courses
     merged = periods_db_center + periods_dhamma
     dedup_cleaned = sort_clean(center,merged, inside)
     return dedup_cleaned
+
+async def fetch_dhamma_courses(centers, center, num_months, num_days, refresh=False):
+    dhamma_location, date_start, date_end, periods_db_center = center_search(center, num_months, num_days)
+
+    # fetch extracted courses from dhamma.org
+    extracted = await fetch_scrap(dhamma_location, date_start, date_end, refresh)
+    return merge_center_courses(centers, center, periods_db_center, extracted)
+# ~/~ end
+# ~/~ begin <<docs/gong-web-app-code/fetch-courses.md#fetch-all-centers>>[init]
+
+nightly_task = None
+
+def course_location(course):
+    return f"location_{course.get('location', {}).get('id')}"
+
+async def fetch_all_dhamma_courses(centers, num_months, num_days):
+    searches = {}
+    for center_obj in centers():
+        try:
+            searches[center_obj.center_name] = center_search(center_obj.center_name, num_months, num_days, "db")
+        except Exception as e:
+            print(f"Dhamma batch: {center_obj.center_name} skipped: {e}")
+    if not searches:
+        return {}
+    locations = ",".join(sorted({search[0] for search in searches.values()}))
+    date_start = min(search[1] for search in searches.values())
+    date_end = max(search[2] for search in searches.values())
+    all_courses = await scrap_courses(locations, date_start, date_end, True)
+
+    warmed = {}
+    for center, (location, start, end, _) in searches.items():
+        center_courses = [c for c in all_courses if course_location(c) == location
+                          and c.get("course_end_date", "") >= start and c.get("course_start_date", "") <= end]
+        put_cached_page((location, start, end, 1), {"courses": center_courses, "pages": 1},
+                        utils.Globals.FETCH_WARM_TTL)
+        warmed[center] = len(center_courses)
+    await save_scrap_cache()
+    return warmed
+
+async def nightly_refresh(centers):
+    while True:
+        now = datetime.now()
+        next_run = now.replace(hour=utils.Globals.FETCH_WARM_HOUR, minute=0, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+        try:
+            warmed = await fetch_all_dhamma_courses(centers, utils.Globals.MONTHS_TO_FETCH,
+                                                    utils.Globals.DAYS_TO_FETCH)
+            print(f"Dhamma nightly refresh done for {len(warmed)} centers")
+        except Exception as e:
+            print(f"Dhamma nightly refresh failed: {e}")
+
+async def start_nightly_refresh(centers):
+    # awaited at server startup: an async startup function runs on the event loop
+    global nightly_task
+    nightly_task = asyncio.get_running_loop().create_task(nightly_refresh(centers))
 # ~/~ end
 # ~/~ end
@@ -12,6 +12,7 @@ def feed_text(params):
         'center_deleted': 'Center and associated database deleted successfully!',
         'config_downloaded': "Configuration in database downloaded",
         'config_uploaded': "New configuration loaded in database",
+        'db_rolled_back': f'The previous database, saved on {params.get("date", "")}, is again the current one.',
         'line_deleted': 'Line deleted. Please review the plan and submit changes to update the center gong.',
         'login_code_sent': "A code to sign in has been sent to your email. Please check your inbox and enter the code here below. The code will expire in 15 minutes.",
         'new_course': 'New line added if did not exist already. Please review the plan and submit changes to update the center gong.',
@@ -23,15 +24,18 @@ def feed_text(params):
         'time_duplicated': f'New time for gong planning: {params.get("time", "")}.',
         'time_inserted': f'Gong playing time inserted: {params.get("time", "")}.',
         'time_modified': f'Gong playing time modified: {params.get("time", "")}.',
+        'times_batch_changed': f'Gong playing times changed: {params.get("inserted", 0)} inserted, {params.get("modified", 0)} modified, {params.get("deleted", 0)} deleted.',
         'user_added': 'User added successfully!',
         'user_deleted': 'User deleted successfully!',
     }
     error_messages = {
+        'bad_config_content': f'The configuration workbook is not valid: {params.get("etext", "")}. It was not loaded.',
         'bad_config_filename': 'The filename does not match the center name and/or is nor a .xslx excel file',
+        'batch_line_invalid': f'Timings not changed, line {params.get("line", "")} is invalid: {params.get("reason", "")}.',
         'center_exists': 'Center with this name already exists.',
         'center_has_planners': f'Cannot delete center. Center is still associated with users: {params.get("users", "")}. Please remove all planner associations first.',
         'center_not_found': 'Center not found.',
-        'center_not_free': 'Cannot delete a center or modify its config when not in the "free" state: its planning is currently under modification',
+        'center_not_free': 'Cannot delete a center, modify its config or roll back its database when not in the "free" state: its planning is currently under modification',
         'day_type_already_exists': 'Cannot create a new day_type when the name already exists',
         'day_type_unchanged' : 'New day_type same as old day_type',
         'db_error': f'Database error occurred: {params.get("etext", "")}. Please contact the program support.',
@@ -42,17 +46,23 @@ def feed_text(params):
         'last_planner_for_center': f'Cannot delete planner. This is the last planner for center: "{params.get("center", "")}". Each center must have at least one planner.',
         'missing_email':'Email is required.',
         'missing_fields': 'Please fill in all required fields.',
+        'no_previous_db': 'No previous database is kept for this center: nothing to roll back.',
         'not_registered': f'Email "{params.get("email", "")}" is not registered, try again or send a message to xxx@xxx.xx to get registered',
         'period_already_exists': 'Cannot create a new period when the name already exists',
         'periods_errors': 'Error(s) in period(s) timings: see table "Timing errors". Must be corrected before saving these changes', 
         'plan_not_ok': 'Correct the planning errors before saving this plan: click "Load saved plan" and suppress the red indicators.',
         'plan_not_saved': 'Create an initial plan with "(re)Start planning" before loading a saved plan',
         'planner_exists': 'This planner association already exists.',
+        'previous_db_corrupted': 'The previous database does not match its recorded checksum: it was not restored.',
+        'previous_db_missing': 'The previous database file is missing: it was not restored.',
+        'row_not_found': 'This line was deleted meanwhile: select its period or day type again.',
+        'sending_db_changed': f'The new database {params.get("file", "")} changed since it was saved: it was not put in production.',
         'template_not_found': 'Template database (xxxx.db) not found.',
         'template_not_free': 'Cannot copy a template if it is not free: being modified',
         'time_already_exists': f'Time already exists in the planning: {params.get("time", "")}.',
         'timings_not_ok': 'Correct the timings errors before saving this plan: click "Load saved timetables" and suppress all lines in table "Timing errors".',
         'timings_not_saved': 'Create initial timings with "(re)Start timetables" before loading saved timetables',
+        'timings_unchanged': 'These timings are the same as the current ones: nothing changed.',
         'user_exists': 'User with this email already exists.',
         'user_has_planners': f'Cannot delete user. User is still associated with centers: {params.get("centers", "")}. Please remove all planner associations first.',
         'user_not_found': 'User not found.',
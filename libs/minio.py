@@ -1,6 +1,13 @@
 # ~/~ begin <<docs/gong-web-app-code/storage-minio.md#libs/minio.py>>[init]
 
 import os
+import json
+import threading
+import itertools
+from bisect import bisect_left, bisect_right
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from pathlib import Path
 import libs.utils as utils
 import pandas as pd 
@@ -71,14 +78,79 @@ def file_download(bucket, the_object, file_to_write):
 # ~/~ end
 # ~/~ begin <<docs/gong-web-app-code/storage-minio.md#get-save-temp-files>>[init]
 
+temp_store = {}   # {center: {df_name: DataFrame}} in-memory edit session data
+temp_dirty = {}   # {center: set of df_names not yet written back to parquet}
+temp_timers = {}  # {center: threading.Timer} debounced write-back
+temp_lock = threading.RLock()
+temp_versions = {}  # {center: {df_name: int}} a new number each time a table is replaced
+temp_version_counter = itertools.count(1)
+temp_evict_callbacks = []  # functions(center) forgetting what other modules built from an edit session
+
+def temp_file_path(center, df_name):
+    return f"{utils.get_db_path()}{center}{df_name}.parquet"
+
+def set_temp_df(center, df_name, df):
+    temp_store.setdefault(center, {})[df_name] = df
+    temp_versions.setdefault(center, {})[df_name] = next(temp_version_counter)
+
+def temp_version(center, df_name):
+    # changes whenever the table changes: for caches of values computed from it
+    with temp_lock:
+        if df_name not in temp_store.get(center, {}):
+            get_center_temp_df(center, df_name)
+        return temp_versions[center][df_name]
+
 def get_center_temp_df(center, df_name):
-    file_path = f"{utils.get_db_path()}{center}{df_name}.parquet"
-    df = pd.read_parquet(file_path)
-    return df
+    with temp_lock:
+        df = temp_store.get(center, {}).get(df_name)
+        if df is None:
+            df = read_temp_snapshot_journal(center, df_name)
+            set_temp_df(center, df_name, df)
+        # callers modify the returned DataFrame in place: never hand out the cached one
+        return df.copy()
 
 def save_df_center_temp(center, df_name, df):
-    file_path = f"{utils.get_db_path()}{center}{df_name}.parquet"
-    df.to_parquet(file_path)
+    with temp_lock:
+        if df_name in TEMP_KEYS:
+            df = index_temp_df(df, df_name)
+            reset_row_ids(center, df_name, df)
+        set_temp_df(center, df_name, df.copy())
+        temp_dirty.setdefault(center, set()).add(df_name)
+        timer = temp_timers.pop(center, None)
+        if timer:
+            timer.cancel()
+        timer = threading.Timer(utils.Globals.TEMP_FLUSH_DELAY, flush_temp_center_data, args=(center,))
+        timer.daemon = True
+        temp_timers[center] = timer
+        timer.start()
+    return
+
+def flush_temp_center_data(center):
+    # write back to parquet all the temp DataFrames of this center changed since the last flush
+    with temp_lock:
+        timer = temp_timers.pop(center, None)
+        if timer:
+            timer.cancel()
+        journaled = set(temp_journal_len.get(center, {}))
+        for df_name in sorted(temp_dirty.pop(center, set()) | journaled):
+            compact_temp_journal(center, df_name)
+    return
+
+def evict_temp_center_data(center):
+    # forget the in-memory edit session of this center WITHOUT writing it back
+    with temp_lock:
+        timer = temp_timers.pop(center, None)
+        if timer:
+            timer.cancel()
+        temp_dirty.pop(center, None)
+        temp_journal_len.pop(center, None)
+        temp_store.pop(center, None)
+        temp_versions.pop(center, None)
+        temp_row_ids.pop(center, None)
+        for df_name in TEMP_KEYS:
+            temp_key_lists.pop((center, df_name), None)
+        for forget in temp_evict_callbacks:
+            forget(center)
     return
 
 def get_center_temp_list_of_dicts(center, key):
@@ -91,18 +163,153 @@ def save_center_temp_list_of_dicts(center, key, data):
     return
 
 def remove_temp_center_data(center):
+    evict_temp_center_data(center)
     folder = Path(utils.get_db_path())
     target_files = [
         file_path for file_path in folder.iterdir()
-        if file_path.is_file() and file_path.name.startswith(center) and file_path.suffix == '.parquet'
+        if file_path.is_file() and file_path.name.startswith(center) and file_path.suffix in ('.parquet', '.jsonl')
     ]
     for file_path in target_files:
         file_path.unlink()
     return
 
+# ~/~ end
+# ~/~ begin <<docs/gong-web-app-code/storage-minio.md#temp-journal>>[init]
+
+TEMP_KEYS = {"timetables": ["period_type", "day_type", "time"],
+             "periods_struct": ["period_type", "day"]}
+
+temp_journal_len = {}  # {center: {df_name: number of records in the journal}}
+
+def temp_journal_path(center, df_name):
+    return f"{utils.get_db_path()}{center}{df_name}.journal.jsonl"
+
+def json_value(value):
+    # numpy scalars from DataFrame rows are not JSON serializable
+    return value.item() if hasattr(value, "item") else str(value)
+
+temp_row_ids = {}  # {center: {df_name: itertools.count}} the next row ids of the keyed tables
+temp_key_lists = {}  # {(center, df_name): (version, sorted list of row keys)}
+
+def index_temp_df(df, df_name):
+    # string keys as categories, rows sorted on the key, a row id as index
+    if df.index.name != "row_id":
+        df = df.reset_index(drop=True).rename_axis("row_id")
+    if not len(df.columns):
+        return df
+    keys = TEMP_KEYS[df_name]
+    df = df.astype({k: "category" for k in keys if pd.api.types.is_string_dtype(df[k])})
+    return df.sort_values(by=keys, kind="stable")
+
+def reset_row_ids(center, df_name, df):
+    # next ids after the ones of the table and never going back: an id is not given twice
+    old_ids = temp_row_ids.setdefault(center, {}).get(df_name)
+    first = max(int(df.index.max()) + 1 if len(df) else 0, next(old_ids) if old_ids else 0)
+    temp_row_ids[center][df_name] = itertools.count(first)
+
+def apply_temp_changes(df, df_name, changes, row_ids):
+    keys = TEMP_KEYS[df_name]
+    for change in changes:
+        old_keys = list(zip(*(df[k] for k in keys)))
+        if change["op"] == "delete":
+            to_drop = {tuple(k) for k in change["keys"]}
+        else:  # upsert
+            new_rows = pd.DataFrame(change["rows"], columns=df.columns if len(df.columns) else None)
+            new_keys = list(zip(*(new_rows[k] for k in keys)))
+            to_drop = set(new_keys)
+            # a replaced row keeps its id
+            id_of_key = dict(zip(old_keys, df.index))
+            new_rows.index = pd.Index([id_of_key.pop(k) if k in id_of_key else next(row_ids) for k in new_keys],
+                                      name="row_id")
+        df = df[[k not in to_drop for k in old_keys]]
+        if change["op"] == "upsert":
+            df = pd.concat([df, new_rows]) if len(df) else new_rows
+    return index_temp_df(df, df_name)
+
+def read_temp_snapshot_journal(center, df_name):
+    df = pd.read_parquet(temp_file_path(center, df_name))
+    if "row_id" in df.columns:
+        df = df.set_index("row_id")
+    journal_path = temp_journal_path(center, df_name)
+    if df_name in TEMP_KEYS:
+        df = index_temp_df(df, df_name)
+        reset_row_ids(center, df_name, df)
+        if os.path.exists(journal_path):
+            with open(journal_path) as f:
+                changes = [json.loads(line) for line in f if line.strip()]
+            df = apply_temp_changes(df, df_name, changes, temp_row_ids[center][df_name])
+            temp_journal_len.setdefault(center, {})[df_name] = len(changes)
+    return df
+
+def get_center_temp_rows(center, df_name, *key):
+    # rows whose key starts with these values, found by binary search in the sorted keys
+    with temp_lock:
+        version = temp_version(center, df_name)  # loads the table when needed
+        df = temp_store[center][df_name]
+        cached = temp_key_lists.get((center, df_name))
+        if cached is None or cached[0] != version:
+            cached = (version, list(zip(*(df[k] for k in TEMP_KEYS[df_name]))))
+            temp_key_lists[(center, df_name)] = cached
+        def prefix(row_key):
+            return row_key[:len(key)]
+        start = bisect_left(cached[1], key, key=prefix)
+        stop = bisect_right(cached[1], key, key=prefix)
+        return df.iloc[start:stop].copy()
+
+def get_center_temp_row(center, df_name, row_id):
+    # the row with this id as a one-row DataFrame, None when it was deleted meanwhile
+    with temp_lock:
+        temp_version(center, df_name)  # loads the table when needed
+        df = temp_store[center][df_name]
+        return df.loc[[row_id]].copy() if row_id in df.index else None
+
+def change_center_temp(center, df_name, changes):
+    # apply a change to a journaled temp DataFrame, append it to the journal and return the new table
+    with temp_lock:
+        get_center_temp_df(center, df_name)  # loaded with its row ids
+        df = apply_temp_changes(temp_store[center][df_name], df_name, changes, temp_row_ids[center][df_name])
+        set_temp_df(center, df_name, df)
+        if df_name in temp_dirty.get(center, set()):
+            # the snapshot is older than memory: the debounced write-back folds this change in too
+            save_df_center_temp(center, df_name, df)
+            return df.copy()
+        with open(temp_journal_path(center, df_name), "a") as f:
+            for change in changes:
+                f.write(json.dumps(change, default=json_value) + "\n")
+        lengths = temp_journal_len.setdefault(center, {})
+        lengths[df_name] = lengths.get(df_name, 0) + len(changes)
+        if lengths[df_name] > utils.Globals.TEMP_JOURNAL_MAX:
+            compact_temp_journal(center, df_name)
+    return df.copy()
+
+def compact_temp_journal(center, df_name):
+    # fold the journal into a new snapshot of the table
+    with temp_lock:
+        df = temp_store[center][df_name]
+        if df.index.name == "row_id":
+            # as a column: the parquet engine does not keep this index
+            df = df.reset_index()
+        df.to_parquet(temp_file_path(center, df_name))
+        temp_dirty.get(center, set()).discard(df_name)
+        temp_journal_len.get(center, {}).pop(df_name, None)
+        journal_path = temp_journal_path(center, df_name)
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+    return
+
 # ~/~ end
 # ~/~ begin <<docs/gong-web-app-code/storage-minio.md#get-save-excel-files>>[init]
 
+CONFIG_SCHEMA_VERSION = 1
+CONFIG_SHEETS = {"all_centers": ["dhamma_course"],
+                 "center": ["params", "replacement", "inside"]}
+CONFIG_PARAMS = [utils.Pkey.TIMEZON, utils.Pkey.LOCATION, utils.Pkey.GONG_ID, utils.Pkey.TARGETS]
+
+excel_cache = {}  # {file_path: (mtime_ns, {sheet: list of dicts})}
+excel_lock = threading.Lock()
+config_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="config")
+config_futures = {}  # {file_path: Future} snapshot compilations in progress
+
 def get_excel(center):
     if center == "all_centers":
         file_path = f"{utils.get_db_path()}all_centers.xlsx"
@@ -110,20 +317,120 @@ def get_excel(center):
         file_path = f"{utils.get_db_path()}{center}.xlsx"
     return file_path
 
+def get_config_snapshot(center):
+    return get_excel(center).removesuffix(".xlsx") + ".config.json"
+
+def config_version(center):
+    # changes each time the workbook is replaced
+    return os.stat(get_excel(center)).st_mtime_ns
+
+def invalidate_excel(center):
+    with excel_lock:
+        excel_cache.pop(get_excel(center), None)
+    return
+
 def remove_excel(center):
-    config_path = f'{utils.get_db_path()}{center}.xlsx'
-    if os.path.exists(config_path):
-        os.remove(config_path)
+    for config_path in [get_excel(center), get_config_snapshot(center)]:
+        if os.path.exists(config_path):
+            os.remove(config_path)
+    invalidate_excel(center)
     return
 
-def dicts_from_excel(center, sheet):
+def validate_config(center, sheets):
+    required = CONFIG_SHEETS["all_centers" if center == "all_centers" else "center"]
+    missing = [sheet for sheet in required if sheet not in sheets]
+    if missing:
+        raise ValueError(f"missing sheet(s) {', '.join(missing)}")
+    if "params" in required:
+        params = {item.get("name"): item.get("value") for item in sheets["params"]}
+        missing = [name for name in CONFIG_PARAMS if name not in params]
+        if missing:
+            raise ValueError(f"missing parameter(s) {', '.join(missing)} in sheet 'params'")
+        try:
+            ZoneInfo(str(params[utils.Pkey.TIMEZON]))
+        except (ZoneInfoNotFoundError, ValueError):
+            raise ValueError(f"unknown timezone '{params[utils.Pkey.TIMEZON]}' in sheet 'params'")
+    return
+
+def write_config_snapshot(center, sheets, mtime):
+    snapshot = {"schema": CONFIG_SCHEMA_VERSION, "source_mtime_ns": mtime, "sheets": sheets}
+    snapshot_path = get_config_snapshot(center)
+    with open(snapshot_path + ".tmp", "w") as f:
+        json.dump(snapshot, f, default=json_value)
+    os.replace(snapshot_path + ".tmp", snapshot_path)
+    return
+
+def compile_config(center):
+    # parse the workbook with openpyxl and write its snapshot: runs in config_executor
     file_path = get_excel(center)
-    df = pd.read_excel(file_path, sheet_name=sheet)
-    result = df.to_dict('records')
-    return result
+    mtime = os.stat(file_path).st_mtime_ns
+    all_sheets = pd.read_excel(file_path, sheet_name=None)
+    sheets = {name: df.to_dict('records') for name, df in all_sheets.items()}
+    write_config_snapshot(center, sheets, mtime)
+    return mtime, sheets
+
+def compile_config_in_background(center):
+    file_path = get_excel(center)
+    with excel_lock:
+        future = config_futures.get(file_path)
+        if future is None:
+            future = config_executor.submit(compile_config, center)
+            config_futures[file_path] = future
+            future.add_done_callback(lambda f: config_futures.pop(file_path, None))
+    return future
+
+def read_config_snapshot(center, mtime):
+    try:
+        with open(get_config_snapshot(center)) as f:
+            snapshot = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if snapshot.get("schema") != CONFIG_SCHEMA_VERSION or snapshot.get("source_mtime_ns") != mtime:
+        return None
+    return mtime, snapshot["sheets"]
+
+def precompile_all_configs():
+    for file_path in Path(utils.get_db_path()).glob("*.xlsx"):
+        center = file_path.stem
+        if read_config_snapshot(center, file_path.stat().st_mtime_ns) is None:
+            compile_config_in_background(center)
+    return
+
+def save_config(center, filebuffer):
+    # validate an uploaded workbook, then store it with its snapshot: raises ValueError if not valid
+    try:
+        all_sheets = pd.read_excel(BytesIO(filebuffer), sheet_name=None)
+    except Exception as e:
+        raise ValueError(f"not a readable excel workbook ({e})")
+    sheets = {name: df.to_dict('records') for name, df in all_sheets.items()}
+    validate_config(center, sheets)
+    file_path = Path(get_excel(center))
+    file_path.write_bytes(filebuffer)
+    mtime = file_path.stat().st_mtime_ns
+    write_config_snapshot(center, sheets, mtime)
+    with excel_lock:
+        excel_cache[str(file_path)] = (mtime, sheets)
+    return
+
+def sheets_from_excel(center):
+    file_path = get_excel(center)
+    mtime = os.stat(file_path).st_mtime_ns
+    with excel_lock:
+        cached = excel_cache.get(file_path)
+    if cached is None or cached[0] != mtime:
+        cached = read_config_snapshot(center, mtime)
+        if cached is None:
+            cached = compile_config_in_background(center).result()
+        with excel_lock:
+            excel_cache[file_path] = cached
+    return cached[1]
+
+def dicts_from_excel(center, sheet):
+    # fresh dicts: callers may modify them
+    return [dict(row) for row in sheets_from_excel(center)[sheet]]
 
 def params_from_excel(center):
-    list_of_dicts = dicts_from_excel(center, "params")
+    list_of_dicts = sheets_from_excel(center)["params"]
     one_dict = {item["name"]: item["value"] for item in list_of_dicts}
     return one_dict
 
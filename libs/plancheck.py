@@ -3,6 +3,8 @@
 from fasthtml.common import *
 from fastlite import database
 from datetime import date
+import os
+import numpy as np
 import pandas as pd
 import libs.utils as utils
 import libs.dbset as dbset
@@ -10,8 +12,8 @@ import libs.minio as minio
 
 # ~/~ begin <<docs/gong-web-app-code/gong-plan-check.md#this-center-courses>>[init]
 
-def add_end_dates(plan, center):
-    types_with_duration = get_types_with_duration(center)
+def add_end_dates(plan, center, source="df"):
+    types_with_duration = get_types_with_duration(center, source)
     for i in range(len(plan)):
         if 'end_date' not in plan[i] or plan[i]['end_date'] is None:
             this_type = list(filter(lambda x: x.get("period_type") == plan[i]['period_type'], types_with_duration))[0]
@@ -25,16 +27,22 @@ def add_end_dates(plan, center):
                 plan[i]['end_date'] = utils.add_months_days(plan[i]['start_date'], 0, this_type.get("duration") -1)
     return plan
 
-def coming_center_courses(center):
+COMING_PERIODS_SQL = """
+    SELECT start_date, period_type FROM coming_periods
+    WHERE start_date >= COALESCE(
+        (SELECT MAX(start_date) FROM coming_periods WHERE start_date < ?),
+        (SELECT MIN(start_date) FROM coming_periods))
+    ORDER BY start_date
+"""
+
+def coming_center_courses(center, source="df"):
     selected_db = dbset.gong_db_name(center)
     db_center = database(utils.get_db_path() + selected_db)
 
-    periods = sorted(db_center.t.coming_periods(), key=lambda x: x["start_date"])
-    count_past = sum(1 for item in periods if date.fromisoformat(item["start_date"]) < date.today())
-    if count_past == 0:
-        count_past = 1
-    date_current_course = periods[count_past-1]["start_date"]  ## [2]
-    periods_db_center_obj = periods[count_past-1:]  ## [3]
+    # the last course started before today (or the first one if none) and all the following ones:
+    # ISO dates compare as strings, both subqueries and the range are served by the start_date index
+    periods_db_center_obj = db_center.q(COMING_PERIODS_SQL, [date.today().isoformat()])  ## [3]
+    date_current_course = periods_db_center_obj[0]["start_date"]  ## [2]
     sorted_periods = [
         {
             'start_date': p["start_date"],
@@ -46,7 +54,7 @@ def coming_center_courses(center):
     ]
     db_center.close()
     #sorted_periods = sorted(periods_db_center, key=lambda x: x['start_date'])
-    sorted_periods_ends = add_end_dates(sorted_periods, center)
+    sorted_periods_ends = add_end_dates(sorted_periods, center, source)
     return sorted_periods_ends, date_current_course
 
 # ~/~ end
@@ -63,97 +71,174 @@ def get_period_types_list(center, source="df"):
     period_types_in_db = periods_struct_df['period_type'].unique()
     return period_types_in_db
 
-def get_types_with_duration(center, source="df"):
-    period_types_list = get_period_types_list(center, source)
+durations_cache = {}  # {(center, source): (data version, types with duration)}
+
+def durations_version(center, source):
     if source == "df":
-        periods_structs = minio.get_center_temp_list_of_dicts(center, "periods_struct")
-        timetables = minio.get_center_temp_list_of_dicts(center, "timetables")
+        data_version = (minio.temp_version(center, "periods_struct"), minio.temp_version(center, "timetables"))
     else: # source == "db"
-        selected_db = dbset.gong_db_name(center)
-        db_center = database(utils.get_db_path() + selected_db)
-        periods_structs = list(db_center.t.periods_struct())
-        timetables = list(db_center.t.timetables())
-        db_center.close() 
-    params_from_excel = minio.params_from_excel(center)
+        data_version = os.stat(utils.get_db_path() + dbset.gong_db_name(center)).st_mtime_ns
+    return data_version, minio.config_version(center)
+
+def compute_types_with_duration(periods_structs, timetables, default_period):
+    # one pass over each table: {period_type: {day: day_type of its first row}}
+    days_types = {}
+    for row in periods_structs:
+        days = days_types.setdefault(row.get("period_type"), {})
+        if row.get("day") is not None:
+            days.setdefault(row.get("day"), row.get("day_type"))
+    # {(period_type, day_type): (first time, last time)}
+    time_ranges = {}
+    for row in timetables:
+        key = (row.get("period_type"), row.get("day_type"))
+        time = row.get("time")
+        first_last = time_ranges.get(key)
+        if first_last is None:
+            time_ranges[key] = (time, time)
+        else:
+            time_ranges[key] = (min(first_last[0], time), max(first_last[1], time))
     types_duration = []
-    for vt in period_types_list:
-        item = {}
-        item["period_type"] = vt
-        days = [row.get("day") for row in periods_structs
-                if row.get("period_type") == vt and row.get("day") is not None]
-        item["duration"] = max(days) + 1
-        day_0_type = next((row.get("day_type") for row in periods_structs
-                 if row.get("period_type") == vt and row.get("day") == 0), None)
-        times_day_0 = [row.get("time") for row in timetables
-                 if row.get("period_type") == vt and row.get("day_type") == day_0_type] 
-        item["time_start_first_day"] = min(times_day_0, default=None)
-        last_day_type = next((row.get("day_type") for row in periods_structs
-                 if row.get("period_type") == vt and row.get("day") == max(days)), None)
-        times_last_day = [row.get("time") for row in timetables
-                 if row.get("period_type") == vt and row.get("day_type") == last_day_type] 
-        item["time_end_last_day"] = max(times_last_day, default=None)
+    for vt, days in days_types.items():
+        last_day = max(days)
+        last_day_type = days[last_day]
+        item = {
+            "period_type": vt,
+            "duration": last_day + 1,
+            "time_start_first_day": time_ranges.get((vt, days.get(0)), (None, None))[0],
+            "time_end_last_day": time_ranges.get((vt, last_day_type), (None, None))[1],
+        }
         if "repeat" not in last_day_type :
             item["tags"] = "F"
-        elif params_from_excel.get(utils.Pkey.DEFAULT_PERIOD, "") == vt:
+        elif default_period == vt:
             item["tags"] = "X"
         else:
             item["tags"] = "V"
         types_duration.append(item)
+    return sort_types_with_duration(types_duration)
+
+def sort_types_with_duration(types_duration):
     # Sort by duration first then RE_SORT EVERYTHING by tags descending
     # this keeps the first sorting order ok for identical tags
     types_sorted = sorted(sorted(types_duration, key=lambda x: x['duration'], reverse=True), 
                         key=lambda x: x['tags'])
     return types_sorted
 
+def stored_types_with_duration(db_center, default_period):
+    # the period_types table written with the gong db, None if missing or not matching periods_struct
+    if "period_types" not in db_center.t:
+        return None
+    stored = list(db_center.t.period_types())
+    durations = {row["period_type"]: row["duration"] for row in db_center.q(
+        "SELECT period_type, MAX(day) + 1 AS duration FROM periods_struct GROUP BY period_type")}
+    if {row["period_type"]: row["duration"] for row in stored} != durations:
+        return None
+    for row in stored:
+        # the default period is a center parameter: it may have changed since the db was written
+        if row["tags"] in ("V", "X"):
+            row["tags"] = "X" if row["period_type"] == default_period else "V"
+    return sort_types_with_duration(stored)
+
+def get_types_with_duration(center, source="df"):
+    # version read before the data: a change in between only makes the next call recompute
+    version = durations_version(center, source)
+    cached = durations_cache.get((center, source))
+    if cached is None or cached[0] != version:
+        default_period = minio.params_from_excel(center).get(utils.Pkey.DEFAULT_PERIOD, "")
+        if source == "df":
+            periods_structs = minio.get_center_temp_list_of_dicts(center, "periods_struct")
+            timetables = minio.get_center_temp_list_of_dicts(center, "timetables")
+            types_sorted = compute_types_with_duration(periods_structs, timetables, default_period)
+        else: # source == "db"
+            selected_db = dbset.gong_db_name(center)
+            db_center = database(utils.get_db_path() + selected_db)
+            types_sorted = stored_types_with_duration(db_center, default_period)
+            if types_sorted is None:
+                periods_structs = list(db_center.t.periods_struct())
+                timetables = list(db_center.t.timetables())
+                types_sorted = compute_types_with_duration(periods_structs, timetables, default_period)
+            db_center.close() 
+        cached = (version, types_sorted)
+        durations_cache[(center, source)] = cached
+    # fresh dicts: callers may modify them
+    return [dict(item) for item in cached[1]]
+
 # ~/~ end
 # ~/~ begin <<docs/gong-web-app-code/gong-plan-check.md#check-complete-plan>>[init]
-def check_plan(session, plan, center):
-    types_with_duration = get_types_with_duration(center)
+
+CHECK_NOTYPE, CHECK_SAME_START, CHECK_VAR_OVERLAP, CHECK_OVERLAP, CHECK_NO_TIME, \
+    CHECK_TIME_OVERLAP_OK, CHECK_TIME_OVERLAP, CHECK_SAME_DAY, CHECK_GAP, CHECK_OK = range(10)
+
+CHECK_TEXTS = {
+    CHECK_NOTYPE: lambda days: "NoType",
+    CHECK_SAME_START: lambda days: "Same starting date",
+    CHECK_VAR_OVERLAP: lambda days: f"CHECK Overlap of {- days} day(s)",
+    CHECK_OVERLAP: lambda days: f"Overlap of {- days} day(s)",
+    CHECK_NO_TIME: lambda days: "Missing time info",
+    CHECK_TIME_OVERLAP_OK: lambda days: "OK Time overlap",
+    CHECK_TIME_OVERLAP: lambda days: "CHECK Time overtap",
+    CHECK_SAME_DAY: lambda days: "OK same day",
+    CHECK_GAP: lambda days: f"CHECK GAP {days} days",
+    CHECK_OK: lambda days: "OK",
+}
+
+def plan_checks(plan, types_with_duration, period_types_in_db):
+    if not plan:
+        return []
+    types = {}
+    for t in types_with_duration:
+        types.setdefault(t.get("period_type"), t)
     default_period = next((t for t in types_with_duration if t.get("tags") == "X"), {}).get("period_type", "")
-    period_types_in_db =  get_period_types_list(center)
-    session[utils.Skey.PLANOK] = True
-    for idx, row in enumerate(plan):
-        pt = row.get("period_type")
-        if idx == len(plan) - 1:
-            if pt not in period_types_in_db:
-                row["check"] = "NoType"
-                session[utils.Skey.PLANOK] = False
-            else:                
-                row["check"] = "OK"
-            continue
-        next_start_date = plan[idx + 1].get("start_date")
-        pt_is_variable = next((t for t in types_with_duration if t.get("period_type") == pt), {"tags":""}).get("tags") in "VX"
-        delta_days = utils.days_between_iso_dates(row.get("end_date"), next_start_date)
-        if pt not in period_types_in_db:
-            row["check"] = "NoType"
-        elif row.get("start_date") == next_start_date:
-            row["check"] = "Same starting date"
-        elif delta_days < 0 and pt_is_variable:
-            row["check"] = f"CHECK Overlap of {- delta_days} day(s)"
-        elif delta_days < 0 and not pt_is_variable:
-            row["check"] = f"Overlap of {- delta_days} day(s)"
-        elif delta_days == 0:
-            this_end_time = next((t.get("time_end_last_day") for t in types_with_duration
-                                if t.get("period_type") == pt), None)
-            next_pt = plan[idx + 1].get("period_type")
-            next_start_time = next((t.get("time_start_first_day") for t in types_with_duration
-                                    if t.get("period_type") == next_pt), None)
-            if this_end_time is None or next_start_time is None:
-                row["check"] = "Missing time info"
-            elif this_end_time > next_start_time:
-                if pt_is_variable or next_pt == default_period:                   
-                    row["check"] = "OK Time overlap"
-                else:
-                    row["check"] = "CHECK Time overtap"
-            else:
-                row["check"] = "OK same day"
-        elif delta_days > 1:
-            row["check"] = f"CHECK GAP {delta_days} days"
-        else:
-            row["check"] = "OK"
-        if not (row["check"].startswith("OK") or row["check"].startswith("CHECK")):
-            session[utils.Skey.PLANOK] = False
+    known_types = set(period_types_in_db)
+    pts = [row.get("period_type") for row in plan]
+    known = np.array([pt in known_types for pt in pts])
+    # every row but the last one, compared with the next row
+    this_pts, next_pts = pts[:-1], pts[1:]
+    starts = np.array([row.get("start_date") for row in plan], dtype="datetime64[D]")
+    ends = np.array([row.get("end_date") for row in plan[:-1]], dtype="datetime64[D]")
+    delta_days = (starts[1:] - ends).astype(int)
+    variable = np.array([types.get(pt, {"tags": ""}).get("tags") in "VX" for pt in this_pts], dtype=bool)
+    end_times = [types.get(pt, {}).get("time_end_last_day") for pt in this_pts]
+    start_times = [types.get(pt, {}).get("time_start_first_day") for pt in next_pts]
+    no_time = np.array([e is None or s is None for e, s in zip(end_times, start_times)], dtype=bool)
+    time_overlap = np.array([e is not None and s is not None and e > s
+                             for e, s in zip(end_times, start_times)], dtype=bool)
+    next_is_default = np.array([pt == default_period for pt in next_pts], dtype=bool)
+    same_day = delta_days == 0
+    codes = np.select(
+        [~known[:-1], starts[:-1] == starts[1:],
+         (delta_days < 0) & variable, delta_days < 0,
+         same_day & no_time, same_day & time_overlap & (variable | next_is_default),
+         same_day & time_overlap, same_day,
+         delta_days > 1],
+        [CHECK_NOTYPE, CHECK_SAME_START, CHECK_VAR_OVERLAP, CHECK_OVERLAP, CHECK_NO_TIME,
+         CHECK_TIME_OVERLAP_OK, CHECK_TIME_OVERLAP, CHECK_SAME_DAY, CHECK_GAP],
+        default=CHECK_OK)
+    checks = [CHECK_TEXTS[code](days) for code, days in zip(codes.tolist(), delta_days.tolist())]
+    checks.append("OK" if known[-1] else "NoType")
+    return checks
+
+def checks_ok(checks):
+    return all(check.startswith("OK") or check.startswith("CHECK") for check in checks)
+
+def check_plan(session, plan, center):
+    checks = plan_checks(plan, get_types_with_duration(center), get_period_types_list(center))
+    for row, check in zip(plan, checks):
+        row["check"] = check
+    session[utils.Skey.PLANOK] = checks_ok(checks)
     return plan
+
+def recheck_rows(session, plan, first, last, center):
+    # rows first..last changed: only their checks and the one of the row before can change.
+    # Returns the range of rows whose check was recomputed, PLANOK is set from all the checks
+    start = max(first - 1, 0)
+    stop = min(last + 2, len(plan))  # the row after last: needed to check last, not checked itself
+    checks = plan_checks(plan[start:stop], get_types_with_duration(center), get_period_types_list(center))
+    if stop < len(plan):
+        checks = checks[:-1]
+    for row, check in zip(plan[start:], checks):
+        row["check"] = check
+    session[utils.Skey.PLANOK] = checks_ok([row.get("check", "") for row in plan])
+    return start, start + len(checks)
 # ~/~ end
 
 # ~/~ end
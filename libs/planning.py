@@ -4,6 +4,7 @@ import asyncio
 import os
 import shutil
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from fasthtml.common import *
 from fastlite import database
@@ -17,38 +18,40 @@ import libs.utilsJS as utilsJS
 
 # ~/~ begin <<docs/gong-web-app-code/gong-planning.md#create-html-table>>[init]
 
+def plan_row(plan_line, **kwargs):
+    # One table row, its id follows the plan line through incremental updates
+    row_id = plan_line.get("row_id")
+    start = plan_line.get("start_date")
+    end = plan_line.get("end_date")
+    ptype = plan_line.get("period_type")
+    source = plan_line.get("source")
+    check = plan_line.get("check")
+    course = plan_line.get("course_type")
+    no_gong = plan_line.get("No_gong", "")
+    # Conditional coloring
+    ptype_cell = Td(B(ptype), style="color: white; background: red") if ptype.startswith("UNKNOWN") else Td(B(ptype))
+    source_cell = Td(source, style="color: white; background: blue") if source in "new input-fill gap" else Td(source)
+    match check[0:2]:
+        case "OK":
+            check_cell = Td(check)
+        case "CH":
+            check_cell = Td(check, style="color: black; background: darkorange")
+        case _:
+            check_cell = Td(check, style="color: white; background: red")
+    # Add delete link for removing this row
+    delete_link = A("Delete",
+        hx_post=f"/planning/delete_line/{row_id}",
+        hx_swap="none",
+        hx_confirm="Are you sure you want to delete this entry?",
+    )
+    return Tr(
+        Td(B(start)), ptype_cell, Td(end), source_cell, check_cell, Td(course), Td(no_gong), Td(delete_link),
+        id=f"plan-row-{row_id}", **kwargs
+    )
+
 def show_draft_plan_table(draft_plan, center, mess):
     # Create an HTML table from a draft plan list of dictionaries
-    rows = []
-    for idx, plan_line in enumerate(sorted(draft_plan, key=lambda x: getattr(x, "start_date", ""))):
-        start = plan_line.get("start_date")
-        end = plan_line.get("end_date")
-        ptype = plan_line.get("period_type")
-        source = plan_line.get("source")
-        check = plan_line.get("check")
-        course = plan_line.get("course_type")
-        no_gong = plan_line.get("No_gong", "")
-        # Conditional coloring
-        ptype_cell = Td(B(ptype), style="color: white; background: red") if ptype.startswith("UNKNOWN") else Td(B(ptype))
-        source_cell = Td(source, style="color: white; background: blue") if source in "new input-fill gap" else Td(source)
-        match check[0:2]:
-            case "OK":
-                check_cell = Td(check)
-            case "CH":
-                check_cell = Td(check, style="color: black; background: darkorange")
-            case _:
-                check_cell = Td(check, style="color: white; background: red")
-        # Add delete link for removing this row
-        delete_link = A("Delete",
-            hx_post=f"/planning/delete_line/{idx}",
-            hx_target="#planning-periods",
-            hx_confirm="Are you sure you want to delete this entry?",
-        )
-        rows.append(
-            Tr(
-                Td(B(start)), ptype_cell, Td(end), source_cell, check_cell, Td(course), Td(no_gong), Td(delete_link)
-            )
-        )
+    rows = [plan_row(plan_line) for plan_line in draft_plan]
     today = datetime.now().date()
     period_types_in_db = plancheck.get_period_types_list(center)
     period_options = [Option(item, value=item) for item in sorted(list(period_types_in_db))]
@@ -76,11 +79,11 @@ def show_draft_plan_table(draft_plan, center, mess):
             Button("Add Period", type="submit")
         ),
         hx_post="/planning/add_line",
-        hx_target="#planning-periods",
+        hx_swap="none",
         ),
     table = Table(
         Thead( Tr( Th("Start date"), Th("Period type"), Th("End date"), Th("Source"), Th("Check"), Th("Info given by center in dhamma.org"), Th("No_gong"), Th("Action"),)),
-        Tbody(*rows)
+        Tbody(*rows, id="plan-rows")
     )
     return Div(
         H2("Current plan with 'www.dhamma.org' added for 12 months from current course start"),
@@ -96,12 +99,12 @@ def show_draft_plan_table(draft_plan, center, mess):
 # ~/~ begin <<docs/gong-web-app-code/gong-planning.md#load-show-center-plan>>[init]
 
 # @rt('/planning/load_dhamma_db')
-def load_dhamma_db(session):
+def load_dhamma_db(session, refresh=False):
     return Div(
         Div("", hx_swap_oob="true", id="timingsubpage"),
         Div(
             P(" Loading this center planning from dhamma.org ..."),
-            Div(hx_get="/planning/check_show_dhamma", 
+            Div(hx_get=f"/planning/check_show_dhamma{'?refresh=1' if refresh else ''}", 
                 hx_target="#planning-periods",
                 hx_trigger="load",  # Triggers when this div loads
                 style="display: none;"),
@@ -109,36 +112,66 @@ def load_dhamma_db(session):
         )
     )
 
-async def save_db_plan_timetable(center_name):
-    source_db_file = utils.get_db_path() + dbset.gong_db_name(center_name)
-    filename = dbset.gong_db_name(center_name, utils.Globals.SENDING)
-    dest_db_file = utils.get_db_path() + filename
-    if os.path.exists(dest_db_file):
-        os.remove(dest_db_file)
-    await asyncio.to_thread(shutil.copy2, Path(source_db_file), Path(dest_db_file))
+SENDING_DB_TABLES = [  # (table, dataclass, primary key) rebuilt from the edit session in the sending db
+    ("coming_periods", dbset.Coming_periods, 'start_date'),
+    ("periods_struct", dbset.Periods_struct, ('period_type', 'day')),
+    ("timetables", dbset.Timetables, ('period_type', 'day_type', 'time')),
+    ("period_types", dbset.Period_types, 'period_type'),  # summary of each period type, for the app and the players
+]
 
-    dest_db = database(dest_db_file)
-    #for t in dest_db.t:
-    #    dest_db.execute(f"DROP TABLE {str(t)}")
-    dest_db.execute("DROP TABLE coming_periods")
-    coming_periods = dest_db.create(dbset.Coming_periods, pk='start_date')
-    for record in minio.get_center_temp_list_of_dicts(center_name, "planning"):
-        coming_periods.insert(start_date=record["start_date"], period_type=record["period_type"])
+def sending_db_rows(center_name):
+    # the records of each rebuilt table, every temp table read once
+    periods_struct = minio.get_center_temp_list_of_dicts(center_name, "periods_struct")
+    timetables = minio.get_center_temp_list_of_dicts(center_name, "timetables")
+    default_period = minio.params_from_excel(center_name).get(utils.Pkey.DEFAULT_PERIOD, "")
+    return {"coming_periods": minio.get_center_temp_list_of_dicts(center_name, "planning"),
+            "periods_struct": periods_struct,
+            "timetables": timetables,
+            "period_types": plancheck.compute_types_with_duration(periods_struct, timetables, default_period)}
 
-    dest_db.execute("DROP TABLE periods_struct")
-    periods_struct = dest_db.create(dbset.Periods_struct, pk=('period_type', 'day'))
-    for record in minio.get_center_temp_list_of_dicts(center_name, "periods_struct"):
-        periods_struct.insert(period_type=record["period_type"], day=record["day"],
-                              day_type=record["day_type"])
+save_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gong-save")  # builds the sending dbs
 
-    dest_db.execute("DROP TABLE timetables")
-    timetables = dest_db.create(dbset.Timetables, pk=('period_type', 'day_type', 'time'))
-    for record in minio.get_center_temp_list_of_dicts(center_name, "timetables"):
-        timetables.insert(period_type=record["period_type"], day_type=record["day_type"],
-                          time=record["time"], gong_id=record["gong_id"], auto=record["auto"],
-                          targets=record["targets"], comment=record["comment"])
-    dest_db.close()
+def write_sending_db(center_name, source_db_file, dest_db_file, progress=lambda done, total, step: None):
+    total = len(SENDING_DB_TABLES) + 2
+    rows = sending_db_rows(center_name)
+    progress(1, total, "edited tables read")
+    build_db_file = dest_db_file + ".build"
+    for file in [build_db_file, dest_db_file]:
+        if os.path.exists(file):
+            os.remove(file)
+    shutil.copy2(source_db_file, build_db_file)
+    build_db = database(build_db_file)
+    # a scratch copy, started again if anything fails: no rollback journal, no sync to disk
+    build_db.execute("PRAGMA journal_mode = OFF")
+    build_db.execute("PRAGMA synchronous = OFF")
+    with build_db.conn:  # one transaction for all the tables
+        for table, cls, pk in SENDING_DB_TABLES:
+            build_db.execute(f"DROP TABLE IF EXISTS {table}")
+            build_db.create(cls, pk=pk)
+            columns = list(cls.__annotations__)
+            build_db.conn.cursor().executemany(
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                [tuple(record[c] for c in columns) for record in rows[table]])
+            progress(2 + [t[0] for t in SENDING_DB_TABLES].index(table), total, f"{table} written")
+        dbset.ensure_gong_db_indexes(build_db)
+    # compact copy without free pages, the file uploaded to the Pis
+    build_db.execute(f"PRAGMA page_size = {utils.Globals.GONG_DB_PAGE_SIZE}")
+    build_db.execute("VACUUM INTO ?", [dest_db_file])
+    build_db.close()
+    os.remove(build_db_file)
+    progress(total, total, "database compacted")
+    return
 
+async def save_db_plan_timetable(center_name, progress=None):
+    source_db_file = utils.get_db_path() + dbset.gong_db_name(center_name)
+    filename = dbset.gong_db_name(center_name, utils.Globals.SENDING)
+    loop = asyncio.get_running_loop()
+    def report(done, total, step):
+        # called in the worker thread: the callback runs on the event loop
+        if progress:
+            loop.call_soon_threadsafe(progress, done, total, step)
+    await loop.run_in_executor(save_executor, write_sending_db, center_name,
+                               source_db_file, utils.get_db_path() + filename, report)
     return filename
 
 async def check_save_show_plan(session, start_plan, mess):
@@ -146,6 +179,8 @@ async def check_save_show_plan(session, start_plan, mess):
     inside = minio.dicts_from_excel(selected_name,"inside")
     plan = fetch.sort_clean(selected_name,start_plan, inside)
     new_draft_plan = plancheck.check_plan(session, plan, selected_name)
+    for row_id, row in enumerate(new_draft_plan):
+        row["row_id"] = row_id
     if not session[utils.Skey.PLANOK]:
         mess_after_check = {"error":"plan_not_ok"}
     else:
@@ -154,19 +189,69 @@ async def check_save_show_plan(session, start_plan, mess):
     session[utils.Skey.SAVED_PLAN] = True
     return show_draft_plan_table(new_draft_plan, selected_name, mess_after_check)
 
+async def update_plan_rows(session, plan, old_ids, start, stop, mess):
+    # plan[start:stop] was just changed: clean it with its neighbours, re-check around it,
+    # save the plan and send out-of-band swaps of the table rows that changed
+    selected_name = session[utils.Skey.CENTER]
+    inside = minio.dicts_from_excel(selected_name,"inside")
+    cleaned = fetch.sort_clean(selected_name, plan[start:stop], inside)
+    plan[start:stop] = cleaned
+    next_id = max([row["row_id"] for row in plan if row.get("row_id") is not None], default=-1) + 1
+    for row in cleaned:
+        if row.get("row_id") is None:
+            row["row_id"] = next_id
+            next_id += 1
+    first, last = plancheck.recheck_rows(session, plan, start, start + len(cleaned) - 1, selected_name)
+    await asyncio.to_thread(minio.save_center_temp_list_of_dicts, selected_name, "planning", plan)
+    session[utils.Skey.SAVED_PLAN] = True
+
+    new_ids = {row["row_id"] for row in plan}
+    swaps = [Template(Tr(id=f"plan-row-{row_id}", hx_swap_oob="delete")) for row_id in old_ids - new_ids]
+    for idx in range(min(first, start), max(last, start + len(cleaned))):
+        row = plan[idx]
+        if row["row_id"] in old_ids:
+            swaps.append(Template(plan_row(row, hx_swap_oob="true")))
+        else:
+            where = f"afterend:#plan-row-{plan[idx - 1]['row_id']}" if idx > 0 else "afterbegin:#plan-rows"
+            swaps.append(Template(Tbody(plan_row(row), hx_swap_oob=where)))
+    if not session[utils.Skey.PLANOK]:
+        mess = {"error":"plan_not_ok"}
+    return (*swaps, line_feedback(mess))
+
+def line_feedback(mess):
+    return Div(messages.feedback_to_user(mess), hx_swap_oob="true", id="line-feedback")
+
+def plan_with_row_ids(center):
+    plan = minio.get_center_temp_list_of_dicts(center, "planning")
+    if not all(pd.notna(row.get("row_id")) for row in plan):
+        return None
+    for row in plan:
+        row["row_id"] = int(row["row_id"])
+    return plan
+
 # @rt('/planning/delete_line')
-async def delete_line(session, index):
+async def delete_line(session, row_id):
     selected_name = session[utils.Skey.CENTER]
-    plan = minio.get_center_temp_list_of_dicts(selected_name, "planning")
+    plan = plan_with_row_ids(selected_name)
+    if plan is None:
+        return line_feedback({"error": "plan_not_saved"})
+    old_ids = {row["row_id"] for row in plan}
+    index = next((i for i, row in enumerate(plan) if row["row_id"] == row_id), None)
     print(f"Deleting line {index} from draft plan with {len(plan)} entries")
-    if 0 <= index < len(plan):
-        plan.pop(index)
-    return await check_save_show_plan(session, plan, {"success": "line_deleted"})
+    if index is None:
+        return line_feedback({"error": "plan_not_saved"})
+    plan.pop(index)
+    # the rows before and after the deleted one are now neighbours
+    return await update_plan_rows(session, plan, old_ids, max(index - 1, 0), index + 1,
+                                  {"success": "line_deleted"})
 
 #@rt('/planning/add_line')
 async def add_line(session, ptype, start):
     selected_name = session[utils.Skey.CENTER]
-    plan = minio.get_center_temp_list_of_dicts(selected_name, "planning")
+    plan = plan_with_row_ids(selected_name)
+    if plan is None:
+        return line_feedback({"error": "plan_not_saved"})
+    old_ids = {row["row_id"] for row in plan}
     # Create new plan line with user input
     new_line = {
         "start_date": start,
@@ -176,12 +261,12 @@ async def add_line(session, ptype, start):
         "course_type": "",
         "No_gong": ""
     }    
-    # Add the new line to the plan
-    plan.append(new_line)
-    # Sort plan by start_date
-    plansor = sorted(plan, key=lambda x: x['start_date'])
-    plancomp = plancheck.add_end_dates(plansor, selected_name)
-    return await check_save_show_plan(session, plancomp, {"success" : "new_course"})
+    # Insert the new line after the lines starting the same day or before
+    index = sum(1 for row in plan if row["start_date"] <= start)
+    plan.insert(index, new_line)
+    plancheck.add_end_dates(plan[index:index + 2], selected_name)
+    return await update_plan_rows(session, plan, old_ids, max(index - 1, 0), index + 2,
+                                  {"success" : "new_course"})
 # ~/~ end
 # ~/~ begin <<docs/gong-web-app-code/gong-planning.md#planning-page>>[init]
 
@@ -210,6 +295,9 @@ async def planning_page(session, selected_name, csms):
             Button("(re)Start getting plans",
                 hx_get="/planning/load_dhamma_db",
                 hx_target="#planning-periods"),
+            Button("refresh from dhamma.org",
+                hx_get="/planning/load_dhamma_db?refresh=1",
+                hx_target="#planning-periods"),
             Span(style="display: inline-block; width: 20px;"),
             Button("Load saved plan",
                 hx_get="/planning/saved_plan",
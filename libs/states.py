@@ -2,17 +2,17 @@
 
 from abc import ABC
 from abc import abstractmethod
+import time
+import heapq
 import asyncio
 from fasthtml.common import *
 from datetime import datetime, timezone
 from statemachine import State, Event, StateChart
 from statemachine.orderedset import OrderedSet
 import libs.transit as transit
+import libs.minio as minio
 import libs.utils as utils
 
-csms = {}
-clocks = {}
-
 # ~/~ begin <<docs/gong-web-app-code/states-machine.md#state-machine>>[init]
 
 class HistoryListener:
@@ -104,6 +104,9 @@ def status_to_stri(status):
     else:
         return str(status)
 
+def row_fields(row):
+    return row if isinstance(row, dict) else row.__dict__
+
 def stri_to_status(strin):
     if strin is None:
         return None
@@ -123,45 +126,67 @@ class CenterDataModel(AbstractPersistentModel):
         self.pi_db_date = None  # confirmed production version date
         self.send_id = None # id of the delayed send for waiting states, to be able to cancel it if needed
         self.last_result = None   # result of the last operation on this machine
+        self.save_progress = None # (steps done, steps in all, step name) of the running db save
+        self.row_read_at = None # time.monotonic() of the last read of the center row
+        self.pending = {} # center row fields changed and not yet written
+        self.in_transition = False # True between before_transition and after_transition: writes are buffered
+
+    ROW_FIELDS = ("created_by", "status_start", "save_db_filename", "center_save_date", "pi_db_date")
+
+    def load_row(self, row=None, read_at=None):
+        # row already read by the caller (startup), else read now
+        if row is None:
+            row = self.db.t.center[self.center_name]
+        fields = row_fields(row)
+        for field in self.ROW_FIELDS:
+            setattr(self, field, fields[field])
+        self.row_read_at = read_at or time.monotonic()
+        return fields
 
     def _read_state(self):
-        centers = self.db.t.center
-        row = centers[self.center_name]
-        self.status_start = row.status_start
-        self.created_by = row.created_by
-        self.pi_db_date = row.pi_db_date
-        self.center_save_date = row.center_save_date
-        self.save_db_filename = row.save_db_filename
-        return stri_to_status(row.status)
+        return stri_to_status(self.load_row()["status"])
 
     def _write_state(self, value):
         now_utc = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S+00:00')
         self.status_start = now_utc
-        value_stri = status_to_stri(value)
-        centers = self.db.t.center
-        centers.update(
-            center_name = self.center_name, 
-            status = value_stri,
-            status_start = self.status_start
-        )
+        self.write_fields(status=status_to_stri(value), status_start=now_utc)
+        return
+
+    def write_fields(self, **fields):
+        self.pending.update(fields)
+        if not self.in_transition:
+            self.flush()
+        return
+
+    def flush(self):
+        if self.pending:
+            self.db.t.center.update(center_name=self.center_name, **self.pending)
+            self.pending = {}
+            self.row_read_at = time.monotonic()
         return
 
     def update_attr(self, attr_name, value):
         setattr(self, attr_name, value)
-        centers = self.db.t.center
-        center_obj = centers[self.center_name]
-        row_dict = center_obj.__dict__
-        row_dict[attr_name] = value
-        centers.update(row_dict)
+        self.write_fields(**{attr_name: value})
         return
 
     def get_center_attr(self, attr_name):
-        if getattr(self, attr_name) is None:
-            centers = self.db.t.center
-            center_obj = centers[self.center_name]
-            setattr(self, attr_name, getattr(center_obj, attr_name))
+        # buffered changes are newer than the db: no read back before they are written
+        stale = self.row_read_at is None or time.monotonic() - self.row_read_at > utils.Globals.CENTER_ROW_TTL
+        if stale and not self.pending:
+            self.load_row()
         return getattr(self, attr_name)
 
+    def before_transition(self):
+        self.flush()   # left by a transition that failed before its end
+        self.in_transition = True
+        return
+
+    def after_transition(self):
+        self.in_transition = False
+        self.flush()
+        return
+
     def get_admin_planners(self):
         planners = self.db.t.planner
         users = self.db.t.user
@@ -174,10 +199,17 @@ class CenterDataModel(AbstractPersistentModel):
         self.state_mach = machine
         return
 
+    def report_save_progress(self, done, total, step):
+        # called on the event loop by the worker building the new db
+        self.save_progress = (done, total, step)
+        return
+
     async def go_next(self, result, delai=1, sendid = None):
         self.last_result = result
-        if "success" in result:
-            await self.state_mach.send("progress", delay=delai, send_id=sendid)
+        if "success" in result and sendid:
+            scheduler.schedule(self.center_name, "progress", delai, sendid)
+        elif "success" in result:
+            await self.state_mach.send("progress", delay=delai)
         else:
             await self.state_mach.send("problem")
         return
@@ -185,12 +217,18 @@ class CenterDataModel(AbstractPersistentModel):
     async def on_enter_free(self):
         self.last_result = {"success": "center is free again"}
         self.update_attr("created_by", None)
+        minio.evict_temp_center_data(self.center_name)
         return
 
     async def on_enter_edit(self):
         self.last_result = {"success": "entered edit mode"}
         return
 
+    async def on_exit_edit(self):
+        # write the in-memory edit session back to the temp parquet files
+        await asyncio.to_thread(minio.flush_temp_center_data, self.center_name)
+        return
+
     async def on_enter_save_db(self):
         result = await transit.save_db_plan_times(self)
         return await self.go_next(result)
@@ -203,7 +241,7 @@ class CenterDataModel(AbstractPersistentModel):
     async def on_exit_wait_01(self):
         if self.send_id:
             print("Canceling delayed event ", self.send_id)
-            self.state_mach.cancel_event(self.send_id)
+            scheduler.cancel(self.send_id)
         return
 
     async def on_enter_transfer(self):
@@ -218,7 +256,7 @@ class CenterDataModel(AbstractPersistentModel):
     async def on_exit_wait_02(self):
         if self.send_id:
             print("Canceling delayed event ", self.send_id)
-            self.state_mach.cancel_event(self.send_id)
+            scheduler.cancel(self.send_id)
         return
 
     async def on_enter_getting_prod(self):
@@ -237,24 +275,129 @@ class CenterDataModel(AbstractPersistentModel):
 # ~/~ end
 # ~/~ begin <<docs/gong-web-app-code/states-machine.md#create-centers-sms>>[init]
 
+class CenterMachines(dict):
+    def __init__(self):
+        super().__init__()
+        self.db = None
+        self.rows = {}    # center rows read at startup, for the machines not built yet
+        self.rows_read_at = None
+
+    def __missing__(self, center_name):
+        if center_name not in self.rows:
+            raise KeyError(center_name)
+        row = self.rows.pop(center_name)
+        if time.monotonic() - self.rows_read_at > utils.Globals.CENTER_ROW_TTL:
+            row = None
+        return build_center_state_machine(center_name, self.db, row, self.rows_read_at)
+
+class CenterLocks(dict):
+    def __missing__(self, center_name):
+        return self.setdefault(center_name, asyncio.Lock())
+
 def delete_state_machine(center_name):
-    del csms[center_name]
-    del clocks[center_name]
+    csms.pop(center_name, None)
+    csms.rows.pop(center_name, None)
+    clocks.pop(center_name, None)
 
-def add_center_state_machine(name, db):
+def build_center_state_machine(name, db, row=None, read_at=None):
     center_state = CenterDataModel(center_name=name, db=db)
+    if row is not None:
+        center_state._state = stri_to_status(center_state.load_row(row, read_at)["status"])
     sm = CenterState(model=center_state)
     center_state.add_machine(sm)
     the_listener = HistoryListener(model=center_state)
     sm.add_listener(the_listener)
     csms[name] = sm
-    clocks[name] = asyncio.Lock()
+    return sm
+
+def add_center_state_machine(name, db):
+    build_center_state_machine(name, db)
 
 def init_center_state_machines(db):
-    centers_list = db.t.center()
-    names = [c.center_name for c in centers_list]
-    for name in names:
-        add_center_state_machine(name, db)
+    csms.clear()
+    csms.db = db
+    csms.rows_read_at = time.monotonic()
+    csms.rows = {row_fields(row)["center_name"]: row for row in db.t.center()}
 
 # ~/~ end
+# ~/~ begin <<docs/gong-web-app-code/states-machine.md#event-scheduler>>[init]
+
+def utc_stamp(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S+00:00')
+
+class EventScheduler:
+    def __init__(self):
+        self.db = None
+        self.heap = []    # (due time as a timestamp, send_id)
+        self.events = {}  # send_id: (due time, center_name, event), for the events not sent nor cancelled
+        self.wakeup = None
+        self.task = None
+        self.sending = set()  # tasks of the events being sent
+
+    async def start(self, db):
+        # awaited at server startup: an async startup function runs on the event loop
+        self.db = db
+        self.heap, self.events = [], {}
+        for row in db.t.scheduled_event():
+            fields = row_fields(row)
+            due = datetime.fromisoformat(fields["due_at"]).timestamp()
+            self.push(fields["send_id"], due, fields["center_name"], fields["event"])
+        print(f"Scheduler re-armed with {len(self.events)} delayed events")
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def push(self, send_id, due, center_name, event):
+        self.events[send_id] = (due, center_name, event)
+        heapq.heappush(self.heap, (due, send_id))
+
+    def schedule(self, center_name, event, delay, send_id):
+        # delay in milliseconds, as for StateChart.send
+        due = time.time() + delay / 1000
+        self.db.t.scheduled_event.upsert(dict(send_id=send_id, center_name=center_name,
+                                              event=event, due_at=utc_stamp(due)))
+        self.push(send_id, due, center_name, event)
+        if self.wakeup:
+            self.wakeup.set()
+
+    def cancel(self, send_id):
+        # also called when the waiting state is left on its own event: the event is delivered
+        self.events.pop(send_id, None)
+        self.db.t.scheduled_event.delete_where("send_id = ?", [send_id])
+
+    def pop_due(self, now):
+        due_events = []
+        while self.heap and self.heap[0][0] <= now:
+            due, send_id = heapq.heappop(self.heap)
+            if send_id in self.events and self.events[send_id][0] == due:   # else cancelled or scheduled again
+                due_events.append((send_id, *self.events.pop(send_id)[1:]))
+        return due_events
+
+    async def run(self):
+        while True:
+            while self.heap and self.heap[0][1] not in self.events:
+                heapq.heappop(self.heap)
+            timeout = max(self.heap[0][0] - time.time(), 0) if self.heap else None
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except TimeoutError:
+                pass
+            for send_id, center_name, event in self.pop_due(time.time()):
+                task = asyncio.create_task(self.send(send_id, center_name, event))
+                self.sending.add(task)
+                task.add_done_callback(self.sending.discard)
+
+    async def send(self, send_id, center_name, event):
+        try:
+            await csms[center_name].send(event)
+        except Exception as e:   # center deleted or transition failing: sending it again would fail too
+            print(f"Delayed event {send_id} failed: {e}")
+        if send_id not in self.events:   # else scheduled again meanwhile
+            self.db.t.scheduled_event.delete_where("send_id = ?", [send_id])
+
+# ~/~ end
+
+csms = CenterMachines()
+clocks = CenterLocks()
+scheduler = EventScheduler()
 # ~/~ end
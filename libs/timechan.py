@@ -1,5 +1,7 @@
 # ~/~ begin <<docs/gong-web-app-code/gong-timings-chan.md#libs/timechan.py>>[init]
 
+import csv
+import re
 import pandas as pd
 from fasthtml.common import *
 from fastlite import database
@@ -10,6 +12,26 @@ import libs.minio as minio
 import libs.timings as timings
 import libs.messages as messages
 
+# ~/~ begin <<docs/gong-web-app-code/gong-timings-chan.md#journal-changes>>[init]
+
+def delete_change(rows_df, df_name):
+    keys = minio.TEMP_KEYS[df_name]
+    return {"op": "delete", "keys": rows_df[keys].values.tolist()}
+
+def upsert_change(rows_df):
+    return {"op": "upsert", "rows": rows_df.to_dict(orient="records")}
+
+def change_timings(center, df_name, changes):
+    with minio.temp_lock:
+        validator = timings.timings_validators.get(center)
+        in_step = validator is not None and validator.versions[df_name] == minio.temp_version(center, df_name)
+        df = minio.change_center_temp(center, df_name, changes)
+        if in_step:
+            validator.apply(df_name, changes)
+            validator.versions[df_name] = minio.temp_version(center, df_name)
+    return df
+
+# ~/~ end
 # ~/~ begin <<docs/gong-web-app-code/gong-timings-chan.md#repaint-timings>>[init]
 
 def repaint(session, period_type, day_type, message, clear_show_times):
@@ -37,32 +59,34 @@ def repaint(session, period_type, day_type, message, clear_show_times):
 # @rt('/timings/delete_timetable_row')
 def delete_timetable_row(session, idx):
     center = session[utils.Skey.CENTER]
-    timetables_df = minio.get_center_temp_df(center, "timetables")
-    period_type = timetables_df.loc[int(idx), "period_type"]
-    day_type = timetables_df.loc[int(idx), "day_type"]
-    filtered_timings = timetables_df[(timetables_df["period_type"] == period_type) &
-                             (timetables_df["day_type"] == day_type)]
-    periods_struct_df = minio.get_center_temp_df(center, "periods_struct")
-    filtered_struct = periods_struct_df[(periods_struct_df["period_type"] == period_type) &
-                                       (periods_struct_df["day_type"] == day_type)]
+    idx = int(idx)
+    timetable_row = minio.get_center_temp_row(center, "timetables", idx)
+    if timetable_row is None:
+        return repaint(session, None, None, {"error": "row_not_found"}, False)
+    period_type = timetable_row.at[idx, "period_type"]
+    day_type = timetable_row.at[idx, "day_type"]
+    filtered_timings = minio.get_center_temp_rows(center, "timetables", period_type, day_type)
+    period_struct = minio.get_center_temp_rows(center, "periods_struct", period_type)
+    filtered_struct = period_struct[period_struct["day_type"] == day_type]
     if len(filtered_timings) == 1 and len(filtered_struct) >= 1:
         message = {"error": "delete_last_time"}
     else:
-        time = timetables_df.loc[int(idx), "time"]    
-        new_timetable = timetables_df.drop(index=int(idx)).reset_index(drop=True)
+        time = timetable_row.at[idx, "time"]
         message = {"success": "time_deleted", 'time': time}
-        minio.save_df_center_temp(center, "timetables", new_timetable)
+        change_timings(center, "timetables", [delete_change(timetable_row, "timetables")])
     return repaint(session, period_type, day_type, message, False)
 
 # @rt('/timings/load_timing_form')
 def load_timing_form(session, idx):
     """Load and display a pre-populated timetable form for modifying an existing entry"""
     center = session[utils.Skey.CENTER]
-    timetables_df = minio.get_center_temp_df(center, "timetables")
+    timetable_row = minio.get_center_temp_row(center, "timetables", int(idx))
+    if timetable_row is None:
+        return Div(messages.feedback_to_user({"error": "row_not_found"}))
     gongs_df = minio.get_center_temp_df(center, "gongs")
     targets_df = minio.get_center_temp_df(center, "targets")
 
-    row = timetables_df.loc[int(idx)]
+    row = timetable_row.iloc[0]
     period_type = row["period_type"]
     day_type = row["day_type"]
     time_value = row["time"]
@@ -117,32 +141,84 @@ def add_mod_timetable_row(session, period_type, day_type, idx, time, gong_id, au
         "targets": " ".join(sorted(targets)),
         "comment": comment
     }
-    timetables_df_bef = minio.get_center_temp_df(center, "timetables")
     if idx != -1:
-        old_data = timetables_df_bef.loc[int(idx)].to_dict()
-        old_time = old_data["time"]
+        old_row = minio.get_center_temp_row(center, "timetables", int(idx))
+        if old_row is None:
+            return repaint(session, None, None, {"error": "row_not_found"}, False)
+        old_time = old_row.at[int(idx), "time"]
     else:
         old_time = "00:00" # Default old time for forced new entries
-    indexs_new_data = timetables_df_bef[(timetables_df_bef["period_type"] == period_type) &
-                                     (timetables_df_bef["day_type"] == day_type) &
-                                     (timetables_df_bef["time"] == time)].index
+    indexs_new_data = minio.get_center_temp_rows(center, "timetables", period_type, day_type, time).index
     index_new_data = indexs_new_data[0] if len(indexs_new_data) > 0 else None
 
-    if index_new_data and new_data["time"] != old_time:
+    if index_new_data is not None and new_data["time"] != old_time:
         # This is a modification that changes the time to an existing time (conflict)
         message = {"error": "time_already_exists", 'time': time}
     else:
-        if index_new_data and new_data["time"] == old_time:
-            # This is a modification of the same entry (time unchanged)
-            timetables_df = timetables_df_bef.drop(index=int(idx)).reset_index(drop=True)
+        if index_new_data is not None and new_data["time"] == old_time:
+            # This is a modification of the same entry (time unchanged): replaced by the upsert
             message = {"success": "time_modified", 'time': time}
         else:
             # This is an insertion of a new time (no conflict)
-            timetables_df = timetables_df_bef
             message = {"success": "time_inserted", 'time': time}
-        timetables_df = pd.concat([timetables_df, pd.DataFrame([new_data])], ignore_index=True)
-        timetables_df = timetables_df.sort_values(by=["period_type", "day_type", "time"]).reset_index(drop=True)
-        minio.save_df_center_temp(center, "timetables", timetables_df)
+        change_timings(center, "timetables", [{"op": "upsert", "rows": [new_data]}])
+    return repaint(session, period_type, day_type, message, False)
+
+# ~/~ end
+# ~/~ begin <<docs/gong-web-app-code/gong-timings-chan.md#batch-timetable>>[init]
+
+TIME_FORMAT = re.compile(r"([01][0-9]|2[0-3]):[0-5][0-9]")
+
+def parse_timings_csv(period_type, day_type, timings_csv):
+    # the rows of the CSV lines, or the error message of the first invalid line
+    rows = {}
+    reader = csv.DictReader(timings_csv.strip().splitlines())
+    if reader.fieldnames is None or not {"time", "gong_id"} <= set(reader.fieldnames):
+        return None, {"error": "batch_line_invalid", "line": 1, "reason": "header must name time and gong_id"}
+    for line, record in enumerate(reader, start=2):
+        time = (record.get("time") or "").strip()
+        gong_id = (record.get("gong_id") or "").strip()
+        auto = (record.get("auto") or "0").strip()
+        if not TIME_FORMAT.fullmatch(time):
+            reason = f"time '{time}' is not HH:MM"
+        elif not gong_id.isdigit():
+            reason = f"gong_id '{gong_id}' is not a number"
+        elif auto not in ("0", "1"):
+            reason = f"auto '{auto}' is not 0 or 1"
+        elif time in rows:
+            reason = f"time {time} is already on another line"
+        else:
+            rows[time] = {"period_type": period_type, "day_type": day_type, "time": time,
+                          "gong_id": int(gong_id), "auto": int(auto),
+                          "targets": " ".join(sorted((record.get("targets") or "").split())),
+                          "comment": record.get("comment") or ""}
+            continue
+        return None, {"error": "batch_line_invalid", "line": line, "reason": reason}
+    return rows, None
+
+# @rt('/timings/batch_timetable')
+def batch_timetable(session, period_type, day_type, timings_csv):
+    center = session[utils.Skey.CENTER]
+    rows, message = parse_timings_csv(period_type, day_type, timings_csv)
+    if message:
+        return repaint(session, period_type, day_type, message, False)
+    current = {row["time"]: {k: ("" if pd.isna(v) else v) for k, v in row.items()}
+               for row in minio.get_center_temp_rows(center, "timetables", period_type, day_type)
+                   .to_dict(orient="records")}
+    deleted = [[period_type, day_type, time] for time in current if time not in rows]
+    upserted = [row for time, row in rows.items() if current.get(time) != row]
+    period_struct = minio.get_center_temp_rows(center, "periods_struct", period_type)
+    if not rows and (period_struct["day_type"] == day_type).any():
+        message = {"error": "delete_last_time"}
+    elif not deleted and not upserted:
+        message = {"error": "timings_unchanged"}
+    else:
+        changes = [{"op": "delete", "keys": deleted}] if deleted else []
+        changes += [{"op": "upsert", "rows": upserted}] if upserted else []
+        change_timings(center, "timetables", changes)
+        inserted = sum(time not in current for time in rows)
+        message = {"success": "times_batch_changed", "inserted": inserted,
+                   "modified": len(upserted) - inserted, "deleted": len(deleted)}
     return repaint(session, period_type, day_type, message, False)
 
 # ~/~ end
@@ -151,46 +227,46 @@ def add_mod_timetable_row(session, period_type, day_type, idx, time, gong_id, au
 # @rt('/timings/modify_day_type')
 def modify_day_type(session, index, day_type):
     center = session[utils.Skey.CENTER]
-    periods_struct_df = minio.get_center_temp_df(center, "periods_struct")
-    period_type = periods_struct_df.loc[index, "period_type"]
-    old_day_type = periods_struct_df.loc[index, "day_type"]
+    struct_row = minio.get_center_temp_row(center, "periods_struct", index)
+    if struct_row is None:
+        return repaint(session, None, None, {"error": "row_not_found"}, False)
+    period_type = struct_row.at[index, "period_type"]
+    old_day_type = struct_row.at[index, "day_type"]
     if old_day_type == day_type:
         message = {"error": "day_type_unchanged"}
     else:
         message = {"success": "day_type_changed"}
-        periods_struct_df.loc[index, "day_type"] = day_type
-        minio.save_df_center_temp(center, "periods_struct", periods_struct_df)
+        struct_row.at[index, "day_type"] = day_type
+        change_timings(center, "periods_struct", [upsert_change(struct_row)])
     return repaint(session, period_type, None, message, False)
 
 # @rt('/timings/del_last_day')
 def del_last_day(session, idx):
     center = session[utils.Skey.CENTER]
-    periods_struct_df = minio.get_center_temp_df(center, "periods_struct")
-    period_type = periods_struct_df.loc[idx, "period_type"]
-    day_type = periods_struct_df.loc[idx, "day_type"]
-    filtered_struct = periods_struct_df[(periods_struct_df["period_type"] == period_type) &
-                                       (periods_struct_df["day_type"] == day_type)]
+    struct_row = minio.get_center_temp_row(center, "periods_struct", idx)
+    if struct_row is None:
+        return repaint(session, None, None, {"error": "row_not_found"}, False)
+    period_type = struct_row.at[idx, "period_type"]
+    day_type = struct_row.at[idx, "day_type"]
+    period_struct = minio.get_center_temp_rows(center, "periods_struct", period_type)
+    filtered_struct = period_struct[period_struct["day_type"] == day_type]
     if len(filtered_struct) == 1:
         message = {"error": "delete_last_day"}
     else:
-        periods_struct_df = periods_struct_df.drop(index=int(idx)).reset_index(drop=True)
         message = {"success": "last_day_deleted"}
-        minio.save_df_center_temp(center, "periods_struct", periods_struct_df)
+        change_timings(center, "periods_struct", [delete_change(struct_row, "periods_struct")])
     return repaint(session, period_type, None, message, False)
 
 # @rt('/timings/dup_last_day')
 def dup_last_day(session, idx):
     center = session[utils.Skey.CENTER]
-    periods_struct_df = minio.get_center_temp_df(center, "periods_struct")
-    period_type = periods_struct_df.loc[idx, "period_type"]
-    row = periods_struct_df.loc[[idx]]
-    day = periods_struct_df.loc[idx, "day"]
-    periods_struct_df = pd.concat([periods_struct_df.iloc[:idx+1], row,
-                                   periods_struct_df.iloc[idx+1:]])
-    periods_struct_df = periods_struct_df.reset_index(drop=True)
-    periods_struct_df.loc[idx+1, "day"] = day + 1
+    row = minio.get_center_temp_row(center, "periods_struct", idx)
+    if row is None:
+        return repaint(session, None, None, {"error": "row_not_found"}, False)
+    period_type = row.at[idx, "period_type"]
+    row["day"] = row["day"] + 1
     message = {"success": "last_day_duplicated"}
-    minio.save_df_center_temp(center, "periods_struct", periods_struct_df)
+    change_timings(center, "periods_struct", [upsert_change(row)])
     return repaint(session, period_type, None, message, False)
 
 def renumber_days_df(periods_struct_df, period_type):
@@ -202,28 +278,25 @@ def renumber_days_df(periods_struct_df, period_type):
 # @rt('/timings/renumber_days')
 def renumber_days(session, period_type):
     center = session[utils.Skey.CENTER]
-    periods_struct_df = minio.get_center_temp_df(center, "periods_struct")
-    filtered = periods_struct_df[periods_struct_df["period_type"] == period_type] 
+    filtered = minio.get_center_temp_rows(center, "periods_struct", period_type)
     period_type = filtered.iloc[-1]["period_type"]
-    periods_struct_df = renumber_days_df(periods_struct_df, period_type)
+    renumbered = renumber_days_df(filtered.copy(), period_type)
     message = {"success": "days_renumbered"}
-    minio.save_df_center_temp(center, "periods_struct", periods_struct_df)
+    change_timings(center, "periods_struct",
+                   [delete_change(filtered, "periods_struct"), upsert_change(renumbered)])
     return repaint(session, period_type, None, message, False)
 
 # @rt('/timings/create_day_type')
 def create_day_type(session, period_type, new_day_type, day_type):
     center = session[utils.Skey.CENTER]
-    timetables_df_bef = minio.get_center_temp_df(center, "timetables")
-    all_day_types = timetables_df_bef[timetables_df_bef["period_type"] == period_type]['day_type'].unique()
+    period_timetables = minio.get_center_temp_rows(center, "timetables", period_type)
+    all_day_types = list(period_timetables['day_type'].unique())
     if new_day_type in all_day_types:
         message = {"error": "day_type_already_exists"}
     else:
-        filtered = timetables_df_bef[(timetables_df_bef["period_type"] == period_type) &
-                                     (timetables_df_bef["day_type"] == day_type)]
+        filtered = period_timetables[period_timetables["day_type"] == day_type].copy()
         filtered["day_type"] = new_day_type
-        timetables_df = pd.concat([timetables_df_bef, filtered], ignore_index=True)
-        timetables_df = timetables_df.sort_values(by=["period_type", "day_type", "time"]).reset_index(drop=True)
-        minio.save_df_center_temp(center, "timetables", timetables_df)
+        change_timings(center, "timetables", [upsert_change(filtered)])
         message = {"success": "day_type_created"}   
     return repaint(session, period_type, new_day_type, message, False)
 
@@ -236,12 +309,9 @@ def delete_period(session, period_type):
     center_periods_df = minio.get_center_temp_df(center, "center_periods")
     center_periods_df = center_periods_df[center_periods_df["period_type"] != period_type].reset_index(drop=True)
     minio.save_df_center_temp(center, "center_periods", center_periods_df)
-    center_struct_df = minio.get_center_temp_df(center, "periods_struct")
-    center_struct_df = center_struct_df[center_struct_df["period_type"] != period_type].reset_index(drop=True)
-    minio.save_df_center_temp(center, "periods_struct", center_struct_df)
-    center_timetables_df = minio.get_center_temp_df(center, "timetables")
-    center_timetables_df = center_timetables_df[center_timetables_df["period_type"] != period_type].reset_index(drop=True)
-    minio.save_df_center_temp(center, "timetables", center_timetables_df)
+    for df_name in ["periods_struct", "timetables"]:
+        period_rows = minio.get_center_temp_rows(center, df_name, period_type)
+        change_timings(center, df_name, [delete_change(period_rows, df_name)])
     message = {"success": "period_deleted"}
     return repaint(session, None, None, message, False)
 
@@ -263,23 +333,17 @@ def create_new_period(session, from_center, new_period, from_period):
         db_from_center = database(utils.get_db_path() + from_selected_db)
 
         from_center_struct_df = pd.DataFrame(list(db_from_center.t.periods_struct()))
-        this_center_struct_df = minio.get_center_temp_df(this_center, "periods_struct")
         new_rows = from_center_struct_df[from_center_struct_df["period_type"] == from_period].copy()
         new_rows["period_type"] = new_period
-        this_center_struct_df = pd.concat([this_center_struct_df, new_rows], ignore_index=True)
-        this_center_struct_df = this_center_struct_df.sort_values(by=["period_type", "day"]).reset_index(drop=True)
-        minio.save_df_center_temp(this_center, "periods_struct", this_center_struct_df)
+        change_timings(this_center, "periods_struct", [upsert_change(new_rows)])
 
         from_center_timetables_df = pd.DataFrame(list(db_from_center.t.timetables()))
-        this_center_timetables_df = minio.get_center_temp_df(this_center, "timetables")
         new_rows = from_center_timetables_df[from_center_timetables_df["period_type"] == from_period].copy()
         new_rows["period_type"] = new_period
         params = minio.params_from_excel(this_center)
         new_rows["gong_id"] = params[utils.Pkey.GONG_ID]
         new_rows["targets"] = params[utils.Pkey.TARGETS]
-        this_center_timetables_df = pd.concat([this_center_timetables_df, new_rows], ignore_index=True)
-        this_center_timetables_df = this_center_timetables_df.sort_values(by=["period_type", "day_type", "time"]).reset_index(drop=True)
-        minio.save_df_center_temp(this_center, "timetables", this_center_timetables_df)
+        change_timings(this_center, "timetables", [upsert_change(new_rows)])
 
         db_from_center.close()
         message = {"success": "period_created"}
@@ -137,20 +137,32 @@ def get_other_center_periods(session, center):
 # ~/~ end
 # ~/~ begin <<docs/gong-web-app-code/gong-timings.md#show-struct-timetable>>[init]
 
-# @rt('/timings/select_period')
-def select_period(session, period_type, clear_show_times=True):
-    center = session[utils.Skey.CENTER]
-    center_periods_df = minio.get_center_temp_df(center, "center_periods")
-    tags = center_periods_df.loc[center_periods_df["period_type"] == period_type, "tags"].iat[0]
-    periods_struct_df = minio.get_center_temp_df(center, "periods_struct")
-    timetables_df = minio.get_center_temp_df(center, "timetables")
-    day_types = timetables_df[timetables_df["period_type"] == period_type]['day_type'].unique()
-    periods_struct_df["Actions"] = periods_struct_df.index.to_series().apply(
+fragments_cache = {}  # {(center, period_type, day_type): (table versions, rendered table)}
+TIMINGS_CSV_COLUMNS = ["time", "gong_id", "auto", "targets", "comment"]
+
+def cached_fragment(center, period_type, day_type, df_names, render, tags=None):
+    versions = tuple(minio.temp_version(center, df_name) for df_name in df_names) + (tags,)
+    cached = fragments_cache.get((center, period_type, day_type))
+    if cached is None or cached[0] != versions:
+        cached = (versions, render())
+        fragments_cache[(center, period_type, day_type)] = cached
+    return cached[1]
+
+def evict_fragments(center):
+    for key in [key for key in fragments_cache if key[0] == center]:
+        del fragments_cache[key]
+
+minio.temp_evict_callbacks.append(evict_fragments)
+
+def struct_fragment(center, period_type, tags):
+    day_types = minio.get_center_temp_rows(center, "timetables", period_type)["day_type"].unique()
+    filtered = minio.get_center_temp_rows(center, "periods_struct", period_type)
+    filtered["Actions"] = filtered.index.to_series().apply(
         lambda idx: Div(
             A("Detail timings",
                 hx_get= ("/timings/select_timings"
                         f"?period_type={quote_plus(period_type)}"
-                        f"&day_type={quote_plus(periods_struct_df.at[idx,'day_type'])}"),
+                        f"&day_type={quote_plus(filtered.at[idx,'day_type'])}"),
                 hx_target="#feedback-times"),   # was: show-times 
                 Span(style="display: inline-block; width: 50px;"),
             Form(
@@ -170,9 +182,17 @@ def select_period(session, period_type, clear_show_times=True):
             #style="display: inline-flex; align-items: center; gap: 50px;"
         )
     )
-    filtered = periods_struct_df[periods_struct_df["period_type"] == period_type]
-    last_idx = filtered.index[-1]
-    html_struct = filtered.to_html(index=False, escape=False)
+    return list(day_types), filtered.index[-1], filtered.to_html(index=False, escape=False)
+
+# @rt('/timings/select_period')
+def select_period(session, period_type, clear_show_times=True):
+    center = session[utils.Skey.CENTER]
+    # center_periods is saved again at each repaint: its tag is part of the cache check, not its version
+    center_periods_df = minio.get_center_temp_df(center, "center_periods")
+    tags = center_periods_df.loc[center_periods_df["period_type"] == period_type, "tags"].iat[0]
+    day_types, last_idx, html_struct = cached_fragment(
+        center, period_type, None, ["periods_struct", "timetables"],
+        lambda: struct_fragment(center, period_type, tags), tags)
     return Div(
         Div(messages.feedback_to_user({})),
         Div("",hx_swap_oob="true",id="show-times") if clear_show_times else None,
@@ -217,11 +237,9 @@ def select_period(session, period_type, clear_show_times=True):
         )
     )
 
-# @rt('/timings/select_timings')
-def select_timings(session, period_type, day_type):
-    center = session[utils.Skey.CENTER]
-    timetables_df = minio.get_center_temp_df(center, "timetables")
-    timetables_df["Actions"] = timetables_df.index.to_series().apply(
+def timetable_fragment(center, period_type, day_type):
+    filtered = minio.get_center_temp_rows(center, "timetables", period_type, day_type)
+    filtered["Actions"] = filtered.index.to_series().apply(
         lambda idx: Div(
             A("Delete",
                 hx_get=f"/timings/delete_timetable_row?idx={idx}",
@@ -234,19 +252,144 @@ def select_timings(session, period_type, day_type):
             style="display: inline-flex; align-items: center; gap: 25px;"
         )
     )
-    filtered = timetables_df[
-        (timetables_df["period_type"] == period_type) &
-        (timetables_df["day_type"] == day_type)]
-    html_timetables = filtered.fillna("").to_html(index=False, escape=False)
+    timings_csv = filtered[TIMINGS_CSV_COLUMNS].fillna("").to_csv(index=False)
+    return filtered.fillna("").to_html(index=False, escape=False), timings_csv
+
+# @rt('/timings/select_timings')
+def select_timings(session, period_type, day_type):
+    center = session[utils.Skey.CENTER]
+    html_timetables, timings_csv = cached_fragment(
+        center, period_type, day_type, ["timetables"],
+        lambda: timetable_fragment(center, period_type, day_type))
     return Div(
         Div(messages.feedback_to_user({})),
         Div(
             H3(f"Timetable for day type: '{day_type}' in period type: '{period_type}'"),
             Safe(html_timetables),
+            Details(
+                Summary("Edit all the timings of this day type at once"),
+                Form(
+                    Input(type="hidden", name="period_type", value=period_type),
+                    Input(type="hidden", name="day_type", value=day_type),
+                    Textarea(timings_csv, name="timings_csv", rows=12),
+                    Button("Replace the timings of this day type", type="submit"),
+                    hx_post="/timings/batch_timetable",
+                    hx_target="#feedback-times",
+                )
+            ),
             hx_swap_oob="true", id="show-times"
         )
     )
 
+# ~/~ end
+# ~/~ begin <<docs/gong-web-app-code/gong-timings.md#timings-validator>>[init]
+
+TIMING_ERROR_COLUMNS = ["period_type", "error", "day_type", "time", "gong_id", "targets"]
+VALIDATED_TABLES = ["periods_struct", "gongs", "targets", "timetables"]
+
+timings_validators = {}  # {center: TimingsValidator} of the edit session tables
+
+class TimingsValidator:
+    def __init__(self, center):
+        self.center = center
+        self.versions = {df_name: minio.temp_version(center, df_name) for df_name in VALIDATED_TABLES}
+        self.gong_ids = {row["id"] for row in minio.get_center_temp_list_of_dicts(center, "gongs")}
+        self.target_names = {row["shortname"] for row in minio.get_center_temp_list_of_dicts(center, "targets")}
+        self.rows = {"periods_struct": {}, "timetables": {}}  # {df_name: {period_type: {key: [rows]}}}
+        for df_name in self.rows:
+            self.add_rows(df_name, minio.get_center_temp_list_of_dicts(center, df_name))
+        self.period_errors = {}  # {period_type: [(check number, error row)]}
+        for period_type in set(self.rows["periods_struct"]) | set(self.rows["timetables"]):
+            self.check_period_type(period_type)
+
+    def add_rows(self, df_name, rows):
+        keys = minio.TEMP_KEYS[df_name]
+        for row in rows:
+            by_key = self.rows[df_name].setdefault(row["period_type"], {})
+            by_key.setdefault(tuple(row[k] for k in keys[1:]), []).append(row)
+
+    def remove_keys(self, df_name, keys):
+        for key in keys:
+            by_key = self.rows[df_name].get(key[0], {})
+            by_key.pop(tuple(key[1:]), None)
+            if not by_key:
+                self.rows[df_name].pop(key[0], None)
+
+    def apply(self, df_name, changes):
+        # same delete/upsert operations as minio.apply_temp_changes, on the indexes
+        keys = minio.TEMP_KEYS[df_name]
+        touched = set()
+        for change in changes:
+            if change["op"] == "delete":
+                old_keys = [tuple(k) for k in change["keys"]]
+            else:  # upsert
+                old_keys = [tuple(row[k] for k in keys) for row in change["rows"]]
+            self.remove_keys(df_name, old_keys)
+            if change["op"] == "upsert":
+                self.add_rows(df_name, change["rows"])
+            touched.update(key[0] for key in old_keys)
+        for period_type in touched:
+            self.check_period_type(period_type)
+
+    def check_period_type(self, period_type):
+        days = self.rows["periods_struct"].get(period_type, {})
+        times = self.rows["timetables"].get(period_type, {})
+        errors = []
+        if days:
+            numbers = [key[0] for key in days]
+            if 0 not in numbers:
+                errors.append((0, {"period_type": period_type, "error": "No day 0"}))
+            if max(numbers) - min(numbers) + 1 != len(numbers):
+                errors.append((0, {"period_type": period_type, "error": "Non-consecutive day numbers"}))
+        day_types = {key[0] for key in times}
+        for key in sorted(days):
+            for row in days[key]:
+                if row["day_type"] not in day_types:
+                    errors.append((1, {"period_type": period_type, "day_type": row["day_type"],
+                                       "error": "No timetable entry for this day type"}))
+        for key in sorted(times):
+            rows = times[key]
+            if len(rows) > 1:
+                errors += [(2, {"period_type": period_type, "day_type": key[0], "time": key[1],
+                                "error": "Duplicated time"}) for _ in rows]
+            for row in rows:
+                if row["gong_id"] not in self.gong_ids:
+                    errors.append((3, {"period_type": period_type, "day_type": key[0], "time": key[1],
+                                       "gong_id": row["gong_id"], "error": "Invalid gong_id"}))
+                targets = row["targets"] if isinstance(row["targets"], str) else ""
+                if not set(targets.split()) <= self.target_names:
+                    errors.append((4, {"period_type": period_type, "day_type": key[0], "time": key[1],
+                                       "targets": targets, "error": "At least one invalid target"}))
+        if errors:
+            self.period_errors[period_type] = errors
+        else:
+            self.period_errors.pop(period_type, None)
+
+    def errors(self):
+        # grouped by check then period type, the missing values as empty strings
+        found = sorted((error for period_type in sorted(self.period_errors)
+                        for error in self.period_errors[period_type]), key=lambda e: e[0])
+        rows = []
+        for _, error in found:
+            row = {column: error.get(column, "") for column in TIMING_ERROR_COLUMNS}
+            row["gong_id"] = int(row["gong_id"]) if row["gong_id"] != "" and pd.notna(row["gong_id"]) else ""
+            rows.append(row)
+        return rows
+
+def get_timings_validator(center):
+    with minio.temp_lock:
+        validator = timings_validators.get(center)
+        if validator is None or any(validator.versions[df_name] != minio.temp_version(center, df_name)
+                                    for df_name in VALIDATED_TABLES):
+            validator = TimingsValidator(center)
+            timings_validators[center] = validator
+        return validator
+
+def evict_timings_validator(center):
+    timings_validators.pop(center, None)
+
+minio.temp_evict_callbacks.append(evict_timings_validator)
+
 # ~/~ end
 # ~/~ begin <<docs/gong-web-app-code/gong-timings.md#load-save-timings>>[init]
 
@@ -269,59 +412,7 @@ def load_timings(center):
 
 def check_timings(session):
     center = session[utils.Skey.CENTER]
-    periods_struct_df = minio.get_center_temp_df(center, "periods_struct")
-    gongs_df = minio.get_center_temp_df(center, "gongs")
-    targets_df = minio.get_center_temp_df(center, "targets")
-    timetables_df = minio.get_center_temp_df(center, "timetables")
-
-    errors_df = pd.DataFrame(columns=["period_type", "error", "day_type", "time", "gong_id", "targets"])
-
-    day_number_sets_for_period_types_dict = (
-        periods_struct_df.groupby("period_type")["day"].apply(set).to_dict())
-    for period_type, day_numbers in day_number_sets_for_period_types_dict.items():
-        if 0 not in day_numbers:
-            errors_df.loc[len(errors_df)] = {
-                "period_type": period_type,
-                "error": "No day 0"
-            }
-        if max(day_numbers) - min(day_numbers) + 1 != len(day_numbers):
-            errors_df.loc[len(errors_df)] = {
-                "period_type": period_type,
-                "error": "Non-consecutive day numbers"
-            }
-
-    # Build a set of valid pairs from timetables_df
-    valid_pairs = set(zip(timetables_df["period_type"], timetables_df["day_type"]))
-    # Build the pairs from periods_struct_df
-    pairs = list(zip(periods_struct_df["period_type"], periods_struct_df["day_type"]))
-    # Mask: True when the pair does NOT exist in timetables_df
-    mask = [p not in valid_pairs for p in pairs]
-    # Extract invalid rows
-    invalid_day_types = periods_struct_df.loc[mask, ["period_type", "day_type"]]
-    invalid_day_types["error"] = "No timetable entry for this day type"
-
-    invalid_gongs = timetables_df.loc[~timetables_df["gong_id"].isin(gongs_df["id"]),
-                           ["period_type", "day_type", "time", "gong_id"]]    
-    invalid_gongs["error"] = "Invalid gong_id"
-
-    duplicated_times = timetables_df[timetables_df.duplicated(
-        subset=["period_type", "day_type", "time"], keep=False)]
-    duplicated_times = duplicated_times[["period_type", "day_type", "time"]]
-    duplicated_times["error"] = "Duplicated time"
-
-    valid_targets = set(targets_df["shortname"])
-    invalid_targets = timetables_df.loc[
-        ~timetables_df["targets"].str.split().apply(lambda t: set(t).issubset(valid_targets)),
-        ["period_type", "day_type", "time", "targets"]
-    ]
-    invalid_targets["error"] = "At least one invalid target"
-
-    errors_df = pd.concat([errors_df, invalid_day_types, duplicated_times, invalid_gongs,invalid_targets], ignore_index=True)
-    errors2_df = errors_df.fillna("")
-    errors2_df["gong_id"] = errors2_df["gong_id"].apply(
-        lambda x: int(x) if isinstance(x, float) and pd.notna(x) else ""
-    )
-    return errors2_df
+    return pd.DataFrame(get_timings_validator(center).errors(), columns=TIMING_ERROR_COLUMNS)
 
 # ~/~ end
 
@@ -1,7 +1,10 @@
 # ~/~ begin <<docs/gong-web-app-code/states-transitions.md#libs/transit.py>>[init]
 
 import os
+import json
 import asyncio
+import shutil
+import hashlib
 from fasthtml.common import *
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
@@ -43,7 +46,10 @@ async def goto_free(session, event, csms):
 # ~/~ begin <<docs/gong-web-app-code/states-transitions.md#system-transitions>>[init]
 
 async def save_db_plan_times(model):
-    save_db_file = await planning.save_db_plan_timetable(model.center_name)
+    save_db_file = await planning.save_db_plan_timetable(model.center_name, model.report_save_progress)
+    model.save_progress = None
+    # checksum of the file sent to the center: checked again when it becomes the ok db
+    await asyncio.to_thread(record_sending_db, model.center_name, save_db_file)
     model.update_attr("save_db_filename", save_db_file)
     await asyncio.to_thread(minio.remove_temp_center_data, model.center_name)
     return {"success": f"new db saved as {save_db_file}"}
@@ -79,26 +85,19 @@ async def transfer_new_db(model):
     result = {"success": f"production db -{minio_object}- sent at {datetime.now(center_tz).isoformat()} center time"}
     return result
 
-def replace_db_files(model):
-    ok_db_file = utils.get_db_path() + dbset.gong_db_name(model.center_name)
-    old_db_file = utils.get_db_path() + dbset.gong_db_name(model.center_name, "old")
-    try:
-        os.remove(old_db_file)
-    except FileNotFoundError:
-        pass
-    os.rename(ok_db_file, old_db_file)            
-    os.rename(utils.get_db_path() + model.get_center_attr("save_db_filename"), ok_db_file)
-    return
-
 async def delete_new_db(model):
     objects_in_minio = minio.get_objects_list(utils.Globals.PI_BUCKET, f"{model.center_name.lower()}")
     confirmation = f"{model.center_name.lower()}/{utils.Globals.RECEIVED}{model.get_center_attr("center_save_date")}.db" in objects_in_minio
     if confirmation or (model.center_name in utils.Globals.TEST_USER):       
         await asyncio.to_thread(minio.delete_object, utils.Globals.PI_BUCKET,
                                 f"{model.center_name.lower()}",f"{utils.Globals.RECEIVED}{model.get_center_attr("center_save_date")}.db")
-        replace_db_files(model)
-        model.update_attr("pi_db_date", model.get_center_attr("center_save_date"))
-        result = {"success": f"confirmation of production version {model.get_center_attr("center_save_date")} is OK"}
+        promoted = await asyncio.to_thread(promote_db_file, model.center_name, model.get_center_attr("save_db_filename"),
+                                           model.get_center_attr("center_save_date"))
+        if "error" in promoted:
+            result = {"error": messages.feed_text(promoted)["mess"]}
+        else:
+            model.update_attr("pi_db_date", model.get_center_attr("center_save_date"))
+            result = {"success": f"confirmation of production version {model.get_center_attr("center_save_date")} is OK"}
     else:
         result = {"error": f"production file '{utils.Globals.RECEIVED}{model.get_center_attr("center_save_date")}.db' NOT PRESENT in minio"}
     return result
@@ -114,5 +113,144 @@ async def send_center_email(model, type, subject):
     await asyncio.to_thread(utils.send_email, subject, etext, to_emails)
     return
 
+# ~/~ end
+# ~/~ begin <<docs/gong-web-app-code/states-transitions.md#promote-db-files>>[init]
+
+def db_file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def fsync_path(path):
+    # a file, or a folder to make renames in it durable
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def manifest_file(center_name):
+    return utils.get_db_path() + center_name.lower() + ".manifest.json"
+
+def read_manifest(center_name):
+    try:
+        with open(manifest_file(center_name)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"sending": None, "ok": None, "previous": []}
+
+def write_manifest(center_name, manifest):
+    tmp_file = manifest_file(center_name) + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, manifest_file(center_name))
+
+def record_sending_db(center_name, save_db_filename):
+    manifest = read_manifest(center_name)
+    manifest["sending"] = {"file": save_db_filename,
+                           "sha256": db_file_sha256(utils.get_db_path() + save_db_filename)}
+    write_manifest(center_name, manifest)
+
+def reconciled_manifest(center_name):
+    manifest = read_manifest(center_name)
+    db_path = utils.get_db_path()
+    known = {e["sha256"]: e for e in [manifest["sending"], manifest["ok"], *manifest["previous"]] if e}
+    ok_name = dbset.gong_db_name(center_name)
+    if os.path.exists(db_path + ok_name):
+        sha256 = db_file_sha256(db_path + ok_name)
+        manifest["ok"] = {"sha256": sha256, "date": known.get(sha256, {}).get("date", ""), "file": ok_name}
+    ring = [dbset.gong_db_name(center_name, f"old{i}") for i in range(1, utils.Globals.OK_DB_VERSIONS + 1)]
+    previous = []
+    for old_name in [name for name in ring if os.path.exists(db_path + name)]:
+        # a gap left by a stopped shift is closed: the versions keep their order
+        if old_name != ring[len(previous)]:
+            os.replace(db_path + old_name, db_path + ring[len(previous)])
+        entry = known.get(db_file_sha256(db_path + ring[len(previous)]), {"sha256": None, "date": ""})
+        previous.append({"sha256": entry["sha256"], "date": entry.get("date", ""), "file": ring[len(previous)]})
+    manifest["previous"] = previous
+    return manifest
+
+def numbered_versions(center_name, previous):
+    return [p | {"file": dbset.gong_db_name(center_name, f"old{i}")} for i, p in enumerate(previous, start=1)]
+
+def shift_previous_versions(center_name, manifest):
+    # old{i} becomes old{i+1}, the oldest one is dropped: frees old1
+    db_path = utils.get_db_path()
+    keep = utils.Globals.OK_DB_VERSIONS
+    legacy_file = db_path + dbset.gong_db_name(center_name, "old")
+    if os.path.exists(legacy_file):
+        # single previous version kept before the ring: the oldest one of the ring
+        if len(manifest["previous"]) < keep:
+            manifest["previous"].append({"sha256": db_file_sha256(legacy_file), "date": ""})
+            os.replace(legacy_file, db_path + dbset.gong_db_name(center_name, f"old{len(manifest['previous'])}"))
+        else:
+            os.remove(legacy_file)
+    for i in range(keep, 0, -1):
+        old_file = db_path + dbset.gong_db_name(center_name, f"old{i}")
+        if os.path.exists(old_file):
+            if i == keep:
+                os.remove(old_file)
+            else:
+                os.replace(old_file, db_path + dbset.gong_db_name(center_name, f"old{i + 1}"))
+    manifest["previous"] = manifest["previous"][:keep - 1]
+
+def keep_ok_db_as_old1(center_name):
+    ok_db_file = utils.get_db_path() + dbset.gong_db_name(center_name)
+    old1_file = utils.get_db_path() + dbset.gong_db_name(center_name, "old1")
+    try:
+        os.link(ok_db_file, old1_file)
+    except OSError:  # no hard links on this file system
+        shutil.copy2(ok_db_file, old1_file)
+
+def promote_db_file(center_name, save_db_filename, save_date):
+    db_path = utils.get_db_path()
+    new_db_file = db_path + save_db_filename
+    ok_db_file = db_path + dbset.gong_db_name(center_name)
+    manifest = reconciled_manifest(center_name)
+    sha256 = db_file_sha256(new_db_file)
+    if manifest["sending"] and manifest["sending"]["sha256"] != sha256:
+        return {"error": "sending_db_changed", "file": save_db_filename}
+    fsync_path(new_db_file)
+    # old1 is already the ok db when a former promotion of this file stopped before its end
+    kept = manifest["ok"] and manifest["previous"] and manifest["previous"][0]["sha256"] == manifest["ok"]["sha256"]
+    if os.path.exists(ok_db_file) and not kept:
+        shift_previous_versions(center_name, manifest)
+        keep_ok_db_as_old1(center_name)
+        manifest["previous"] = numbered_versions(center_name, [manifest["ok"]] + manifest["previous"])
+    os.replace(new_db_file, ok_db_file)
+    fsync_path(db_path)
+    manifest["ok"] = {"file": dbset.gong_db_name(center_name), "sha256": sha256, "date": save_date}
+    manifest["sending"] = None
+    write_manifest(center_name, manifest)
+    return {"success": "db_promoted"}
+
+def rollback_db_file(center_name):
+    # the most recent previous version becomes the ok db again, the others move up the ring
+    db_path = utils.get_db_path()
+    manifest = reconciled_manifest(center_name)
+    if not manifest["previous"]:
+        return {"error": "no_previous_db"}
+    old1_file = db_path + dbset.gong_db_name(center_name, "old1")
+    previous = manifest["previous"][0]
+    if not os.path.exists(old1_file):
+        return {"error": "previous_db_missing"}
+    if db_file_sha256(old1_file) != previous["sha256"]:
+        return {"error": "previous_db_corrupted"}
+    del manifest["previous"][0]
+    os.replace(old1_file, db_path + dbset.gong_db_name(center_name))
+    for i in range(2, utils.Globals.OK_DB_VERSIONS + 1):
+        old_file = db_path + dbset.gong_db_name(center_name, f"old{i}")
+        if os.path.exists(old_file):
+            os.replace(old_file, db_path + dbset.gong_db_name(center_name, f"old{i - 1}"))
+    fsync_path(db_path)
+    manifest["ok"] = previous | {"file": dbset.gong_db_name(center_name)}
+    manifest["previous"] = numbered_versions(center_name, manifest["previous"])
+    write_manifest(center_name, manifest)
+    return {"success": "db_rolled_back", "date": previous.get("date", "")}
+
 # ~/~ end
 # ~/~ end
@@ -38,14 +38,25 @@ class GlobalsDefinition:
     ORANGE:str = "darkorange"
     INITIAL_COUNTDOWN:int = 4000 # seconds before auto-abandoning an edit session, set in planning_page and used in JS_CLIENT_TIMER
     SUBDIR_TEMP:str = "temp" # subdir of get_db_path() for temp files
+    TEMP_FLUSH_DELAY:int = 5 # seconds without change before an edited temp DataFrame is written back to parquet
+    TEMP_JOURNAL_MAX:int = 200 # records in a temp table edit journal before it is folded into a new parquet snapshot
     MONTHS_TO_FETCH:int = 12 # when fetching dhamma courses from dhamma.org, how many months to fetch starting from current month
     DAYS_TO_FETCH:int = 0 # when fetching dharma courses from dhamma.org, how many extra days to fetch after the last day of the last month (to catch late announcements)
+    FETCH_CONCURRENCY:int = 4 # max simultaneous page requests to dhamma.org over the pooled scraping session
+    FETCH_CACHE_TTL:int = 3600 # seconds a dhamma.org search result page is reused before being fetched again
+    FETCH_CACHE_SIZE:int = 500 # max dhamma.org result pages kept in the cache, least recently used dropped first
+    FETCH_CACHE_FILE:str = "dhamma-cache.json" # file under get_db_path() keeping the dhamma.org cache across restarts, "" for memory only
+    FETCH_WARM_HOUR:int = 3 # server local hour of the nightly dhamma.org refresh of all centers
+    FETCH_WARM_TTL:int = 86400 # seconds the pages cached by the nightly refresh stay valid
+    CENTER_ROW_TTL:int = 5 # seconds a center row read from the central db is trusted before being read again
     WAIT01_HOUR:int = 0
     WAIT01_MINS:int = 40
     WAIT02_HOUR:int = 1
     WAIT02_MINS:int = 20
     SHORT_DELAY:int = 4 # seconds: waiting time before uploading file to minio IN DEV MODE
     SENDING:str = "sending"
+    OK_DB_VERSIONS:int = 3 # previous ok dbs kept per center as old1..oldN for a rollback
+    GONG_DB_PAGE_SIZE:int = 1024 # bytes per page of the sending gong db written by VACUUM INTO: small tables, less slack in the file sent to the Pis
     RECEIVED:str = "received"
     CENTER_BUCKET:str = "centers-data" # bucket name for local center data 
     PI_BUCKET:str = "dhamma-gong-databases"  # bucket name for db exchange with Rasperry Pis
@@ -157,7 +168,9 @@ def toggle_markdown(md_id: str, insert=None, showhelp=False):
 # ~/~ begin <<docs/gong-web-app-code/utilities.md#plus-months-days>>[init]
 
 def add_months_days(date_str, num_months, num_days):
-    dt = datetime.strptime(date_str, "%Y-%m-%d").date()
+    dt = date.fromisoformat(date_str)
+    if num_months == 0:
+        return (dt + timedelta(days=num_days)).isoformat()
     # total months since year 0 (make month zero-based)
     total = dt.year * 12 + (dt.month - 1) + num_months
     new_year, new_month0 = divmod(total, 12)
@@ -46,7 +46,13 @@ def before(req, session):
 
 bware = Beforeware(before, skip=[r'/favicon\.ico', r'/static/.*', r'.*\.css','/login','/', '/create_magic_link', '/verify_code', '/create_code', '/healthz' ])
 
+async def start_background_tasks():
+    # async: FastHTML runs the sync startup functions in a worker thread, without the event loop
+    await fetch.start_nightly_refresh(centers)
+    await states.scheduler.start(db)
+
 app, rt = fast_app(live=False, title="Gong Users", favicon="favicon.ico", before=bware,
+    on_startup=[start_background_tasks],
     hdrs=(custom_styles,
         Link(rel="stylesheet", href="https://cdn.jsdelivr.net/npm/@picocss/pico@latest/css/pico.min.css", type='text/css'),
         Link(rel='stylesheet', href='https://cdn.jsdelivr.net/npm/flatpickr/dist/flatpickr.min.css', type='text/css'),
@@ -60,11 +66,13 @@ utils.show_load_context()
 db_path = utils.get_db_path()
 db = dbset.get_central_db()
 minio.minio_client = minio.create_minio_client()
+minio.precompile_all_configs()
 
 roles = db.create(dbset.Role, pk='role_name')
 users = db.create(dbset.User, pk='email')
 centers = db.create(dbset.Center, pk='center_name')
 planners = db.create(dbset.Planner, pk=('user_email', 'center_name'))
+scheduled_events = db.create(dbset.Scheduled_event, pk='send_id')
 
 dbset.init_data(roles, users, centers, planners)
 states.init_center_state_machines(db)
@@ -118,6 +126,10 @@ def get(session):
 async def post(file: UploadFile, center_name: str):
     return await cdash.upload_config(file, center_name)
 
+@rt('/rollback_db')
+async def post(center_name: str):
+    return await cdash.rollback_db(center_name)
+
 # ~/~ end
 # ~/~ begin <<docs/gong-web-app-code/0-gong-prog.md#consult-centers-plans>>[init]
 
@@ -197,13 +209,13 @@ async def get(session):
 # ~/~ begin <<docs/gong-web-app-code/0-gong-prog.md#courses-planning>>[init]
 
 @rt('/planning/load_dhamma_db')
-def get(session):
-    return planning.load_dhamma_db(session)
+def get(session, refresh: bool = False):
+    return planning.load_dhamma_db(session, refresh)
 
 @rt('/planning/check_show_dhamma')
-async def get(session, request):
+async def get(session, request, refresh: bool = False):
     merged_plan = await fetch.fetch_dhamma_courses(centers, session[utils.Skey.CENTER],
-                        utils.Globals.MONTHS_TO_FETCH, utils.Globals.DAYS_TO_FETCH)
+                        utils.Globals.MONTHS_TO_FETCH, utils.Globals.DAYS_TO_FETCH, refresh)
     return await planning.check_save_show_plan(session, merged_plan, {})
 
 @rt('/planning/saved_plan')
@@ -213,9 +225,9 @@ async def get(session):
     plan = minio.get_center_temp_list_of_dicts(session[utils.Skey.CENTER], "planning")
     return await planning.check_save_show_plan(session, plan, {"success": "show_plan"})
 
-@rt('/planning/delete_line/{idx}')
-async def post(session, idx: int):
-    return await planning.delete_line(session, idx)
+@rt('/planning/delete_line/{row_id}')
+async def post(session, row_id: int):
+    return await planning.delete_line(session, row_id)
 
 @rt('/planning/add_line')
 async def post(session, ptype: str, start: str):
@@ -275,6 +287,10 @@ def post(session, period_type: str, day_type: str, idx: int, time: str, gong_id:
     return timechan.add_mod_timetable_row(session, period_type, day_type, idx, time,
                                      gong_id, auto, targets, comment)
 
+@rt('/timings/batch_timetable')
+def post(session, period_type: str, day_type: str, timings_csv: str = ""):
+    return timechan.batch_timetable(session, period_type, day_type, timings_csv)
+
 @rt('/timings/modify_day_type')
 def post(session, index: int, day_type: str):
     return timechan.modify_day_type(session, index, day_type)
@@ -0,0 +1,36 @@
+# Benchmark of fetch.sort_clean against the former sort / adjacent dedup / list-scan clean
+# on synthetic multi-year plans.
+# Run from the repo root: python tests/other-tests/bench_sort_clean.py
+
+import copy
+import random
+import sys
+import timeit
+
+sys.path.insert(0, "tests")
+sys.path.insert(0, ".")
+
+import libs.fetch as fetch
+from test_fetch import PLAN_DURATIONS, _random_plan, _sort_clean_reference
+
+def bench_sort_clean(years_list=(1, 5, 20), repeat=5):
+    # the real get_types_with_duration reads the edit session tables: its calls are counted
+    calls = []
+    fetch.plancheck.get_types_with_duration = lambda center: calls.append(center) or PLAN_DURATIONS
+    rng = random.Random(0)
+    inside = [{"action": "fillin", "period_type": "Service"},
+              {"action": "delete", "period_type": "3d", "container": "10d"},
+              {"action": "delete", "period_type": "Trust", "container": "@ALL@"},
+              {"action": "insert1", "container": "Sati", "period_type": "Service", "after": "10d"}]
+    for years in years_list:
+        plan = _random_plan(rng, years * 365)
+        for name, func in [("former", _sort_clean_reference), ("current", fetch.sort_clean)]:
+            # the pipeline changes its rows: each run gets its own copy, made outside the timing
+            copies = [copy.deepcopy(plan) for _ in range(repeat)]
+            calls.clear()
+            seconds = min(timeit.repeat(lambda: func("Mahi", copies.pop(), inside), number=1, repeat=repeat))
+            print(f"{years:>3} years, {len(plan):>5} rows, {name:<8}: {seconds * 1000:8.2f} ms, "
+                  f"{len(calls) // repeat} duration lookups")
+
+if __name__ == "__main__":
+    bench_sort_clean()
@@ -0,0 +1,48 @@
+# Benchmark of the cold start of the center state machines: states.init_center_state_machines,
+# then the first access to one center, against the former eager build of every machine.
+# Run from the repo root: python tests/other-tests/bench_startup.py
+
+import sys
+import timeit
+
+sys.path.insert(0, ".")
+
+from fastlite import database
+
+import libs.dbset as dbset
+import libs.states as states
+
+def centers_db(count):
+    db = database(":memory:")
+    centers = db.create(dbset.Center, pk="center_name")
+    centers.insert_all([{"center_name": f"Center{i:04d}", "status": "free", "created_by": "",
+                         "status_start": "2026-01-01T00:00:00+00:00"} for i in range(count)])
+    return db
+
+def former_init(db):
+    # one machine and one primary key query per center, all built at startup
+    for row in db.t.center():
+        states.add_center_state_machine(states.row_fields(row)["center_name"], db)
+
+def current_init(db):
+    states.init_center_state_machines(db)
+    states.csms["Center0000"]
+
+def bench_startup(counts=(10, 100, 1000), repeat=3):
+    for count in counts:
+        db = centers_db(count)
+        queries = []
+        db.conn.exec_trace = lambda cursor, sql, bindings: queries.append(sql) or True
+        for name, func in [("former", former_init), ("current", current_init)]:
+            def cold_start():
+                states.csms.clear()
+                states.csms.rows = {}
+                func(db)
+            queries.clear()
+            seconds = min(timeit.repeat(cold_start, number=1, repeat=repeat))
+            selects = len([q for q in queries if q.startswith("select") and "[center]" in q]) // repeat
+            print(f"{count:>5} centers, {name:<8}: {seconds * 1000:9.2f} ms, {selects:>5} center queries")
+        db.close()
+
+if __name__ == "__main__":
+    bench_startup()
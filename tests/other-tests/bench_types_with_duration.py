@@ -0,0 +1,26 @@
+# Benchmark of plancheck.compute_types_with_duration against the former per-type scans,
+# on synthetic centers with many period types and dense timetables.
+# Run from the repo root: python tests/other-tests/bench_types_with_duration.py
+
+import random
+import sys
+import timeit
+
+sys.path.insert(0, "tests")
+sys.path.insert(0, ".")
+
+import libs.plancheck as plancheck
+from test_plancheck import _scan_types_with_duration, random_center_tables
+
+def bench_types_with_duration(sizes=((10, 20), (40, 60), (150, 100)), repeat=5):
+    rng = random.Random(0)
+    for num_types, num_times in sizes:
+        periods_structs, timetables = random_center_tables(rng, num_types, num_times)
+        for name, func in [("former", _scan_types_with_duration),
+                           ("current", plancheck.compute_types_with_duration)]:
+            seconds = min(timeit.repeat(lambda: func(periods_structs, timetables, "T1"),
+                                        number=1, repeat=repeat))
+            print(f"{num_types:>4} types, {len(timetables):>6} times, {name:<8}: {seconds * 1000:9.2f} ms")
+
+if __name__ == "__main__":
+    bench_types_with_duration()
@@ -1,6 +1,15 @@
-from unittest.mock import Mock, patch
+import asyncio
+import copy
+import random
+import re
+from datetime import date
+from unittest.mock import Mock
 
+import pytest
+
+import libs.fetch as fetch
 from libs.fetch import (
+    CourseTypeMapper,
     fetch_scrap,
     get_period_type,
     deduplicate,
@@ -32,6 +41,55 @@ def test_get_period_type_unknown_returns_input():
     assert get_period_type("UNKNOWN", "anything", [], []) == "UNKNOWN"
 
 
+def test_get_period_type_first_listed_description_wins():
+    replacement = [{"raw_course_type": "R", "course_description": "DAY", "period_type": "first"},
+                   {"raw_course_type": "R", "course_description": "10", "period_type": "second"}]
+    # "10" is found before "DAY" in the course type, but "DAY" comes first in the table
+    assert get_period_type("R", "10-Day", [], replacement) == "first"
+
+
+def _scan_period_type(dhamma_type, course_type, dhamma_types, replacement):
+    """The list-scanning lookup the mapper replaces, kept as the reference."""
+    replace_dhamma = [r for r in replacement if r["raw_course_type"] == dhamma_type]
+    if replace_dhamma:
+        replace_all = [r for r in replace_dhamma if r["course_description"] == "@ALL@"]
+        if replace_all:
+            return replace_all[0]["period_type"]
+        cleaned_type = re.sub(r'[^a-zA-Z0-9]', '', course_type).upper()
+        replace_cleaned = [r for r in replace_dhamma if r["course_description"] in cleaned_type]
+        if replace_cleaned:
+            return replace_cleaned[0]["period_type"]
+    match_dhamma = [r for r in dhamma_types if r["raw_course_type"] == dhamma_type]
+    return match_dhamma[0]["period_type"] if match_dhamma else dhamma_type
+
+
+def test_course_type_mapper_matches_list_scan():
+    rng = random.Random(9)
+    raws = ["R1", "R2", "R3", "R4"]
+    words = ["DAY", "10", "10DAY", "OSC", "TEEN", "A", "@ALL@"]
+    for _ in range(200):
+        replacement = [{"raw_course_type": rng.choice(raws), "course_description": rng.choice(words),
+                        "period_type": f"P{i}"} for i in range(rng.randint(0, 6))]
+        dhamma_types = [{"raw_course_type": rng.choice(raws), "period_type": f"M{i}"} for i in range(3)]
+        mapper = CourseTypeMapper(dhamma_types, replacement)
+        for _ in range(10):
+            raw = rng.choice(raws)
+            course_type = "-".join(rng.choice(words[:-1]).lower() for _ in range(rng.randint(0, 3)))
+            assert mapper.period_type(raw, course_type) == \
+                _scan_period_type(raw, course_type, dhamma_types, replacement)
+
+
+def test_course_type_mapper_rebuilt_when_config_changes(monkeypatch):
+    versions = {"all_centers": 1, "Mahi": 1}
+    monkeypatch.setattr(fetch.minio, "config_version", lambda center: versions[center])
+    monkeypatch.setattr(fetch.minio, "dicts_from_excel", lambda center, sheet: [])
+    monkeypatch.setattr(fetch, "course_mappers", {})
+    mapper = fetch.course_type_mapper("Mahi")
+    assert fetch.course_type_mapper("Mahi") is mapper
+    versions["Mahi"] = 2
+    assert fetch.course_type_mapper("Mahi") is not mapper
+
+
 # ----------------------------------------------------------------------
 # deduplicate: adjacent rows with same date+type but different source -> "BOTH"
 # ----------------------------------------------------------------------
@@ -107,33 +165,326 @@ def _course(course_type):
     }
 
 
-def test_fetch_scrap_paginates_and_maps():
-    page1 = {"courses": [_course("CT1")], "pages": 2}
-    page2 = {"courses": [_course("CT2")], "pages": 2}
+@pytest.fixture
+def fake_session(monkeypatch, tmp_path):
+    """Replace the pooled scraping session with one serving canned pages, with an empty page cache."""
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(fetch, "scrap_cache", fetch.OrderedDict())
+    monkeypatch.setattr(fetch, "scrap_cache_loaded", False)
+    monkeypatch.setattr(fetch, "scrap_cache_dirty", False)
+    pages = {}
+    calls = []
+
+    async def fake_post(url, data=None, **kwargs):
+        page = int(dict(data)["page"])
+        calls.append(page)
+        await asyncio.sleep(0.01 * (len(pages) - page))  # later pages answer first
+        return Mock(json=Mock(return_value=pages[page]))
 
-    def fake_post(url, data=None, **kwargs):
-        resp = Mock()
-        resp.json.return_value = page1 if int(data["page"]) == 1 else page2
-        return resp
+    session = Mock()
+    session.post.side_effect = fake_post
+    monkeypatch.setattr(fetch.requests, "AsyncSession", Mock(return_value=session))
+    monkeypatch.setattr(fetch, "scrap_session", None)
+    yield pages, calls
 
-    mock_session = Mock()
-    mock_session.post.side_effect = fake_post
-    with patch("libs.fetch.requests.Session", return_value=mock_session):
-        result = fetch_scrap("location_1", "2023-01-01", "2023-02-01")
 
-    assert [c["course_type"] for c in result] == ["CT1", "CT2"]
+def test_fetch_scrap_paginates_and_maps(fake_session):
+    pages, calls = fake_session
+    pages.update({1: {"courses": [_course("CT1")], "pages": 3},
+                  2: {"courses": [_course("CT2")], "pages": 3},
+                  3: {"courses": [_course("CT3")], "pages": 3}})
+    result = asyncio.run(fetch_scrap("location_1", "2023-01-01", "2023-02-01"))
 
+    assert [c["course_type"] for c in result] == ["CT1", "CT2", "CT3"]
+    assert calls[0] == 1 and sorted(calls) == [1, 2, 3]
 
-def test_fetch_scrap_filters_cancelled_and_noncenter():
+
+def test_fetch_scrap_filters_cancelled_and_noncenter(fake_session):
+    pages, _ = fake_session
     cancelled = _course("CANCELLED_ONE")
     cancelled["status"] = [{"status": "cancelled"}]
     noncenter = _course("NONCENTER_ONE")
     noncenter["location"] = {"center_noncenter": "noncenter"}
-    payload = {"courses": [_course("KEPT"), cancelled, noncenter], "pages": 1}
-
-    mock_session = Mock()
-    mock_session.post.return_value = Mock(json=Mock(return_value=payload))
-    with patch("libs.fetch.requests.Session", return_value=mock_session):
-        result = fetch_scrap("location_1", "2023-01-01", "2023-02-01")
+    pages[1] = {"courses": [_course("KEPT"), cancelled, noncenter], "pages": 1}
+    result = asyncio.run(fetch_scrap("location_1", "2023-01-01", "2023-02-01"))
 
     assert [c["course_type"] for c in result] == ["KEPT"]
+
+
+def test_fetch_scrap_reuses_session_within_a_loop(fake_session):
+    pages, _ = fake_session
+    pages[1] = {"courses": [], "pages": 1}
+
+    async def two_searches():
+        await fetch_scrap("location_1", "2023-01-01", "2023-02-01")
+        await fetch_scrap("location_2", "2023-01-01", "2023-02-01")
+
+    asyncio.run(two_searches())
+    assert fetch.requests.AsyncSession.call_count == 1
+
+
+# ----------------------------------------------------------------------
+# page cache: TTL, LRU bound, disk copy and forced refresh
+# ----------------------------------------------------------------------
+def _search(refresh=False):
+    return asyncio.run(fetch_scrap("location_1", "2023-01-01", "2023-02-01", refresh))
+
+
+def test_fetch_scrap_served_from_cache(fake_session):
+    pages, calls = fake_session
+    pages.update({1: {"courses": [_course("CT1")], "pages": 2}, 2: {"courses": [_course("CT2")], "pages": 2}})
+    first = _search()
+    assert _search() == first
+    assert len(calls) == 2
+
+
+def test_fetch_scrap_refresh_bypasses_cache(fake_session):
+    pages, calls = fake_session
+    pages[1] = {"courses": [_course("OLD")], "pages": 1}
+    _search()
+    pages[1] = {"courses": [_course("NEW")], "pages": 1}
+    assert [c["course_type"] for c in _search(refresh=True)] == ["NEW"]
+    assert [c["course_type"] for c in _search()] == ["NEW"]
+    assert len(calls) == 2
+
+
+def test_fetch_cache_expires_after_ttl(fake_session, monkeypatch):
+    pages, calls = fake_session
+    pages[1] = {"courses": [], "pages": 1}
+    monkeypatch.setattr(fetch.utils, "Globals", fetch.utils.GlobalsDefinition(FETCH_CACHE_TTL=-1))
+    _search()
+    _search()
+    assert len(calls) == 2
+
+
+def test_fetch_cache_drops_least_recently_used(fake_session, monkeypatch):
+    monkeypatch.setattr(fetch.utils, "Globals", fetch.utils.GlobalsDefinition(FETCH_CACHE_SIZE=2))
+    for page in [1, 2]:
+        fetch.put_cached_page(("loc", "a", "b", page), {"pages": page})
+    fetch.get_cached_page(("loc", "a", "b", 1))
+    fetch.put_cached_page(("loc", "a", "b", 3), {"pages": 3})
+    assert list(fetch.scrap_cache) == [("loc", "a", "b", 1), ("loc", "a", "b", 3)]
+
+
+def test_fetch_cache_reloaded_from_disk(fake_session, tmp_path, monkeypatch):
+    pages, calls = fake_session
+    pages[1] = {"courses": [_course("CT1")], "pages": 1}
+    _search()
+    assert (tmp_path / "dhamma-cache.json").exists()
+    monkeypatch.setattr(fetch, "scrap_cache", fetch.OrderedDict())
+    monkeypatch.setattr(fetch, "scrap_cache_loaded", False)
+    assert [c["course_type"] for c in _search()] == ["CT1"]
+    assert len(calls) == 1
+
+
+def test_fetch_cache_file_written_only_after_new_pages(fake_session, monkeypatch):
+    pages, _ = fake_session
+    pages[1] = {"courses": [_course("CT1")], "pages": 1}
+    writes = []
+    monkeypatch.setattr(fetch, "write_scrap_cache", lambda entries: writes.append(entries))
+    _search()
+    _search()
+    assert len(writes) == 1
+    assert writes[0][0][0] == ["location_1", "2023-01-01", "2023-02-01", 1]
+
+
+# ----------------------------------------------------------------------
+# single flight: identical concurrent searches share one scrape
+# ----------------------------------------------------------------------
+def test_concurrent_identical_searches_share_one_scrape(fake_session):
+    pages, calls = fake_session
+    pages.update({1: {"courses": [_course("CT1")], "pages": 2}, 2: {"courses": [_course("CT2")], "pages": 2}})
+
+    async def burst():
+        return await asyncio.gather(*[fetch_scrap("location_1", "2023-01-01", "2023-02-01", True)
+                                      for _ in range(5)])
+
+    results = asyncio.run(burst())
+    assert len(calls) == 2
+    assert all([c["course_type"] for c in r] == ["CT1", "CT2"] for r in results)
+    results[0][0]["course_type"] = "changed"
+    assert results[1][0]["course_type"] == "CT1"
+    assert fetch.scrap_inflight == {}
+
+
+def test_refresh_does_not_join_cached_search(fake_session):
+    pages, calls = fake_session
+    pages[1] = {"courses": [_course("OLD")], "pages": 1}
+    _search()
+    pages[1] = {"courses": [_course("NEW")], "pages": 1}
+
+    async def cached_then_refresh():
+        return await asyncio.gather(fetch_scrap("location_1", "2023-01-01", "2023-02-01"),
+                                    fetch_scrap("location_1", "2023-01-01", "2023-02-01", True))
+
+    cached, refreshed = asyncio.run(cached_then_refresh())
+    assert [c["course_type"] for c in cached] == ["OLD"]
+    assert [c["course_type"] for c in refreshed] == ["NEW"]
+    assert len(calls) == 2
+
+
+def test_concurrent_searches_all_get_the_failure(fake_session):
+    pages, calls = fake_session  # no page 1 -> KeyError inside the scrape
+
+    async def burst():
+        return await asyncio.gather(*[fetch_scrap("location_1", "2023-01-01", "2023-02-01")
+                                      for _ in range(3)], return_exceptions=True)
+
+    results = asyncio.run(burst())
+    assert len(calls) == 1
+    assert all(isinstance(r, KeyError) for r in results)
+    assert fetch.scrap_inflight == {}
+
+
+# ----------------------------------------------------------------------
+# nightly batch: one search for all regions, split back per center
+# ----------------------------------------------------------------------
+def _located(course_type, location_id, start):
+    course = _course(course_type)
+    course.update({"course_start_date": start, "course_end_date": start,
+                   "location": {"center_noncenter": "center", "id": location_id}})
+    return course
+
+
+def test_fetch_all_centers_in_one_search(fake_session, monkeypatch):
+    pages, calls = fake_session
+    pages[1] = {"courses": [_located("A1", 1, "2023-01-05"), _located("B1", 2, "2023-01-05"),
+                            _located("A2", 1, "2023-03-05")], "pages": 1}
+    searches = {"Alpha": ("location_1", "2023-01-01", "2023-02-01", []),
+                "Beta": ("location_2", "2023-01-01", "2023-06-01", [])}
+    sources = []
+    def center_search(center, months, days, source):
+        sources.append(source)
+        return searches[center]
+    monkeypatch.setattr(fetch, "center_search", center_search)
+    centers = Mock(return_value=[Mock(center_name="Alpha"), Mock(center_name="Beta")])
+
+    warmed = asyncio.run(fetch.fetch_all_dhamma_courses(centers, 1, 0))
+    assert warmed == {"Alpha": 1, "Beta": 1}
+    assert sources == ["db", "db"]
+    sent = fetch.requests.AsyncSession.return_value.post.call_args.kwargs["data"]
+    assert [v for k, v in sent if k == "regions[]"] == ["location_1", "location_2"]
+
+    # the planner's own search for Alpha is now served from the cache
+    result = asyncio.run(fetch_scrap("location_1", "2023-01-01", "2023-02-01"))
+    assert [c["course_type"] for c in result] == ["A1"]
+    assert len(calls) == 1
+
+
+# ----------------------------------------------------------------------
+# sort_clean: same plans as the former sort / adjacent dedup / list-scan clean
+# ----------------------------------------------------------------------
+def _deduplicate_reference(merged):
+    deduplicated = []
+    i = 0
+    while i < len(merged):
+        current = merged[i]
+        if i + 1 < len(merged):
+            next_item = merged[i + 1]
+            if (current['start_date'] == next_item['start_date'] and
+                    current['period_type'] == next_item['period_type'] and
+                    current['source'] != next_item['source']):
+                if current['source'] == "dhamma.org":
+                    current['source'] = 'BOTH'
+                    deduplicated.append(current)
+                else:
+                    next_item['source'] = 'BOTH'
+                    deduplicated.append(next_item)
+                i += 2
+                continue
+        deduplicated.append(current)
+        i += 1
+    return deduplicated
+
+
+def _clean_reference(center, periods_dhamma_org, inside):
+    cleaned = []
+    delete_list = [d for d in inside if d["action"] == "delete"]
+    insert1_list = [d for d in inside if d["action"] == "insert1"]
+    for i, row in enumerate(periods_dhamma_org):
+        if i == 0:
+            cleaned.append(row)
+            continue
+        row_bef = periods_dhamma_org[i-1]
+        row_delete_list = [d for d in delete_list if d["period_type"] == row["period_type"]]
+        if row_delete_list:
+            if row_delete_list[0]["container"] == "@ALL@":
+                cleaned[-1]["No_gong"] = row["period_type"]
+                continue
+            elif [d for d in row_delete_list if d["container"] == row_bef["period_type"]
+                  and check_within(row, row_bef)]:
+                cleaned[-1]["No_gong"] = row["period_type"]
+                continue
+            else:
+                cleaned.append(row)
+                continue
+        elif [d for d in insert1_list if d["container"] == row["period_type"]]:
+            first_period_duration = [d for d in fetch.plancheck.get_types_with_duration(center)
+                                     if d["period_type"] == row["period_type"]][0]["duration"]
+            end_first_period = fetch.utils.add_months_days(row["start_date"], 0, first_period_duration - 1)
+            source = row["source"] + " + CONFIG." if not row["source"].endswith("CONFIG.") else row["source"]
+            no_gong = row["no_gong"] if "no_gong" in row else None
+            cleaned.append({"start_date": row["start_date"], "end_date": end_first_period,
+                            "period_type": insert1_list[0]["period_type"], "source": source,
+                            "course_type": row["course_type"], "no_gong": no_gong})
+            cleaned.append({"start_date": fetch.utils.add_months_days(end_first_period, 0, 1),
+                            "end_date": row["end_date"], "period_type": insert1_list[0]["after"],
+                            "source": source, "course_type": row["course_type"], "no_gong": no_gong})
+            continue
+        else:
+            cleaned.append(row)
+    return cleaned
+
+
+def _sort_clean_reference(center, aplan, inside):
+    sorted_plan = sorted(sorted(aplan, key=lambda x: x['end_date'], reverse=True),
+                         key=lambda x: x['start_date'])
+    dedup = _deduplicate_reference(sorted_plan)
+    return fetch.fillgaps_dhamma_courses(_clean_reference(center, dedup, inside), inside)
+
+
+PLAN_TYPES = ["10d", "Sati", "3d", "Service", "Trust"]
+PLAN_DURATIONS = [{"period_type": pt, "duration": d} for pt, d in zip(PLAN_TYPES, [11, 9, 4, 2, 3])]
+
+
+def _random_plan(rng, days):
+    """One center db row and at most one dhamma.org row per start date, like the real sources."""
+    plan = []
+    first = date(2024, 1, 1).toordinal()
+    for source in ["mahi.ok.db", "dhamma.org"]:
+        for ordinal in sorted(rng.sample(range(first, first + days), days // 6)):
+            start = date.fromordinal(ordinal)
+            plan.append({"start_date": start.isoformat(),
+                         "end_date": date.fromordinal(ordinal + rng.randint(0, 12)).isoformat(),
+                         "period_type": rng.choice(PLAN_TYPES), "source": source, "course_type": "ct"})
+    return plan
+
+
+def _random_inside(rng):
+    inside = [{"action": "fillin", "period_type": "Service"}]
+    for _ in range(rng.randint(0, 3)):
+        inside.append({"action": "delete", "period_type": rng.choice(PLAN_TYPES),
+                       "container": rng.choice(PLAN_TYPES + ["@ALL@"])})
+    if rng.random() < 0.7:
+        inside.append({"action": "insert1", "container": rng.choice(PLAN_TYPES),
+                       "period_type": "Service", "after": "10d"})
+    return inside
+
+
+def test_sort_clean_matches_former_pipeline(monkeypatch):
+    monkeypatch.setattr(fetch.plancheck, "get_types_with_duration", lambda center: PLAN_DURATIONS)
+    rng = random.Random(10)
+    for _ in range(300):
+        plan, inside = _random_plan(rng, rng.randint(6, 400)), _random_inside(rng)
+        assert fetch.sort_clean("Mahi", copy.deepcopy(plan), inside) == \
+            _sort_clean_reference("Mahi", copy.deepcopy(plan), inside)
+
+
+def test_deduplicate_pairs_twins_separated_by_another_course():
+    merged = [
+        {"start_date": "2024-01-01", "period_type": "A", "source": "mahi.ok.db"},
+        {"start_date": "2024-01-01", "period_type": "B", "source": "dhamma.org"},
+        {"start_date": "2024-01-01", "period_type": "A", "source": "dhamma.org"},
+    ]
+    result = deduplicate(merged)
+    assert [(r["period_type"], r["source"]) for r in result] == [("A", "BOTH"), ("B", "dhamma.org")]
@@ -0,0 +1,24 @@
+import importlib
+
+import pytest
+from starlette.testclient import TestClient
+
+
+@pytest.fixture
+def main_app(tmp_path, monkeypatch):
+    """main imported on a SQLite central db and an empty DATA_DIR, no MinIO server needed at boot."""
+    monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path / 'central.db'}")
+    monkeypatch.setenv("DATA_DIR", f"{tmp_path}/")
+    monkeypatch.setenv("MINIO_ROOT_USER", "test")
+    monkeypatch.setenv("MINIO_ROOT_PASSWORD", "test-secret")
+    return importlib.import_module("main")
+
+
+# ----------------------------------------------------------------------
+# lifespan: the startup functions start their background tasks on the event loop
+# ----------------------------------------------------------------------
+def test_app_boots_with_background_tasks(main_app):
+    with TestClient(main_app.app) as client:
+        assert client.get("/healthz").status_code == 200
+        assert not main_app.fetch.nightly_task.done()
+        assert not main_app.states.scheduler.task.done()
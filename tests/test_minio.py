@@ -0,0 +1,239 @@
+import os
+import random
+
+import pandas as pd
+import pytest
+
+import libs.minio as minio
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """Point DATA_DIR at an empty temp folder and start with an empty edit-session store."""
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    yield tmp_path
+    for center in list(minio.temp_store):
+        minio.evict_temp_center_data(center)
+
+
+def _timetables():
+    return pd.DataFrame([
+        {"period_type": "10d", "day_type": "day1", "time": "04:00", "gong_id": 1},
+        {"period_type": "10d", "day_type": "day1", "time": "21:00", "gong_id": 2},
+    ])
+
+
+# ----------------------------------------------------------------------
+# in-memory edit session: reads and writes memory, parquet written lazily
+# ----------------------------------------------------------------------
+def test_save_then_get_served_from_memory(data_dir):
+    minio.save_df_center_temp("Mahi", "timetables", _timetables())
+    assert not (data_dir / "Mahitimetables.parquet").exists()
+    df = minio.get_center_temp_df("Mahi", "timetables")
+    assert df.to_dict(orient="records") == _timetables().to_dict(orient="records")
+
+
+def test_get_returns_a_copy(data_dir):
+    minio.save_df_center_temp("Mahi", "timetables", _timetables())
+    df = minio.get_center_temp_df("Mahi", "timetables")
+    df.loc[0, "gong_id"] = 5
+    assert minio.get_center_temp_df("Mahi", "timetables").loc[0, "gong_id"] == 1
+
+
+def test_flush_writes_parquet_and_reload_after_evict(data_dir):
+    minio.save_df_center_temp("Mahi", "timetables", _timetables())
+    minio.flush_temp_center_data("Mahi")
+    assert (data_dir / "Mahitimetables.parquet").exists()
+    minio.evict_temp_center_data("Mahi")
+    assert "Mahi" not in minio.temp_store
+    assert minio.get_center_temp_df("Mahi", "timetables").to_dict(orient="records") == \
+        _timetables().to_dict(orient="records")
+
+
+def test_debounced_write_back(data_dir, monkeypatch):
+    monkeypatch.setattr(minio.utils, "Globals", minio.utils.GlobalsDefinition(TEMP_FLUSH_DELAY=0))
+    minio.save_df_center_temp("Mahi", "timetables", _timetables())
+    timer = minio.temp_timers.get("Mahi")
+    if timer:  # may already have fired and unregistered itself
+        timer.join(timeout=5)
+    assert (data_dir / "Mahitimetables.parquet").exists()
+    assert "Mahi" not in minio.temp_dirty
+
+
+def test_remove_temp_center_data_evicts_and_deletes(data_dir):
+    minio.save_df_center_temp("Mahi", "timetables", _timetables())
+    minio.flush_temp_center_data("Mahi")
+    minio.remove_temp_center_data("Mahi")
+    assert "Mahi" not in minio.temp_store
+    assert os.listdir(data_dir) == []
+
+
+# ----------------------------------------------------------------------
+# edit journal: snapshot + journal replay gives the in-memory table back
+# ----------------------------------------------------------------------
+def _journaled_mahi(data_dir):
+    minio.save_df_center_temp("Mahi", "timetables", _timetables())
+    minio.flush_temp_center_data("Mahi")
+    return data_dir / "Mahitimetables.journal.jsonl"
+
+
+def test_change_appends_journal_not_snapshot(data_dir):
+    journal = _journaled_mahi(data_dir)
+    snapshot_mtime = (data_dir / "Mahitimetables.parquet").stat().st_mtime_ns
+    new_row = {"period_type": "10d", "day_type": "day1", "time": "12:00", "gong_id": 3}
+    df = minio.change_center_temp("Mahi", "timetables", [{"op": "upsert", "rows": [new_row]}])
+    assert list(df["time"]) == ["04:00", "12:00", "21:00"]
+    assert len(journal.read_text().splitlines()) == 1
+    assert (data_dir / "Mahitimetables.parquet").stat().st_mtime_ns == snapshot_mtime
+
+
+def test_replay_after_crash_matches_memory(data_dir):
+    _journaled_mahi(data_dir)
+    minio.change_center_temp("Mahi", "timetables", [
+        {"op": "upsert", "rows": [{"period_type": "10d", "day_type": "day1", "time": "04:00", "gong_id": 9}]},
+        {"op": "delete", "keys": [["10d", "day1", "21:00"]]},
+    ])
+    in_memory = minio.get_center_temp_df("Mahi", "timetables")
+    minio.temp_store.pop("Mahi")  # process lost its memory, files are kept
+    minio.temp_journal_len.pop("Mahi")
+    replayed = minio.get_center_temp_df("Mahi", "timetables")
+    pd.testing.assert_frame_equal(replayed, in_memory, check_dtype=False)
+    assert list(replayed["gong_id"]) == [9]
+
+
+def test_journal_compacted_past_threshold(data_dir, monkeypatch):
+    monkeypatch.setattr(minio.utils, "Globals", minio.utils.GlobalsDefinition(TEMP_JOURNAL_MAX=2))
+    journal = _journaled_mahi(data_dir)
+    for time in ["05:00", "06:00", "07:00"]:
+        row = {"period_type": "10d", "day_type": "day1", "time": time, "gong_id": 1}
+        minio.change_center_temp("Mahi", "timetables", [{"op": "upsert", "rows": [row]}])
+    assert not journal.exists()
+    assert len(pd.read_parquet(data_dir / "Mahitimetables.parquet")) == 5
+
+
+# ----------------------------------------------------------------------
+# row ids and key seeks of the journaled tables
+# ----------------------------------------------------------------------
+def _row(time, gong_id=1):
+    return {"period_type": "10d", "day_type": "day1", "time": time, "gong_id": gong_id}
+
+
+def test_row_ids_stable_across_changes(data_dir):
+    _journaled_mahi(data_dir)
+    df = minio.get_center_temp_df("Mahi", "timetables")
+    ids = dict(zip(df["time"], df.index))
+    df = minio.change_center_temp("Mahi", "timetables", [{"op": "upsert", "rows": [_row("12:00")]},
+                                                         {"op": "upsert", "rows": [_row("21:00", 7)]}])
+    assert df.loc[ids["21:00"], "gong_id"] == 7  # replaced in place, same id
+    assert df.loc[ids["04:00"], "time"] == "04:00"  # not shifted by the new row before it
+    new_id = df.index[df["time"] == "12:00"][0]
+    df = minio.change_center_temp("Mahi", "timetables", [{"op": "delete", "keys": [["10d", "day1", "12:00"]]}])
+    df = minio.change_center_temp("Mahi", "timetables", [{"op": "upsert", "rows": [_row("13:00")]}])
+    assert new_id not in df.index  # a deleted id is not given again
+    assert minio.get_center_temp_row("Mahi", "timetables", new_id) is None
+
+
+def test_row_ids_replayed_after_crash(data_dir):
+    _journaled_mahi(data_dir)
+    minio.change_center_temp("Mahi", "timetables", [{"op": "upsert", "rows": [_row("12:00")]}])
+    minio.compact_temp_journal("Mahi", "timetables")
+    minio.change_center_temp("Mahi", "timetables", [{"op": "upsert", "rows": [_row("15:00")]},
+                                                     {"op": "delete", "keys": [["10d", "day1", "04:00"]]}])
+    in_memory = minio.get_center_temp_df("Mahi", "timetables")
+    for lost in [minio.temp_store, minio.temp_journal_len, minio.temp_row_ids]:  # process lost its memory
+        lost.pop("Mahi")
+    pd.testing.assert_frame_equal(minio.get_center_temp_df("Mahi", "timetables"), in_memory)
+
+
+def test_key_seek_matches_scan(data_dir):
+    rng = random.Random(18)
+    rows = [{"period_type": f"T{rng.randint(0, 5)}", "day_type": f"d{rng.randint(0, 3)}",
+             "time": f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}", "gong_id": 1} for _ in range(300)]
+    minio.save_df_center_temp("Mahi", "timetables", pd.DataFrame(rows).drop_duplicates(["period_type", "day_type", "time"]))
+    df = minio.get_center_temp_df("Mahi", "timetables")
+    for period_type in ["T0", "T3", "T9"]:
+        for day_type in [None, "d1", "d7"]:
+            key = (period_type,) if day_type is None else (period_type, day_type)
+            scanned = df[(df["period_type"] == period_type) & ((df["day_type"] == day_type) | (day_type is None))]
+            pd.testing.assert_frame_equal(minio.get_center_temp_rows("Mahi", "timetables", *key), scanned)
+
+
+# ----------------------------------------------------------------------
+# excel configuration: parsed once, re-parsed when the file changes
+# ----------------------------------------------------------------------
+def _write_config(path, location):
+    with pd.ExcelWriter(path) as writer:
+        pd.DataFrame([{"name": "location", "value": location}]).to_excel(writer, sheet_name="params", index=False)
+        pd.DataFrame([{"action": "fillin", "period_type": "Service"}]).to_excel(writer, sheet_name="inside", index=False)
+
+
+@pytest.fixture
+def read_excel_calls(monkeypatch):
+    calls = []
+    real_read_excel = pd.read_excel
+    def counting_read_excel(*args, **kwargs):
+        calls.append(args[0])
+        return real_read_excel(*args, **kwargs)
+    monkeypatch.setattr(minio.pd, "read_excel", counting_read_excel)
+    yield calls
+    minio.excel_cache.clear()
+
+
+def test_excel_parsed_once_for_all_sheets(data_dir, read_excel_calls):
+    _write_config(data_dir / "Mahi.xlsx", 1370)
+    assert minio.params_from_excel("Mahi") == {"location": 1370}
+    assert minio.dicts_from_excel("Mahi", "inside") == [{"action": "fillin", "period_type": "Service"}]
+    minio.dicts_from_excel("Mahi", "inside")[0]["action"] = "changed"
+    assert minio.dicts_from_excel("Mahi", "inside")[0]["action"] == "fillin"
+    assert len(read_excel_calls) == 1
+
+
+def test_excel_reparsed_when_file_changes(data_dir, read_excel_calls):
+    config = data_dir / "Mahi.xlsx"
+    _write_config(config, 1370)
+    minio.params_from_excel("Mahi")
+    _write_config(config, 1371)
+    os.utime(config, ns=(config.stat().st_atime_ns, config.stat().st_mtime_ns + 1_000_000))
+    assert minio.params_from_excel("Mahi") == {"location": 1371}
+    assert len(read_excel_calls) == 2
+
+
+def test_snapshot_used_once_memory_dropped(data_dir, read_excel_calls):
+    _write_config(data_dir / "Mahi.xlsx", 1370)
+    minio.params_from_excel("Mahi")
+    assert (data_dir / "Mahi.config.json").exists()
+    minio.invalidate_excel("Mahi")
+    assert minio.params_from_excel("Mahi") == {"location": 1370}
+    assert len(read_excel_calls) == 1
+
+
+def _workbook_bytes(tmp_path, **sheets):
+    path = tmp_path / "upload.xlsx"
+    with pd.ExcelWriter(path) as writer:
+        for name, rows in sheets.items():
+            pd.DataFrame(rows).to_excel(writer, sheet_name=name, index=False)
+    return path.read_bytes()
+
+
+def test_save_config_validates_and_compiles(data_dir, read_excel_calls):
+    params = [{"name": "timezon", "value": "Europe/Paris"}, {"name": "location", "value": 1396},
+              {"name": "gong_id", "value": 4}, {"name": "targets", "value": "CC"}]
+    filebuffer = _workbook_bytes(data_dir, params=params, replacement=[{"period_type": "X"}],
+                                 inside=[{"action": "fillin"}])
+    minio.save_config("Mahi", filebuffer)
+    assert (data_dir / "Mahi.xlsx").read_bytes() == filebuffer
+    assert minio.params_from_excel("Mahi")["location"] == 1396
+    minio.excel_cache.clear()
+    assert minio.params_from_excel("Mahi")["timezon"] == "Europe/Paris"
+    assert len(read_excel_calls) == 1  # the upload itself, never a reader
+
+
+def test_save_config_rejects_invalid_workbook(data_dir):
+    params = [{"name": "timezon", "value": "Mars/Olympus"}, {"name": "location", "value": 1396},
+              {"name": "gong_id", "value": 4}, {"name": "targets", "value": "CC"}]
+    with pytest.raises(ValueError, match="missing sheet"):
+        minio.save_config("Mahi", _workbook_bytes(data_dir, params=params))
+    with pytest.raises(ValueError, match="unknown timezone"):
+        minio.save_config("Mahi", _workbook_bytes(data_dir, params=params, replacement=[{"a": 1}],
+                                                  inside=[{"a": 1}]))
+    assert not (data_dir / "Mahi.xlsx").exists()
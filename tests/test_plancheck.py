@@ -0,0 +1,277 @@
+import random
+from datetime import date
+
+import pandas as pd
+import pytest
+from fastlite import database
+
+import libs.dbset as dbset
+import libs.minio as minio
+import libs.plancheck as plancheck
+import libs.utils as utils
+
+
+@pytest.fixture
+def temp_center(tmp_path, monkeypatch):
+    """Mahi edit session tables in memory, with a fixed config and no default period."""
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(minio, "config_version", lambda center: 1)
+    monkeypatch.setattr(minio, "params_from_excel", lambda center: {})
+    monkeypatch.setattr(plancheck, "durations_cache", {})
+    minio.save_df_center_temp("Mahi", "periods_struct", pd.DataFrame(STRUCT))
+    minio.save_df_center_temp("Mahi", "timetables", pd.DataFrame(TIMES))
+    yield "Mahi"
+    minio.evict_temp_center_data("Mahi")
+
+
+STRUCT = [{"period_type": "10d", "day": d, "day_type": "day0" if d == 0 else "day"} for d in range(11)] + \
+         [{"period_type": "Service", "day": 0, "day_type": "repeat"}]
+TIMES = [{"period_type": "10d", "day_type": "day0", "time": "18:00", "gong_id": 1},
+         {"period_type": "10d", "day_type": "day", "time": "04:00", "gong_id": 1},
+         {"period_type": "10d", "day_type": "day", "time": "21:00", "gong_id": 1},
+         {"period_type": "Service", "day_type": "repeat", "time": "06:00", "gong_id": 1}]
+
+
+# ----------------------------------------------------------------------
+# get_types_with_duration: one pass per table, memoized per data version
+# ----------------------------------------------------------------------
+def _scan_types_with_duration(periods_structs, timetables, default_period):
+    """The per-type scanning computation the grouped one replaces, kept as the reference."""
+    types_duration = []
+    for vt in pd.DataFrame(periods_structs)["period_type"].unique():
+        item = {"period_type": vt}
+        days = [r["day"] for r in periods_structs if r["period_type"] == vt and r["day"] is not None]
+        item["duration"] = max(days) + 1
+        day_0_type = next((r["day_type"] for r in periods_structs if r["period_type"] == vt and r["day"] == 0), None)
+        item["time_start_first_day"] = min((r["time"] for r in timetables
+                                            if r["period_type"] == vt and r["day_type"] == day_0_type), default=None)
+        last_day_type = next((r["day_type"] for r in periods_structs
+                              if r["period_type"] == vt and r["day"] == max(days)), None)
+        item["time_end_last_day"] = max((r["time"] for r in timetables
+                                         if r["period_type"] == vt and r["day_type"] == last_day_type), default=None)
+        item["tags"] = "F" if "repeat" not in last_day_type else "X" if default_period == vt else "V"
+        types_duration.append(item)
+    return sorted(sorted(types_duration, key=lambda x: x["duration"], reverse=True), key=lambda x: x["tags"])
+
+
+def random_center_tables(rng, num_types, num_times):
+    periods_structs, timetables = [], []
+    for t in range(num_types):
+        day_types = ["first", "middle", "repeat" if rng.random() < 0.3 else "last"]
+        for day in range(rng.randint(1, 12)):
+            periods_structs.append({"period_type": f"T{t}", "day": day, "day_type": rng.choice(day_types)})
+        for _ in range(num_times):
+            timetables.append({"period_type": f"T{t}", "day_type": rng.choice(day_types),
+                               "time": f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}"})
+    rng.shuffle(periods_structs)
+    return periods_structs, timetables
+
+
+def test_types_with_duration_matches_scan():
+    rng = random.Random(11)
+    for _ in range(100):
+        periods_structs, timetables = random_center_tables(rng, rng.randint(1, 8), rng.randint(0, 6))
+        assert plancheck.compute_types_with_duration(periods_structs, timetables, "T1") == \
+            _scan_types_with_duration(periods_structs, timetables, "T1")
+
+
+def test_types_with_duration_of_edit_session(temp_center):
+    types = {t["period_type"]: t for t in plancheck.get_types_with_duration(temp_center)}
+    assert types["10d"] == {"period_type": "10d", "duration": 11, "time_start_first_day": "18:00",
+                            "time_end_last_day": "21:00", "tags": "F"}
+    assert types["Service"]["tags"] == "V"
+
+
+def test_types_with_duration_memoized_until_tables_change(temp_center, monkeypatch):
+    reads = []
+    real_read = minio.get_center_temp_list_of_dicts
+    monkeypatch.setattr(minio, "get_center_temp_list_of_dicts",
+                        lambda center, key: reads.append(key) or real_read(center, key))
+    first = plancheck.get_types_with_duration(temp_center)
+    first[0]["duration"] = 99  # callers get their own copies
+    assert plancheck.get_types_with_duration(temp_center)[0]["duration"] != 99
+    assert len(reads) == 2
+    minio.change_center_temp(temp_center, "periods_struct",
+                             [{"op": "upsert", "rows": [{"period_type": "10d", "day": 11, "day_type": "day"}]}])
+    types = {t["period_type"]: t for t in plancheck.get_types_with_duration(temp_center)}
+    assert types["10d"]["duration"] == 12
+    assert len(reads) == 4
+
+
+@pytest.fixture
+def saved_db(temp_center, tmp_path, monkeypatch):
+    """Mahi ok.db with the edit session tables and the period_types summary written on save."""
+    db = database(str(tmp_path / dbset.gong_db_name(temp_center)))
+    db.create(dbset.Periods_struct, pk=("period_type", "day")).insert_all(STRUCT)
+    db.create(dbset.Timetables, pk=("period_type", "day_type", "time")).insert_all(TIMES)
+    summary = plancheck.compute_types_with_duration(STRUCT, TIMES, "Service")
+    db.create(dbset.Period_types, pk="period_type").insert_all(summary)
+    computed = []
+    real_compute = plancheck.compute_types_with_duration
+    monkeypatch.setattr(plancheck, "compute_types_with_duration",
+                        lambda *args: computed.append(args) or real_compute(*args))
+    yield db, computed
+    db.close()
+
+
+def test_types_with_duration_read_from_saved_table(saved_db):
+    db, computed = saved_db
+    assert plancheck.get_types_with_duration("Mahi", source="db") == \
+        _scan_types_with_duration(STRUCT, TIMES, "")  # default period of the current params
+    assert computed == []
+
+
+def test_types_with_duration_computed_when_table_drifts(saved_db):
+    db, computed = saved_db
+    db.t.periods_struct.insert(period_type="10d", day=11, day_type="day")
+    types = {t["period_type"]: t for t in plancheck.get_types_with_duration("Mahi", source="db")}
+    assert types["10d"]["duration"] == 12
+    assert len(computed) == 1
+
+
+# ----------------------------------------------------------------------
+# check_plan: array checks give the strings and verdict of the row loop
+# ----------------------------------------------------------------------
+def _loop_check_plan(plan, types_with_duration, period_types_in_db):
+    """The row-by-row check the vectorized one replaces, kept as the reference."""
+    default_period = next((t for t in types_with_duration if t.get("tags") == "X"), {}).get("period_type", "")
+    plan_ok = True
+    for idx, row in enumerate(plan):
+        pt = row.get("period_type")
+        if idx == len(plan) - 1:
+            row["check"] = "NoType" if pt not in period_types_in_db else "OK"
+            plan_ok = plan_ok and row["check"] == "OK"
+            continue
+        next_start_date = plan[idx + 1].get("start_date")
+        pt_is_variable = next((t for t in types_with_duration if t.get("period_type") == pt),
+                              {"tags": ""}).get("tags") in "VX"
+        delta_days = utils.days_between_iso_dates(row.get("end_date"), next_start_date)
+        if pt not in period_types_in_db:
+            row["check"] = "NoType"
+        elif row.get("start_date") == next_start_date:
+            row["check"] = "Same starting date"
+        elif delta_days < 0 and pt_is_variable:
+            row["check"] = f"CHECK Overlap of {- delta_days} day(s)"
+        elif delta_days < 0 and not pt_is_variable:
+            row["check"] = f"Overlap of {- delta_days} day(s)"
+        elif delta_days == 0:
+            this_end_time = next((t.get("time_end_last_day") for t in types_with_duration
+                                  if t.get("period_type") == pt), None)
+            next_pt = plan[idx + 1].get("period_type")
+            next_start_time = next((t.get("time_start_first_day") for t in types_with_duration
+                                    if t.get("period_type") == next_pt), None)
+            if this_end_time is None or next_start_time is None:
+                row["check"] = "Missing time info"
+            elif this_end_time > next_start_time:
+                row["check"] = "OK Time overlap" if pt_is_variable or next_pt == default_period \
+                    else "CHECK Time overtap"
+            else:
+                row["check"] = "OK same day"
+        elif delta_days > 1:
+            row["check"] = f"CHECK GAP {delta_days} days"
+        else:
+            row["check"] = "OK"
+        if not (row["check"].startswith("OK") or row["check"].startswith("CHECK")):
+            plan_ok = False
+    return [row["check"] for row in plan], plan_ok
+
+
+def random_plan(rng, period_types, num_rows):
+    plan, day = [], date(2025, 1, 1).toordinal()
+    for _ in range(num_rows):
+        day += rng.choice([0, 1, 2, 5, 9, 12])
+        plan.append({"start_date": date.fromordinal(day).isoformat(),
+                     "end_date": date.fromordinal(day + rng.randint(0, 14)).isoformat(),
+                     "period_type": rng.choice(period_types)})
+    return plan
+
+
+def test_check_plan_matches_row_loop(monkeypatch):
+    rng = random.Random(12)
+    for _ in range(200):
+        periods_structs, timetables = random_center_tables(rng, rng.randint(1, 6), rng.randint(0, 3))
+        types = plancheck.compute_types_with_duration(periods_structs, timetables, "T1")
+        in_db = pd.DataFrame(periods_structs)["period_type"].unique()
+        plan = random_plan(rng, list(in_db) + ["Unknown"], rng.randint(0, 30))
+        monkeypatch.setattr(plancheck, "get_types_with_duration", lambda center: types)
+        monkeypatch.setattr(plancheck, "get_period_types_list", lambda center: in_db)
+        session = {}
+        checked = plancheck.check_plan(session, [dict(row) for row in plan], "Mahi")
+        assert ([row["check"] for row in checked], session[utils.Skey.PLANOK]) == \
+            _loop_check_plan(plan, types, in_db)
+
+
+def test_recheck_rows_matches_full_check(monkeypatch):
+    rng = random.Random(13)
+    for _ in range(200):
+        periods_structs, timetables = random_center_tables(rng, rng.randint(1, 6), rng.randint(0, 3))
+        types = plancheck.compute_types_with_duration(periods_structs, timetables, "T1")
+        in_db = pd.DataFrame(periods_structs)["period_type"].unique()
+        monkeypatch.setattr(plancheck, "get_types_with_duration", lambda center: types)
+        monkeypatch.setattr(plancheck, "get_period_types_list", lambda center: in_db)
+        plan = random_plan(rng, list(in_db) + ["Unknown"], rng.randint(1, 20))
+        plancheck.check_plan({}, plan, "Mahi")
+        changed = rng.randrange(len(plan))
+        plan[changed]["period_type"] = rng.choice(list(in_db) + ["Unknown"])
+        session = {}
+        plancheck.recheck_rows(session, plan, changed, changed, "Mahi")
+        full = plancheck.plan_checks(plan, types, in_db)
+        assert [row["check"] for row in plan] == full
+        assert session[utils.Skey.PLANOK] == plancheck.checks_ok(full)
+
+
+# ----------------------------------------------------------------------
+# coming_center_courses: last course before today and the following ones, in SQL
+# ----------------------------------------------------------------------
+@pytest.fixture
+def center_db(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(plancheck, "add_end_dates", lambda plan, center, source="df": plan)
+    db = database(str(tmp_path / "mahi.ok.db"))
+    db.create(dbset.Coming_periods, pk="start_date")
+    yield db
+    db.close()
+
+
+def _days_from_today(days):
+    return date.fromordinal(date.today().toordinal() + days).isoformat()
+
+
+def test_coming_courses_start_at_current_course(center_db):
+    for days in [-400, -30, -3, 5, 40]:
+        center_db.t.coming_periods.insert(start_date=_days_from_today(days), period_type="10d")
+    periods, current = plancheck.coming_center_courses("Mahi")
+    assert current == _days_from_today(-3)
+    assert [p["start_date"] for p in periods] == [_days_from_today(d) for d in [-3, 5, 40]]
+    assert periods[0]["source"] == "mahi.ok.db"
+
+
+def test_coming_courses_all_in_future(center_db):
+    for days in [40, 5]:
+        center_db.t.coming_periods.insert(start_date=_days_from_today(days), period_type="10d")
+    periods, current = plancheck.coming_center_courses("Mahi")
+    assert current == _days_from_today(5)
+    assert len(periods) == 2
+
+
+def test_coming_courses_end_dates_from_saved_db(saved_db):
+    db, _ = saved_db
+    minio.remove_temp_center_data("Mahi")  # not being edited: no edit session tables
+    db.create(dbset.Coming_periods, pk="start_date")
+    for days in [-3, 5]:
+        db.t.coming_periods.insert(start_date=_days_from_today(days), period_type="10d")
+    periods, _ = plancheck.coming_center_courses("Mahi", "db")
+    assert [p["end_date"] for p in periods] == [_days_from_today(-3 + 10), _days_from_today(5 + 10)]
+
+
+def test_gong_db_indexes_added_only_when_missing(tmp_path):
+    db = database(str(tmp_path / "old.db"))
+    db.execute("CREATE TABLE coming_periods (start_date TEXT, period_type TEXT)")
+    db.create(dbset.Periods_struct, pk=("period_type", "day"))
+    db.create(dbset.Timetables, pk=("period_type", "day_type", "time"))
+    dbset.ensure_gong_db_indexes(db)
+    dbset.ensure_gong_db_indexes(db)
+    names = [r["name"] for r in db.q("SELECT name FROM sqlite_master WHERE type = 'index'")]
+    assert "idx_coming_periods_key" in names
+    assert not [n for n in names if n.startswith("idx_") and n != "idx_coming_periods_key"]
+    db.close()
@@ -0,0 +1,217 @@
+import asyncio
+import os
+import shutil
+import threading
+import time
+from unittest.mock import Mock
+
+import pandas as pd
+import pytest
+from fastlite import database
+
+import libs.minio as minio
+import libs.planning as planning
+import libs.plancheck as plancheck
+import libs.transit as transit
+import libs.utils as utils
+
+
+@pytest.fixture
+def mahi_session(tmp_path, monkeypatch):
+    """Mahi edit session loaded from the test ok.db, with a fixed config."""
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(minio, "params_from_excel", lambda center: {})
+    monkeypatch.setattr(minio, "config_version", lambda center: 1)
+    shutil.copy("tests/data/mahi.ok.db", tmp_path / "mahi.ok.db")
+    db = database(str(tmp_path / "mahi.ok.db"))
+    minio.save_df_center_temp("Mahi", "periods_struct", pd.DataFrame(list(db.t.periods_struct())))
+    minio.save_df_center_temp("Mahi", "timetables", pd.DataFrame(list(db.t.timetables())))
+    minio.save_df_center_temp("Mahi", "planning", pd.DataFrame(
+        [{"start_date": f"2027-{m:02d}-01", "period_type": "10-Day", "source": "dhamma.org"} for m in range(1, 13)]))
+    db.close()
+    yield tmp_path
+    minio.evict_temp_center_data("Mahi")
+
+
+def _insert_reference(db, rows):
+    """The per-record inserts the bulk build replaces, kept as the reference."""
+    for table, cls, pk in planning.SENDING_DB_TABLES:
+        db.execute(f"DROP TABLE IF EXISTS {table}")
+        created = db.create(cls, pk=pk)
+        for record in rows[table]:
+            created.insert(**{c: record[c] for c in cls.__annotations__})
+
+
+# ----------------------------------------------------------------------
+# sending db: bulk build in one transaction, compacted by VACUUM INTO
+# ----------------------------------------------------------------------
+def test_sending_db_matches_record_inserts(mahi_session):
+    source = str(mahi_session / "mahi.ok.db")
+    planning.write_sending_db("Mahi", source, str(mahi_session / "mahi.sending.db"))
+    shutil.copy(source, mahi_session / "reference.db")
+    reference = database(str(mahi_session / "reference.db"))
+    _insert_reference(reference, planning.sending_db_rows("Mahi"))
+    sent = database(str(mahi_session / "mahi.sending.db"))
+    for table in [t for t in reference.table_names() if not t.startswith("sqlite_")]:
+        assert list(sent.t[table]()) == list(reference.t[table]()), table
+    assert len(list(sent.t.coming_periods())) == 12
+    assert sent.q("PRAGMA page_size")[0]["page_size"] == 1024
+    assert sent.q("PRAGMA freelist_count")[0]["freelist_count"] == 0
+    assert not [name for name in os.listdir(mahi_session) if ".build" in name]
+    sent.close()
+    reference.close()
+
+
+def test_sending_db_replaces_previous_one(mahi_session):
+    source = str(mahi_session / "mahi.ok.db")
+    dest = str(mahi_session / "mahi.sending.db")
+    (mahi_session / "mahi.sending.db.build").write_text("left by a failed build")
+    planning.write_sending_db("Mahi", source, dest)
+    planning.write_sending_db("Mahi", source, dest)
+    sent = database(dest)
+    assert list(sent.t.period_types()) == plancheck.get_types_with_duration("Mahi")
+    assert not os.path.exists(dest + ".build")
+    sent.close()
+
+
+# ----------------------------------------------------------------------
+# save off the event loop: the loop keeps serving while a center saves
+# ----------------------------------------------------------------------
+def test_event_loop_responsive_during_save(mahi_session, monkeypatch):
+    real_rows = planning.sending_db_rows
+    def slow_rows(center_name):
+        time.sleep(0.5)  # a big center: the loop would be blocked this long if run on it
+        return real_rows(center_name)
+    monkeypatch.setattr(planning, "sending_db_rows", slow_rows)
+    reports = []
+    def progress(done, total, step):
+        reports.append((done, total, step, threading.get_ident()))
+
+    async def save_while_ticking():
+        lags = []
+        async def ticker():
+            while True:
+                before = time.perf_counter()
+                await asyncio.sleep(0.01)
+                lags.append(time.perf_counter() - before - 0.01)
+        ticking = asyncio.create_task(ticker())
+        filename = await planning.save_db_plan_timetable("Mahi", progress)
+        await asyncio.sleep(0)  # the last progress report is queued on the loop
+        ticking.cancel()
+        return filename, lags, threading.get_ident()
+
+    filename, lags, loop_thread = asyncio.run(save_while_ticking())
+    assert filename == "mahi.sending.db"
+    assert len(lags) > 20 and max(lags) < 0.1
+    assert [r[:2] for r in reports] == [(done, 6) for done in range(1, 7)]
+    assert {r[3] for r in reports} == {loop_thread}
+
+
+# ----------------------------------------------------------------------
+# promotion of the sending db: checksummed, atomic, ring of previous versions
+# ----------------------------------------------------------------------
+def _send_db(tmp_path, content, date):
+    (tmp_path / "mahi.sending.db").write_bytes(content)
+    transit.record_sending_db("Mahi", "mahi.sending.db")
+    transit.promote_db_file("Mahi", "mahi.sending.db", date)
+
+
+def test_promote_keeps_previous_versions(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    (tmp_path / "mahi.ok.db").write_bytes(b"v0")
+    for version in range(1, 6):
+        _send_db(tmp_path, f"v{version}".encode(), f"2027-01-0{version}")
+    assert (tmp_path / "mahi.ok.db").read_bytes() == b"v5"
+    assert not (tmp_path / "mahi.sending.db").exists()
+    kept = [(tmp_path / f"mahi.old{i}.db").read_bytes() for i in range(1, utils.Globals.OK_DB_VERSIONS + 1)]
+    assert kept == [b"v4", b"v3", b"v2"]
+    assert not (tmp_path / "mahi.old4.db").exists()
+    manifest = transit.read_manifest("Mahi")
+    assert manifest["ok"]["sha256"] == transit.db_file_sha256(tmp_path / "mahi.ok.db")
+    assert [p["date"] for p in manifest["previous"]] == ["2027-01-04", "2027-01-03", "2027-01-02"]
+    assert [p["file"] for p in manifest["previous"]] == ["mahi.old1.db", "mahi.old2.db", "mahi.old3.db"]
+
+
+def test_promote_refuses_changed_sending_db(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    (tmp_path / "mahi.ok.db").write_bytes(b"v0")
+    (tmp_path / "mahi.sending.db").write_bytes(b"v1")
+    transit.record_sending_db("Mahi", "mahi.sending.db")
+    (tmp_path / "mahi.sending.db").write_bytes(b"v1, truncated")
+    assert transit.promote_db_file("Mahi", "mahi.sending.db", "2027-01-01") == \
+        {"error": "sending_db_changed", "file": "mahi.sending.db"}
+    assert (tmp_path / "mahi.ok.db").read_bytes() == b"v0"
+    assert not (tmp_path / "mahi.old1.db").exists()
+
+
+def test_rollback_puts_back_previous_version(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    (tmp_path / "mahi.ok.db").write_bytes(b"v0")
+    for version in range(1, 4):
+        _send_db(tmp_path, f"v{version}".encode(), f"2027-01-0{version}")
+    assert transit.rollback_db_file("Mahi") == {"success": "db_rolled_back", "date": "2027-01-02"}
+    assert (tmp_path / "mahi.ok.db").read_bytes() == b"v2"
+    assert (tmp_path / "mahi.old1.db").read_bytes() == b"v1"
+    assert (tmp_path / "mahi.old2.db").read_bytes() == b"v0"
+    assert not (tmp_path / "mahi.old3.db").exists()
+    (tmp_path / "mahi.old1.db").write_bytes(b"v1, damaged")
+    assert transit.rollback_db_file("Mahi") == {"error": "previous_db_corrupted"}
+    (tmp_path / "mahi.old1.db").unlink()
+    (tmp_path / "mahi.old2.db").unlink()
+    assert transit.rollback_db_file("Mahi") == {"error": "no_previous_db"}
+    assert (tmp_path / "mahi.ok.db").read_bytes() == b"v2"
+
+
+def test_promotion_stopped_after_shift_is_reconciled(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    (tmp_path / "mahi.ok.db").write_bytes(b"v0")
+    for version in range(1, 3):
+        _send_db(tmp_path, f"v{version}".encode(), f"2027-01-0{version}")
+    real_replace = os.replace
+    def crash_on_ok(src, dst):
+        if str(dst).endswith("mahi.ok.db"):
+            raise OSError("power cut")
+        real_replace(src, dst)
+    (tmp_path / "mahi.sending.db").write_bytes(b"v3")
+    transit.record_sending_db("Mahi", "mahi.sending.db")
+    monkeypatch.setattr(transit.os, "replace", crash_on_ok)
+    with pytest.raises(OSError):
+        transit.promote_db_file("Mahi", "mahi.sending.db", "2027-01-03")  # ring shifted, ok db linked as old1
+    monkeypatch.setattr(transit.os, "replace", real_replace)
+    assert [(tmp_path / f"mahi.old{i}.db").read_bytes() for i in (1, 2, 3)] == [b"v2", b"v1", b"v0"]
+
+    assert transit.promote_db_file("Mahi", "mahi.sending.db", "2027-01-03") == {"success": "db_promoted"}
+    assert [(tmp_path / f"mahi.old{i}.db").read_bytes() for i in (1, 2, 3)] == [b"v2", b"v1", b"v0"]
+    manifest = transit.read_manifest("Mahi")
+    assert [p["date"] for p in manifest["previous"]] == ["2027-01-02", "2027-01-01", ""]
+    assert transit.rollback_db_file("Mahi") == {"success": "db_rolled_back", "date": "2027-01-02"}
+    assert (tmp_path / "mahi.ok.db").read_bytes() == b"v2"
+
+
+def test_rollback_after_stopped_promotion(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    (tmp_path / "mahi.ok.db").write_bytes(b"v0")
+    for version in range(1, 3):
+        _send_db(tmp_path, f"v{version}".encode(), f"2027-01-0{version}")
+    (tmp_path / "mahi.sending.db").write_bytes(b"v3")
+    transit.record_sending_db("Mahi", "mahi.sending.db")
+    monkeypatch.setattr(transit, "keep_ok_db_as_old1", Mock(side_effect=OSError("power cut")))
+    with pytest.raises(OSError):
+        transit.promote_db_file("Mahi", "mahi.sending.db", "2027-01-03")  # stopped right after the shift
+    assert not (tmp_path / "mahi.old1.db").exists()
+    assert transit.rollback_db_file("Mahi") == {"success": "db_rolled_back", "date": "2027-01-01"}
+    assert (tmp_path / "mahi.ok.db").read_bytes() == b"v1"
+    assert (tmp_path / "mahi.old1.db").read_bytes() == b"v0"
+
+
+def test_promote_moves_legacy_old_db_into_ring(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    (tmp_path / "mahi.old.db").write_bytes(b"v-1")
+    (tmp_path / "mahi.ok.db").write_bytes(b"v0")
+    _send_db(tmp_path, b"v1", "2027-01-01")
+    assert not (tmp_path / "mahi.old.db").exists()
+    assert [(tmp_path / f"mahi.old{i}.db").read_bytes() for i in (1, 2)] == [b"v0", b"v-1"]
+    assert [p["file"] for p in transit.read_manifest("Mahi")["previous"]] == ["mahi.old1.db", "mahi.old2.db"]
+    assert transit.rollback_db_file("Mahi")["success"] == "db_rolled_back"
+    assert transit.rollback_db_file("Mahi")["success"] == "db_rolled_back"
+    assert (tmp_path / "mahi.ok.db").read_bytes() == b"v-1"
@@ -0,0 +1,217 @@
+import asyncio
+
+import pytest
+
+import libs.dbset as dbset
+import libs.states as states
+import libs.transit as transit
+import libs.utils as utils
+
+
+@pytest.fixture
+def mahi_machine(tables):
+    """Mahi state machine on the in-memory central db, with its statements on the center table recorded."""
+    db, _, _, centers, _ = tables
+    statements = []
+    def trace(cursor, sql, bindings):
+        if "[center]" in sql and not sql.startswith("PRAGMA"):
+            statements.append(sql.split()[0].lower())
+        return True
+    db.conn.exec_trace = trace
+    db.create(dbset.Scheduled_event, pk="send_id")
+    states.add_center_state_machine("Mahi", db)
+    yield states.csms["Mahi"], centers, statements
+    states.delete_state_machine("Mahi")
+
+
+@pytest.fixture
+def send_steps(monkeypatch):
+    """save_db, wait_01 and transfer steps without files nor minio: the transfer fails."""
+    delays = {"wait": 10}
+    async def save_db(model):
+        model.update_attr("save_db_filename", "mahi.sending.db")
+        return {"success": "saved"}
+    async def get_delay(model, until_hour, minutes=0):
+        return {"success": "waiting"}, delays["wait"]
+    async def transfer(model):
+        model.update_attr("center_save_date", "2027-01-01")
+        return {"error": "transfer failed"}
+    monkeypatch.setattr(transit, "save_db_plan_times", save_db)
+    monkeypatch.setattr(transit, "get_delay", get_delay)
+    monkeypatch.setattr(transit, "transfer_new_db", transfer)
+    return delays
+
+
+def _updates(statements):
+    return statements.count("update")
+
+
+async def _until_state(sm, state_id, timeout=2):
+    for _ in range(int(timeout / 0.01)):
+        if sm.configuration[-1].id == state_id:
+            return
+        await asyncio.sleep(0.01)
+    raise TimeoutError(f"{sm.model.center_name} still in {sm.configuration[-1].id}")
+
+
+# ----------------------------------------------------------------------
+# center row: one unit of work per transition, cached reads revalidated
+# ----------------------------------------------------------------------
+def test_transition_writes_row_once(mahi_machine):
+    sm, centers, statements = mahi_machine
+
+    async def edit_then_abandon():
+        await sm.activate_initial_state()
+        statements.clear()
+        sm.model.update_attr("created_by", "planner@example.com")  # outside a transition: written at once
+        assert _updates(statements) == 1
+        statements.clear()
+        await sm.send("progress")
+        assert _updates(statements) == 1
+        statements.clear()
+        await sm.send("abandon_changes")  # state, status_start and created_by of on_enter_free
+        assert _updates(statements) == 1
+
+    asyncio.run(edit_then_abandon())
+    row = centers["Mahi"]
+    assert (row.status, row.created_by) == ("free", None)
+    assert row.status_start == sm.model.get_center_attr("status_start")
+
+
+def test_chained_transitions_each_write_once(mahi_machine, send_steps):
+    sm, centers, statements = mahi_machine
+
+    async def send_to_center():
+        await states.scheduler.start(sm.model.db)
+        await sm.activate_initial_state()
+        await sm.send("progress")
+        statements.clear()
+        await sm.send("progress")  # edit -> save_db -> wait_01, then transfer -> w_reco_trans sent by the scheduler
+        await _until_state(sm, "w_reco_trans")
+        assert _updates(statements) == 4
+        states.scheduler.task.cancel()
+
+    asyncio.run(send_to_center())
+    row = centers["Mahi"]
+    assert (row.status, row.save_db_filename, row.center_save_date) == ("w_reco_trans", "mahi.sending.db", "2027-01-01")
+
+
+def test_center_row_read_again_when_stale(mahi_machine, monkeypatch):
+    sm, centers, statements = mahi_machine
+    clock = [sm.model.row_read_at]  # the state was read when the machine was built
+    monkeypatch.setattr(states.time, "monotonic", lambda: clock[0])
+    assert sm.model.get_center_attr("pi_db_date") is None
+    centers.update(center_name="Mahi", pi_db_date="2027-01-01")  # written by another process
+    statements.clear()
+    clock[0] += utils.Globals.CENTER_ROW_TTL / 2
+    assert sm.model.get_center_attr("pi_db_date") is None
+    assert statements == []
+    clock[0] += utils.Globals.CENTER_ROW_TTL
+    assert sm.model.get_center_attr("pi_db_date") == "2027-01-01"
+    assert statements == ["select"]
+
+
+# ----------------------------------------------------------------------
+# startup: all center rows read by one query, machines built on first access
+# ----------------------------------------------------------------------
+def test_startup_reads_centers_once(tables):
+    db, _, _, centers, _ = tables
+    centers.update(center_name="Pajjota", status="edit", created_by="planner@example.com")
+    statements = []
+    db.conn.exec_trace = lambda cursor, sql, bindings: statements.append(sql) or True
+    states.init_center_state_machines(db)
+    assert [s for s in statements if "[center]" in s and not s.startswith("PRAGMA")] == ["select * from [center]"]
+    assert dict.keys(states.csms) == set()
+    statements.clear()
+    sm = states.csms["Pajjota"]
+    assert sm.configuration[0].id == "edit"
+    assert sm.model.get_center_attr("created_by") == "planner@example.com"
+    assert [s for s in statements if not s.startswith("PRAGMA")] == []
+    assert states.csms["Pajjota"] is sm
+    assert isinstance(states.clocks["Pajjota"], asyncio.Lock)
+    with pytest.raises(KeyError):
+        states.csms["Unknown"]
+    states.delete_state_machine("Mahi")  # never built
+    with pytest.raises(KeyError):
+        states.csms["Mahi"]
+    states.csms.clear()
+
+
+# ----------------------------------------------------------------------
+# scheduler: delayed events persisted, re-armed at startup, cancelled by send_id
+# ----------------------------------------------------------------------
+def test_waiting_state_does_not_block_send(mahi_machine, send_steps):
+    sm, _, _ = mahi_machine
+    send_steps["wait"] = 3_600_000
+    scheduled = sm.model.db.t.scheduled_event
+
+    async def wait_then_free():
+        await states.scheduler.start(sm.model.db)
+        await sm.activate_initial_state()
+        await sm.send("progress")
+        await asyncio.wait_for(sm.send("progress"), 1)
+        assert sm.configuration[-1].id == "wait_01"
+        assert [(r["send_id"], r["event"]) for r in scheduled()] == [("Mahi_wait01", "progress")]
+        await sm.send("force_to_free")  # on_exit_wait_01 cancels the delayed progress
+        assert scheduled() == [] and states.scheduler.events == {}
+        states.scheduler.task.cancel()
+
+    asyncio.run(wait_then_free())
+
+
+def test_scheduler_rearmed_at_startup(tables, send_steps):
+    db, _, _, centers, _ = tables
+    db.create(dbset.Scheduled_event, pk="send_id")
+    scheduled = db.t.scheduled_event
+    centers.update(center_name="Mahi", status="send_to_center,wait_01")
+    centers.update(center_name="Pajjota", status="send_to_center,wait_01")
+    scheduled.insert(send_id="Mahi_wait01", center_name="Mahi", event="progress",
+                     due_at="2026-01-01T00:40:00+00:00")  # due while the server was down
+    scheduled.insert(send_id="Pajjota_wait01", center_name="Pajjota", event="progress",
+                     due_at="2099-01-01T00:40:00+00:00")
+    states.init_center_state_machines(db)
+
+    async def restart():
+        await states.scheduler.start(db)
+        await _until_state(states.csms["Mahi"], "w_reco_trans")
+        assert states.csms["Pajjota"].configuration[-1].id == "wait_01"
+        assert [r["send_id"] for r in scheduled()] == ["Pajjota_wait01"]
+        states.scheduler.task.cancel()
+
+    asyncio.run(restart())
+    states.csms.clear()
+
+
+def test_scheduler_pops_due_events_in_order():
+    scheduler = states.EventScheduler()
+    for name, delay in [("A", 30), ("B", 10), ("C", 20), ("D", 40)]:
+        scheduler.push(f"{name}_wait01", 1000 + delay, name, "progress")
+    scheduler.push("B_wait01", 1035, "B", "progress")  # scheduled again: the first due time is dropped
+    scheduler.events.pop("C_wait01")                    # cancelled
+    due = scheduler.pop_due(1036)
+    assert [d[0] for d in due] == ["A_wait01", "B_wait01"]
+    assert list(scheduler.events) == ["D_wait01"]
+
+
+def test_scheduled_row_kept_until_event_delivered(tables, monkeypatch):
+    db, _, _, _, _ = tables
+    db.create(dbset.Scheduled_event, pk="send_id")
+    delivered = []
+    class Machine:
+        async def send(self, event):
+            assert [r["send_id"] for r in db.t.scheduled_event()] == ["Mahi_wait01"]  # a restart now sends it again
+            delivered.append(event)
+    monkeypatch.setattr(states, "csms", {"Mahi": Machine()})
+
+    async def deliver():
+        await states.scheduler.start(db)
+        states.scheduler.schedule("Mahi", "progress", 10, "Mahi_wait01")
+        for _ in range(100):
+            if delivered and not states.scheduler.sending:
+                break
+            await asyncio.sleep(0.01)
+        states.scheduler.task.cancel()
+
+    asyncio.run(deliver())
+    assert delivered == ["progress"]
+    assert db.t.scheduled_event() == []
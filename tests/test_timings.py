@@ -0,0 +1,246 @@
+import random
+
+import pandas as pd
+import pytest
+from fasthtml.common import to_xml
+
+import libs.minio as minio
+import libs.timechan as timechan
+import libs.timings as timings
+import libs.utils as utils
+
+
+@pytest.fixture
+def edit_session(tmp_path, monkeypatch):
+    """An empty Mahi edit session with its timings validators reset."""
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(timings, "timings_validators", {})
+    yield {utils.Skey.CENTER: "Mahi"}
+    minio.evict_temp_center_data("Mahi")
+
+
+def _frame_check_timings(periods_struct_df, gongs_df, targets_df, timetables_df):
+    """The whole-table pandas checks the validator replaces, kept as the reference."""
+    errors_df = pd.DataFrame(columns=["period_type", "error", "day_type", "time", "gong_id", "targets"])
+    for period_type, day_numbers in periods_struct_df.groupby("period_type")["day"].apply(set).to_dict().items():
+        if 0 not in day_numbers:
+            errors_df.loc[len(errors_df)] = {"period_type": period_type, "error": "No day 0"}
+        if max(day_numbers) - min(day_numbers) + 1 != len(day_numbers):
+            errors_df.loc[len(errors_df)] = {"period_type": period_type, "error": "Non-consecutive day numbers"}
+    valid_pairs = set(zip(timetables_df["period_type"], timetables_df["day_type"]))
+    mask = [p not in valid_pairs for p in zip(periods_struct_df["period_type"], periods_struct_df["day_type"])]
+    invalid_day_types = periods_struct_df.loc[mask, ["period_type", "day_type"]]
+    invalid_day_types["error"] = "No timetable entry for this day type"
+    invalid_gongs = timetables_df.loc[~timetables_df["gong_id"].isin(gongs_df["id"]),
+                                      ["period_type", "day_type", "time", "gong_id"]]
+    invalid_gongs["error"] = "Invalid gong_id"
+    duplicated_times = timetables_df[timetables_df.duplicated(subset=["period_type", "day_type", "time"], keep=False)]
+    duplicated_times = duplicated_times[["period_type", "day_type", "time"]]
+    duplicated_times["error"] = "Duplicated time"
+    valid_targets = set(targets_df["shortname"])
+    invalid_targets = timetables_df.loc[
+        ~timetables_df["targets"].str.split().apply(lambda t: set(t).issubset(valid_targets)),
+        ["period_type", "day_type", "time", "targets"]]
+    invalid_targets["error"] = "At least one invalid target"
+    errors_df = pd.concat([errors_df, invalid_day_types, duplicated_times, invalid_gongs, invalid_targets],
+                          ignore_index=True).fillna("")
+    errors_df["gong_id"] = errors_df["gong_id"].apply(lambda x: int(x) if isinstance(x, float) and pd.notna(x) else x)
+    return errors_df
+
+
+def _as_set(errors_df):
+    return sorted(tuple(str(v) for v in row) for row in errors_df.itertuples(index=False))
+
+
+def random_timings(rng, num_types):
+    periods_struct, timetables = [], []
+    for t in range(num_types):
+        day_types = ["first", "day", "last"]
+        for day in rng.sample(range(8), rng.randint(1, 6)):
+            periods_struct.append({"period_type": f"T{t}", "day": day, "day_type": rng.choice(day_types)})
+        for _ in range(rng.randint(0, 6)):
+            timetables.append(random_time_row(rng, f"T{t}", rng.choice(day_types)))
+    return periods_struct, timetables
+
+
+def random_time_row(rng, period_type, day_type):
+    return {"period_type": period_type, "day_type": day_type, "time": f"{rng.randint(4, 6):02d}:00",
+            "gong_id": rng.randint(1, 4), "auto": 0,
+            "targets": " ".join(rng.sample(["CC", "FH", "XX"], rng.randint(0, 2))), "comment": ""}
+
+
+TIMETABLE_COLUMNS = ["period_type", "day_type", "time", "gong_id", "auto", "targets", "comment"]
+
+
+def save_tables(center, periods_struct, timetables):
+    minio.save_df_center_temp(center, "periods_struct", pd.DataFrame(periods_struct))
+    minio.save_df_center_temp(center, "timetables", pd.DataFrame(timetables, columns=TIMETABLE_COLUMNS))
+    minio.save_df_center_temp(center, "gongs", pd.DataFrame([{"id": 1}, {"id": 2}, {"id": 3}]))
+    minio.save_df_center_temp(center, "targets", pd.DataFrame([{"shortname": "CC"}, {"shortname": "FH"}]))
+
+
+def reference_errors(center):
+    return _as_set(_frame_check_timings(*(minio.get_center_temp_df(center, df_name)
+                                          for df_name in ["periods_struct", "gongs", "targets", "timetables"])))
+
+
+# ----------------------------------------------------------------------
+# timings validator: same errors as the whole-table checks, kept up to date by the changes
+# ----------------------------------------------------------------------
+def test_validator_matches_frame_checks(edit_session):
+    rng = random.Random(16)
+    for _ in range(50):
+        save_tables("Mahi", *random_timings(rng, rng.randint(1, 5)))
+        assert _as_set(timings.check_timings(edit_session)) == reference_errors("Mahi")
+
+
+def test_changes_update_validator_incrementally(edit_session, monkeypatch):
+    rng = random.Random(17)
+    save_tables("Mahi", *random_timings(rng, 4))
+    timings.check_timings(edit_session)
+    builds = []
+    real_init = timings.TimingsValidator.__init__
+    monkeypatch.setattr(timings.TimingsValidator, "__init__",
+                        lambda self, center: builds.append(center) or real_init(self, center))
+    for _ in range(60):
+        period_type = f"T{rng.randint(0, 4)}"
+        if rng.random() < 0.5:
+            df_name, day = "periods_struct", rng.randint(0, 8)
+            row = {"period_type": period_type, "day": day, "day_type": rng.choice(["first", "day", "last"])}
+            keys = [[period_type, day]]
+        else:
+            df_name, row = "timetables", random_time_row(rng, period_type, rng.choice(["first", "day", "last"]))
+            keys = [[period_type, row["day_type"], row["time"]]]
+        change = {"op": "delete", "keys": keys} if rng.random() < 0.3 else {"op": "upsert", "rows": [row]}
+        timechan.change_timings("Mahi", df_name, [change])
+        assert _as_set(timings.check_timings(edit_session)) == reference_errors("Mahi")
+    assert builds == []
+
+
+def test_validator_rebuilt_when_table_replaced(edit_session):
+    save_tables("Mahi", [{"period_type": "10d", "day": 0, "day_type": "day"}],
+                [random_time_row(random.Random(0), "10d", "day") | {"gong_id": 1, "targets": "CC"}])
+    assert len(timings.check_timings(edit_session)) == 0
+    minio.save_df_center_temp("Mahi", "gongs", pd.DataFrame([{"id": 2}]))
+    errors = timings.check_timings(edit_session)
+    assert list(errors["error"]) == ["Invalid gong_id"]
+    assert list(errors["gong_id"]) == [1]
+
+
+def test_validator_forgotten_with_abandoned_session(edit_session):
+    save_tables("Mahi", *random_timings(random.Random(19), 2))
+    timings.check_timings(edit_session)
+    assert list(timings.timings_validators) == ["Mahi"]
+    minio.remove_temp_center_data("Mahi")  # edit abandoned
+    assert timings.timings_validators == {}
+
+
+# ----------------------------------------------------------------------
+# select_period / select_timings: only the selected rows rendered, kept until their tables change
+# ----------------------------------------------------------------------
+@pytest.fixture
+def shown_center(edit_session, monkeypatch):
+    rng = random.Random(18)
+    save_tables("Mahi", *random_timings(rng, 3))
+    minio.save_df_center_temp("Mahi", "center_periods",
+                              pd.DataFrame([{"period_type": f"T{t}", "tags": "F"} for t in range(3)]))
+    monkeypatch.setattr(timings, "fragments_cache", {})
+    renders = []
+    for name in ["struct_fragment", "timetable_fragment"]:
+        real = getattr(timings, name)
+        monkeypatch.setattr(timings, name, lambda *args, real=real, name=name: renders.append(name) or real(*args))
+    yield edit_session, renders
+
+
+def test_select_timings_renders_selected_rows(shown_center):
+    session, renders = shown_center
+    timetables_df = minio.get_center_temp_df("Mahi", "timetables")
+    period_type, day_type = timetables_df.loc[0, "period_type"], timetables_df.loc[0, "day_type"]
+    html = to_xml(timings.select_timings(session, period_type, day_type))
+    selected = timetables_df[(timetables_df["period_type"] == period_type) & (timetables_df["day_type"] == day_type)]
+    assert html.count("/timings/delete_timetable_row?idx=") == len(selected)
+    assert all(f"delete_timetable_row?idx={idx}\"" in html for idx in selected.index)
+
+
+def test_select_fragments_cached_until_table_changes(shown_center):
+    session, renders = shown_center
+    first = to_xml(timings.select_period(session, "T1"))
+    assert to_xml(timings.select_period(session, "T1")) == first
+    timings.select_timings(session, "T1", "day")
+    timings.select_timings(session, "T1", "day")
+    assert renders == ["struct_fragment", "timetable_fragment"]
+    timechan.change_timings("Mahi", "periods_struct",
+                            [{"op": "upsert", "rows": [{"period_type": "T1", "day": 9, "day_type": "day"}]}])
+    assert "<td>9</td>" in to_xml(timings.select_period(session, "T1"))
+    timings.select_timings(session, "T1", "day")
+    assert renders == ["struct_fragment", "timetable_fragment", "struct_fragment"]
+
+
+def test_fragments_forgotten_with_abandoned_session(shown_center):
+    session, _ = shown_center
+    timings.select_period(session, "T1")
+    timings.select_timings(session, "T1", "day")
+    timings.fragments_cache[("Pajjota", "10d", None)] = ((), "kept")
+    minio.remove_temp_center_data("Mahi")  # edit abandoned
+    assert list(timings.fragments_cache) == [("Pajjota", "10d", None)]
+
+
+def test_open_form_keeps_its_row_after_other_changes(shown_center):
+    session, renders = shown_center
+    timetables_df = minio.get_center_temp_df("Mahi", "timetables")
+    row_id = timetables_df.index[-1]
+    period_type, day_type, time = timetables_df.loc[row_id, ["period_type", "day_type", "time"]]
+    timechan.change_timings("Mahi", "timetables", [{"op": "upsert", "rows": [
+        random_time_row(random.Random(1), period_type, day_type) | {"time": "00:01"}]}])
+    assert f'value="{time}"' in to_xml(timechan.load_timing_form(session, row_id))
+    timechan.change_timings("Mahi", "timetables", [{"op": "delete", "keys": [[period_type, day_type, time]]}])
+    assert "deleted meanwhile" in to_xml(timechan.load_timing_form(session, row_id))
+    assert "deleted meanwhile" in to_xml(timechan.delete_timetable_row(session, row_id))
+
+
+# ----------------------------------------------------------------------
+# batch change of a day type: one change, one check, one repaint
+# ----------------------------------------------------------------------
+@pytest.fixture
+def batch_center(edit_session, monkeypatch):
+    save_tables("Mahi", [{"period_type": "10d", "day": 0, "day_type": "day"}],
+                [{"period_type": "10d", "day_type": "day", "time": time, "gong_id": 1, "auto": 0,
+                  "targets": "CC", "comment": ""} for time in ["04:00", "06:00", "21:00"]])
+    minio.save_df_center_temp("Mahi", "center_periods", pd.DataFrame([{"period_type": "10d", "tags": "F"}]))
+    repaints = []
+    monkeypatch.setattr(timechan, "repaint", lambda session, period_type, day_type, message, clear: repaints.append(message))
+    changes = []
+    real_change = timechan.change_timings
+    monkeypatch.setattr(timechan, "change_timings", lambda *args: changes.append(args) or real_change(*args))
+    yield edit_session, repaints, changes
+
+
+def test_batch_applies_differences_once(batch_center):
+    session, repaints, changes = batch_center
+    timings.check_timings(session)
+    timechan.batch_timetable(session, "10d", "day",
+                             "time,gong_id,auto,targets,comment\n04:00,1,0,CC,\n05:30,2,1,FH CC,new\n21:00,3,0,CC,\n")
+    assert repaints == [{"success": "times_batch_changed", "inserted": 1, "modified": 1, "deleted": 1}]
+    assert len(changes) == 1
+    df = minio.get_center_temp_df("Mahi", "timetables")
+    assert list(df["time"]) == ["04:00", "05:30", "21:00"]
+    assert df.loc[df["time"] == "05:30", "targets"].iat[0] == "CC FH"
+    assert _as_set(timings.check_timings(session)) == reference_errors("Mahi")
+
+
+def test_batch_rejects_invalid_line(batch_center):
+    session, repaints, changes = batch_center
+    timechan.batch_timetable(session, "10d", "day", "time,gong_id\n04:00,1\n4h,1\n")
+    timechan.batch_timetable(session, "10d", "day", "time,gong_id\n04:00,1\n04:00,2\n")
+    timechan.batch_timetable(session, "10d", "day", "time,gong_id\n")
+    assert [m.get("line") for m in repaints[:2]] == [3, 3]
+    assert repaints[2] == {"error": "delete_last_time"}
+    assert changes == []
+
+
+def test_batch_of_shown_timings_is_unchanged(batch_center):
+    session, repaints, changes = batch_center
+    html = to_xml(timings.select_timings(session, "10d", "day"))
+    shown_csv = html.split('name="timings_csv" rows="12">')[1].split("</textarea>")[0]
+    timechan.batch_timetable(session, "10d", "day", shown_csv)
+    assert repaints == [{"error": "timings_unchanged"}]